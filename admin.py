@@ -1,39 +1,27 @@
 import streamlit as st
 import pandas as pd
 import sqlite3
+import db
+import cache
+import tables
+import search
+import audit
 from datetime import datetime
 import bcrypt
 import yaml
 from yaml.loader import SafeLoader
 import stripe
 
-# Initialize database connection
-conn = sqlite3.connect('stunr_db.sqlite', check_same_thread=False)
-c = conn.cursor()
-
 # Audit logging function
-def log_audit(user_id, action, details):
-    timestamp = datetime.now().isoformat()
-    c.execute("INSERT INTO audit_logs (user_id, action, details, timestamp) VALUES (?, ?, ?, ?)",
-              (user_id, action, details, timestamp))
-    conn.commit()
+def log_audit(user_id, action, details, sync=False):
+    timestamp = audit.log_audit(user_id, action, details, sync=sync)
     st.write(f"Audit Log: {action} - {details} at {timestamp}")  # Optional feedback
 
 # Fetch or initialize invoice settings
-settings = c.execute("SELECT * FROM invoice_settings").fetchone()
-if not settings:
-    c.execute("INSERT INTO invoice_settings (company_name, company_address, logo_url, footer_text, primary_color, font) VALUES (?, ?, ?, ?, ?, ?)",
-              ("STUNR.ai", "Mock Merchant Address", "", "Thank you for your business! Contact: support@stunr.ai", '#6772e5', 'Helvetica'))
-    conn.commit()
-    settings = c.execute("SELECT * FROM invoice_settings").fetchone()
+settings = db.get_invoice_settings()
 
 # Fetch or initialize payment settings
-payment_settings = c.execute("SELECT * FROM payment_settings").fetchone()
-if not payment_settings:
-    c.execute("INSERT INTO payment_settings (stripe_publishable_key, stripe_secret_key) VALUES (?, ?)",
-              ("pk_test_...", "sk_test_..."))  # Replace with real test keys
-    conn.commit()
-    payment_settings = c.execute("SELECT * FROM payment_settings").fetchone()
+payment_settings = db.get_payment_settings()
 stripe.api_key = payment_settings[2]  # Secret key
 
 st.header("Admin")
@@ -42,18 +30,15 @@ admin_tab1, admin_tab2 = st.tabs(["User Management", "Settings"])
 with admin_tab1:
     st.subheader("User Management")
     # Use a safer query to handle missing org_id
-    users_df = pd.read_sql_query("SELECT id AS ID, username AS Username, email AS Email, name AS Name, role AS Role, created_at AS 'Created At' FROM users WHERE org_id = ? OR org_id IS NULL", conn, params=(st.session_state['org_id'],))
-    if not users_df.empty:
-        search_query = st.text_input("Search Users (Username, Email, Name)", placeholder="Search by username or email...")
-        if search_query:
-            users_df = users_df[
-                users_df['Username'].str.contains(search_query, case=False) |
-                users_df['Email'].str.contains(search_query, case=False) |
-                users_df['Name'].str.contains(search_query, case=False)
-            ]
+    search_query = st.text_input("Search Users (Username, Email, Name)", placeholder="Search by username or email...")
+    if search_query:
+        users_df = search.search_users(st.session_state['org_id'], search_query)
         st.dataframe(users_df, use_container_width=True, hide_index=True)
     else:
-        st.write("No users yet.")
+        users_df = tables.paginated_table("users", "id AS ID, username AS Username, email AS Email, name AS Name, role AS Role, created_at AS 'Created At'",
+                                          "FROM users WHERE (org_id = ? OR org_id IS NULL)", params=(st.session_state['org_id'],), org_id=st.session_state['org_id'])
+        if users_df.empty:
+            st.write("No users yet.")
 
     new_username = st.text_input("New Username")
     new_email = st.text_input("New Email")
@@ -65,10 +50,9 @@ with admin_tab1:
             hashed_password = bcrypt.hashpw(new_password.encode(), bcrypt.gensalt())
             created_at = datetime.now().isoformat()
             try:
-                c.execute("INSERT INTO users (username, email, password, name, role, created_at, org_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                          (new_username, new_email, hashed_password.decode(), new_name, new_role, created_at, st.session_state['org_id']))
-                conn.commit()
-                log_audit(st.session_state['user_id'], "added_user", f"Username: {new_username}")
+                db.execute("INSERT INTO users (username, email, password, name, role, created_at, org_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (new_username, new_email, hashed_password.decode(), new_name, new_role, created_at, st.session_state['org_id']))
+                log_audit(st.session_state['user_id'], "added_user", f"Username: {new_username}", sync=True)
                 st.success("User added successfully!")
                 # Update config.yaml dynamically (mock)
                 with open('config.yaml', 'r') as file:
@@ -89,7 +73,7 @@ with admin_tab1:
     if not users_df.empty:
         selected_user = st.selectbox("Edit User", [f"ID: {user['ID']} - {user['Username']}" for _, user in users_df.iterrows()])
         user_id = int(selected_user.split("ID: ")[1].split(" - ")[0])
-        user_data = c.execute("SELECT id, username, email, name, role, created_at FROM users WHERE id = ?", (user_id,)).fetchone()
+        user_data = db.query_one("SELECT id, username, email, name, role, created_at FROM users WHERE id = ?", (user_id,))
         if user_data:
             edit_username = st.text_input("Edit Username", value=user_data[1])
             edit_email = st.text_input("Edit Email", value=user_data[2])
@@ -103,9 +87,8 @@ with admin_tab1:
                 query_parts = [f"{k} = ?" for k in updates.keys()]
                 query = f"UPDATE users SET {', '.join(query_parts)} WHERE id = ?"
                 values = list(updates.values()) + [user_id]
-                c.execute(query, values)
-                conn.commit()
-                log_audit(st.session_state['user_id'], "updated_user", f"ID: {user_id}, Username: {edit_username}")
+                db.execute(query, values)
+                log_audit(st.session_state['user_id'], "updated_user", f"ID: {user_id}, Username: {edit_username}", sync=True)
                 st.success("User updated successfully!")
                 # Mock config update
                 with open('config.yaml', 'r') as file:
@@ -121,9 +104,8 @@ with admin_tab1:
                     yaml.dump(config_data, file)
                 st.info("Config updated (mock) - restart app for changes to take effect.")
             if st.button("Delete User", key=f"delete_user_{user_id}"):
-                c.execute("DELETE FROM users WHERE id = ?", (user_id,))
-                conn.commit()
-                log_audit(st.session_state['user_id'], "deleted_user", f"ID: {user_id}")
+                db.execute("DELETE FROM users WHERE id = ?", (user_id,))
+                log_audit(st.session_state['user_id'], "deleted_user", f"ID: {user_id}", sync=True)
                 st.success("User deleted successfully!")
                 # Mock config update
                 with open('config.yaml', 'r') as file:
@@ -146,12 +128,11 @@ with admin_tab2:
 
     if st.button("Save Settings"):
         if settings:
-            c.execute("UPDATE invoice_settings SET company_name = ?, company_address = ?, logo_url = ?, footer_text = ?, primary_color = ?, font = ? WHERE id = ?",
-                      (company_name, company_address, logo_url, footer_text, primary_color, font, settings[0]))
+            db.execute("UPDATE invoice_settings SET company_name = ?, company_address = ?, logo_url = ?, footer_text = ?, primary_color = ?, font = ? WHERE id = ?",
+                       (company_name, company_address, logo_url, footer_text, primary_color, font, settings[0]))
         else:
-            c.execute("INSERT INTO invoice_settings (company_name, company_address, logo_url, footer_text, primary_color, font) VALUES (?, ?, ?, ?, ?, ?)",
-                      (company_name, company_address, logo_url, footer_text, primary_color, font))
-        conn.commit()
+            db.execute("INSERT INTO invoice_settings (company_name, company_address, logo_url, footer_text, primary_color, font) VALUES (?, ?, ?, ?, ?, ?)",
+                       (company_name, company_address, logo_url, footer_text, primary_color, font))
         log_audit(st.session_state['user_id'], "updated_settings", "Invoice settings updated")
         st.success("Settings saved successfully!")
 
@@ -159,44 +140,40 @@ with admin_tab2:
     stripe_sk = st.text_input("Stripe Secret Key", value=payment_settings[2] if payment_settings else "sk_test_...", type="password")
     if st.button("Update Payment Settings"):
         if payment_settings:
-            c.execute("UPDATE payment_settings SET stripe_publishable_key = ?, stripe_secret_key = ? WHERE id = ?",
-                      (stripe_pk, stripe_sk, payment_settings[0]))
+            db.execute("UPDATE payment_settings SET stripe_publishable_key = ?, stripe_secret_key = ? WHERE id = ?",
+                       (stripe_pk, stripe_sk, payment_settings[0]))
         else:
-            c.execute("INSERT INTO payment_settings (stripe_publishable_key, stripe_secret_key) VALUES (?, ?)",
-                      (stripe_pk, stripe_sk))
-        conn.commit()
+            db.execute("INSERT INTO payment_settings (stripe_publishable_key, stripe_secret_key) VALUES (?, ?)",
+                       (stripe_pk, stripe_sk))
         stripe.api_key = stripe_sk
-        log_audit(st.session_state['user_id'], "updated_payment_settings", "Payment settings updated")
+        log_audit(st.session_state['user_id'], "updated_payment_settings", "Payment settings updated", sync=True)
         st.success("Payment settings updated successfully!")
 
     webhook_event = st.selectbox("Webhook Event", ["payment_success", "sub_cancel", "invoice_paid"])
     webhook_url = st.text_input("Webhook URL")
     if st.button("Add Webhook"):
         if webhook_event and webhook_url:
-            c.execute("INSERT INTO webhooks (event, url) VALUES (?, ?)", (webhook_event, webhook_url))
-            conn.commit()
+            db.execute("INSERT INTO webhooks (event, url) VALUES (?, ?)", (webhook_event, webhook_url))
             log_audit(st.session_state['user_id'], "added_webhook", f"Event: {webhook_event}, URL: {webhook_url}")
             st.success("Webhook added successfully!")
         else:
             st.error("Please fill all fields.")
 
-    webhooks_df = pd.read_sql_query("SELECT id AS ID, event AS Event, url AS URL FROM webhooks", conn)
+    webhooks_df = cache.read_sql("SELECT id AS ID, event AS Event, url AS URL FROM webhooks")
     if not webhooks_df.empty:
         st.dataframe(webhooks_df, use_container_width=True, hide_index=True)
         selected_webhook = st.selectbox("Edit Webhook", [f"ID: {row['ID']} - {row['Event']}" for _, row in webhooks_df.iterrows()])
         webhook_id = int(selected_webhook.split("ID: ")[1].split(" - ")[0])
-        webhook_data = c.execute("SELECT id, event, url FROM webhooks WHERE id = ?", (webhook_id,)).fetchone()
+        webhook_data = db.query_one("SELECT id, event, url FROM webhooks WHERE id = ?", (webhook_id,))
         if webhook_data:
             edit_event = st.selectbox("Edit Event", ["payment_success", "sub_cancel", "invoice_paid"], index=["payment_success", "sub_cancel", "invoice_paid"].index(webhook_data[1]))
             edit_url = st.text_input("Edit URL", value=webhook_data[2])
             if st.button("Update Webhook", key=f"update_webhook_{webhook_id}"):
-                c.execute("UPDATE webhooks SET event = ?, url = ? WHERE id = ?", (edit_event, edit_url, webhook_id))
-                conn.commit()
+                db.execute("UPDATE webhooks SET event = ?, url = ? WHERE id = ?", (edit_event, edit_url, webhook_id))
                 log_audit(st.session_state['user_id'], "updated_webhook", f"ID: {webhook_id}")
                 st.success("Webhook updated successfully!")
             if st.button("Delete Webhook", key=f"delete_webhook_{webhook_id}"):
-                c.execute("DELETE FROM webhooks WHERE id = ?", (webhook_id,))
-                conn.commit()
+                db.execute("DELETE FROM webhooks WHERE id = ?", (webhook_id,))
                 log_audit(st.session_state['user_id'], "deleted_webhook", f"ID: {webhook_id}")
                 st.success("Webhook deleted successfully!")
                 st.experimental_rerun()
\ No newline at end of file
@@ -0,0 +1,73 @@
+import atexit
+import threading
+from datetime import datetime
+import db
+
+# Buffered audit log writer.
+# Entries are queued in memory and written to audit_logs in one transaction per batch,
+# either when FLUSH_SIZE entries are waiting or every FLUSH_INTERVAL seconds.
+# log_audit(..., sync=True) flushes everything queued so far durably before returning.
+
+FLUSH_SIZE = 500
+FLUSH_INTERVAL = 1.0  # seconds
+
+_queue = []
+_queue_lock = threading.Lock()
+_flush_lock = threading.Lock()  # keeps batches in the order they were queued
+_wakeup = threading.Event()
+_flusher = None
+
+
+def flush(durable=False):
+    with _flush_lock:
+        with _queue_lock:
+            batch = _queue[:]
+            _queue.clear()
+        if not batch:
+            return 0
+        try:
+            with db.transaction(durable=durable) as cur:
+                cur.executemany("INSERT INTO audit_logs (user_id, action, details, timestamp) VALUES (?, ?, ?, ?)", batch)
+        except Exception:
+            # Put the batch back in front so nothing is lost; the next flush retries it
+            with _queue_lock:
+                _queue[:0] = batch
+            raise
+        return len(batch)
+
+
+def _flush_loop():
+    while True:
+        _wakeup.wait(FLUSH_INTERVAL)
+        _wakeup.clear()
+        try:
+            flush()
+        except Exception as e:
+            print(f"Audit flush failed, will retry: {e}")
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is None:
+        with _queue_lock:
+            if _flusher is None:
+                _flusher = threading.Thread(target=_flush_loop, name="audit-flusher", daemon=True)
+                _flusher.start()
+
+
+# Queue an audit entry and return its timestamp
+def log_audit(user_id, action, details, sync=False):
+    timestamp = datetime.now().isoformat()
+    _ensure_flusher()
+    with _queue_lock:
+        _queue.append((user_id, action, details, timestamp))
+        pending = len(_queue)
+    if sync:
+        flush(durable=True)
+    elif pending >= FLUSH_SIZE:
+        _wakeup.set()
+    return timestamp
+
+
+# Whatever is still queued goes to disk on interpreter shutdown
+atexit.register(flush, durable=True)
@@ -0,0 +1,122 @@
+import argparse
+from datetime import date, datetime, timedelta
+import numpy as np
+import pandas as pd
+import db
+import tax_engine
+
+# Subscription billing runs.
+# A run bills one calendar month (period 'YYYY-MM') for every subscription that is not
+# canceled, started before the period ends and was not billed since the period began.
+# Subscriptions are read CHUNK_SIZE at a time in id order, and trial, proration, coupon and
+# tax are computed for the whole chunk with NumPy:
+#   billable days = days of the period after max(start_date + trial_days, period start)
+#   subtotal      = amount * billable days / days in period * (1 - coupon_pct / 100)
+#   tax           = tax_engine.compute_tax on the subtotal, both rounded to the cent
+#   total         = subtotal + tax
+# Tax follows the same source as the Taxes page: the tax_rules rate of the customer's country,
+# and subscriptions.tax_rate only for countries without a rule.
+# Subscriptions still in their trial for the whole period get no invoice. Each chunk's
+# invoices and last_bill_date updates are one transaction, and invoices are unique per
+# (sub_id, period), so a run that crashed can simply be started again; a run's totals count
+# only the invoices it created. Runs are recorded in billing_runs with the org they billed
+# (NULL for a run over every org).
+
+CHUNK_SIZE = 50000
+DUE_DAYS = 30
+
+
+def create_tables(cur):
+    cur.execute("""CREATE TABLE IF NOT EXISTS billing_runs
+                   (id INTEGER PRIMARY KEY, org_id INTEGER, period TEXT, started_at TEXT, finished_at TEXT, invoices_created INTEGER DEFAULT 0, amount_billed FLOAT DEFAULT 0, status TEXT DEFAULT 'running')""")
+
+
+def period_bounds(period):
+    start = datetime.strptime(period, '%Y-%m').date()
+    end = (start + timedelta(days=32)).replace(day=1)
+    return start, end
+
+
+# Invoice amounts for one chunk. Returns (subtotal, rate, tax, total, prorated, billable) arrays;
+# countries/tax_rate/rules are passed on to tax_engine.compute_tax.
+def compute_amounts(amount, start_day, trial_days, coupon_pct, countries, tax_rate, period_start, period_end, rules=None):
+    days = (np.datetime64(period_end) - np.datetime64(period_start)).astype(np.int64)
+    billable_from = np.maximum(start_day + trial_days.astype('timedelta64[D]'), np.datetime64(period_start))
+    billable_days = np.clip((np.datetime64(period_end) - billable_from).astype(np.int64), 0, days)
+    subtotal = amount * (billable_days / days) * (1 - coupon_pct / 100)
+    subtotal = np.round(subtotal, 2)
+    rate, tax, total = tax_engine.compute_tax(subtotal, countries, tax_rate, rules)
+    return subtotal, rate, tax, total, billable_days < days, billable_days > 0
+
+
+def _load_chunk(after_id, period_start, period_end, org_id=None):
+    sql = """SELECT s.id, s.org_id, s.amount, substr(s.start_date, 1, 10), s.trial_days, s.coupon_pct, upper(c.country), s.tax_rate
+             FROM subscriptions s LEFT JOIN customers c ON c.id = s.customer_id
+             WHERE s.id > ? AND COALESCE(s.status, '') != 'canceled' AND s.start_date IS NOT NULL AND s.start_date < ?
+                   AND (s.last_bill_date IS NULL OR s.last_bill_date < ?)"""
+    params = [after_id, period_end.isoformat(), period_start.isoformat()]
+    if org_id is not None:
+        sql += " AND s.org_id = ?"
+        params.append(org_id)
+    return db.query(sql + " ORDER BY s.id LIMIT ?", params + [CHUNK_SIZE])
+
+
+def _bill_chunk(rows, period, period_start, period_end, rules):
+    ids, org_ids, amount, start, trial, coupon, country, tax_rate = zip(*rows)
+    subtotal, tax_rate, tax, total, prorated, billable = compute_amounts(
+        np.nan_to_num(np.array(amount, dtype=float)),
+        np.array(start, dtype='datetime64[D]'),
+        np.nan_to_num(np.array(trial, dtype=float)).astype(np.int64),
+        np.nan_to_num(np.array(coupon, dtype=float)),
+        pd.Series(country),
+        np.nan_to_num(np.array(tax_rate, dtype=float)),
+        period_start, period_end, rules)
+    issued = period_start.isoformat()
+    due = (period_start + timedelta(days=DUE_DAYS)).isoformat()
+    billed = np.flatnonzero(billable)
+    invoices = [(ids[i], org_ids[i], issued, float(total[i]), float(subtotal[i]), float(tax_rate[i]), float(tax[i]), 'open', due, period) for i in billed.tolist()]
+    with db.transaction() as cur:
+        last_id = cur.execute("SELECT COALESCE(MAX(id), 0) FROM invoices").fetchone()[0]
+        cur.executemany("INSERT OR IGNORE INTO invoices (sub_id, org_id, date, amount, net_amount, tax_rate, tax_amount, status, due_date, period) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", invoices)
+        # Subscriptions already invoiced for the period were ignored; only the new rows count
+        inserted = [row[0] for row in cur.execute("SELECT sub_id FROM invoices WHERE id > ?", (last_id,))]
+        cur.executemany("UPDATE subscriptions SET last_bill_date = ? WHERE id = ?", [(issued, ids[i]) for i in billed.tolist()])
+    created = billed[np.isin(np.array(ids)[billed], inserted)]
+    return len(created), float(total[created].sum()), int(prorated[created].sum())
+
+
+# Bill every due subscription for period ('YYYY-MM', default: the current month).
+# Returns {'run_id', 'invoices', 'amount', 'prorated'}.
+def run(period=None, org_id=None):
+    period = period or date.today().strftime('%Y-%m')
+    period_start, period_end = period_bounds(period)
+    with db.transaction() as cur:
+        cur.execute("INSERT INTO billing_runs (org_id, period, started_at) VALUES (?, ?, ?)", (org_id, period, datetime.now().isoformat()))
+        run_id = cur.lastrowid
+    created, billed, prorated, after_id = 0, 0.0, 0, 0
+    try:
+        rules = tax_engine.rule_index()
+        while True:
+            rows = _load_chunk(after_id, period_start, period_end, org_id)
+            if not rows:
+                break
+            n, amount, p = _bill_chunk(rows, period, period_start, period_end, rules)
+            created, billed, prorated, after_id = created + n, billed + amount, prorated + p, rows[-1][0]
+            db.execute("UPDATE billing_runs SET invoices_created = ?, amount_billed = ? WHERE id = ?", (created, billed, run_id))
+        status = 'completed'
+    except BaseException:
+        status = 'failed'
+        raise
+    finally:
+        db.execute("UPDATE billing_runs SET finished_at = ?, invoices_created = ?, amount_billed = ?, status = ? WHERE id = ?",
+                   (datetime.now().isoformat(), created, billed, status, run_id))
+    return {'run_id': run_id, 'invoices': created, 'amount': round(billed, 2), 'prorated': prorated}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate renewal invoices for every subscription due in a billing period.")
+    parser.add_argument('--period', default=None, help="Billing month YYYY-MM (default: current month)")
+    parser.add_argument('--org-id', type=int, default=None, help="Only bill this org (default: all)")
+    args = parser.parse_args()
+    result = run(args.period, args.org_id)
+    print(f"Billing run {result['run_id']}: {result['invoices']} invoices, {result['amount']:.2f} USDC ({result['prorated']} prorated)")
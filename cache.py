@@ -0,0 +1,144 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+import db
+
+# In-memory cache for read_sql results (and other DataFrames derived from the database).
+# Streamlit reruns a page on every widget interaction, so the same org-scoped query is
+# issued again and again while a user types into a search box. Results are kept per
+# (sql, params, org_id) in an LRU bounded by MEMORY_BUDGET bytes and dropped as soon as a
+# table they read from is written:
+#  - commits through db.transaction() report the tables they wrote (db.on_commit), widened
+#    with every table their triggers write to (rollups, org_id cascades, ...);
+#  - commits from other processes are detected through PRAGMA data_version and clear everything.
+
+MEMORY_BUDGET = int(os.environ.get('STUNR_QUERY_CACHE_MB', '256')) * 1024 * 1024
+MAX_ENTRY_FRACTION = 4  # results larger than MEMORY_BUDGET / 4 are never cached
+
+READ_TABLES = re.compile(r"\b(?:FROM|JOIN)\s+[\"`\[]?(\w+)", re.IGNORECASE)
+
+_entries = OrderedDict()  # key -> (DataFrame, size, tables)
+_by_table = {}            # table -> set of keys reading it
+_size = 0
+_lock = threading.Lock()
+_generation = 0           # bumped on every invalidation; stale reads are not stored
+_data_version = None
+_trigger_targets = None   # table -> tables written by its triggers (transitively)
+_hits = 0
+_misses = 0
+
+
+def _load_trigger_targets():
+    direct = {}
+    for table, sql in db.query("SELECT tbl_name, sql FROM sqlite_master WHERE type = 'trigger'"):
+        body = sql.split('BEGIN', 1)[-1]
+        direct.setdefault(table.lower(), set()).update(t.lower() for t in db.WRITE_TARGET.findall(body))
+    closure = {}
+    for table in direct:
+        seen = set()
+        todo = [table]
+        while todo:
+            for target in direct.get(todo.pop(), ()):
+                if target not in seen:
+                    seen.add(target)
+                    todo.append(target)
+        closure[table] = seen
+    return closure
+
+
+def _drop(key):
+    global _size
+    df, size, tables = _entries.pop(key)
+    _size -= size
+    for table in tables:
+        keys = _by_table.get(table)
+        if keys:
+            keys.discard(key)
+            if not keys:
+                del _by_table[table]
+
+
+# Drop every cached result that reads from one of tables (all results when tables is None)
+def invalidate(tables=None):
+    global _generation, _size, _trigger_targets
+    with _lock:
+        _generation += 1
+        if tables is None:
+            _entries.clear()
+            _by_table.clear()
+            _size = 0
+            _trigger_targets = None  # schema may have changed too
+            return
+        affected = set()
+        for table in tables:
+            table = table.lower()
+            affected.add(table)
+            affected |= (_trigger_targets or {}).get(table, set())
+        for table in affected:
+            for key in list(_by_table.get(table, ())):
+                _drop(key)
+
+
+db.on_commit(invalidate)
+
+
+# Clear everything if another process committed since the last check.
+# Returns False when the check could not be made (the caller should not use the cache).
+def _check_external_writes():
+    global _data_version
+    version = db.data_version()
+    if version is None:
+        return False
+    if _data_version is None:
+        _data_version = version
+    elif version != _data_version:
+        _data_version = version
+        invalidate()
+    return True
+
+
+# Return compute() (a DataFrame), cached under key until one of tables is written.
+# The DataFrame returned is a copy, so callers may add or convert columns.
+def memoize(key, tables, compute, org_id=None):
+    global _size, _trigger_targets, _hits, _misses
+    if not _check_external_writes():
+        return compute()
+    key = (key, org_id)
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            _entries.move_to_end(key)
+            _hits += 1
+            return entry[0].copy()
+        _misses += 1
+        generation = _generation
+    if _trigger_targets is None:
+        _trigger_targets = _load_trigger_targets()
+
+    df = compute()
+    size = int(df.memory_usage(index=True, deep=True).sum())
+    if size > MEMORY_BUDGET // MAX_ENTRY_FRACTION:
+        return df
+    tables = {t.lower() for t in tables}
+    with _lock:
+        if generation != _generation or key in _entries:
+            return df  # a write landed while we were computing
+        _entries[key] = (df, size, tables)
+        _size += size
+        for table in tables:
+            _by_table.setdefault(table, set()).add(key)
+        while _size > MEMORY_BUDGET and _entries:
+            _drop(next(iter(_entries)))
+    return df.copy()
+
+
+# Cached db.read_sql; the tables a query reads are taken from its FROM/JOIN clauses
+def read_sql(sql, params=(), org_id=None):
+    params_key = tuple(sorted(params.items())) if isinstance(params, dict) else tuple(params)
+    return memoize((sql, params_key), READ_TABLES.findall(sql), lambda: db.read_sql(sql, params=params), org_id)
+
+
+def stats():
+    with _lock:
+        return {'entries': len(_entries), 'bytes': _size, 'budget': MEMORY_BUDGET, 'hits': _hits, 'misses': _misses}
@@ -0,0 +1,142 @@
+import numpy as np
+import pandas as pd
+import cache
+import db
+
+# Chart data layer.
+# Every series handed to alt.Chart is aggregated in SQL to the granularity it is drawn at,
+# line/area series are thinned to at most MAX_POINTS with largest-triangle-three-buckets,
+# bar charts keep their MAX_CATEGORIES largest categories, and the finished series is cached
+# per (chart, org, time range) until one of its source tables is written.
+
+MAX_POINTS = 1000
+MAX_CATEGORIES = 50
+
+# Grain -> length of the ISO timestamp prefix that identifies a bucket
+GRAIN_LENGTH = {'hour': 13, 'day': 10, 'month': 7}
+
+
+def bucket_sql(col, grain):
+    return f"substr({col}, 1, {GRAIN_LENGTH[grain]})"
+
+
+# "AND col >= ? AND col <= ?" for whichever ends of the range are given
+def _range_clause(col, start, end):
+    sql, params = "", []
+    if start is not None:
+        sql += f" AND {col} >= ?"
+        params.append(str(start))
+    if end is not None:
+        sql += f" AND {col} <= ?"
+        params.append(str(end) + '~')  # '~' sorts after any time suffix, so the whole end day is included
+    return sql, params
+
+
+# Indices of the points largest-triangle-three-buckets keeps out of (x, y).
+# The first and last points are always kept; each inner bucket keeps the point forming the
+# largest triangle with the point kept before it and the average of the next bucket.
+def lttb_indices(x, y, threshold):
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    bounds = np.floor(np.linspace(1, n - 1, threshold - 1)).astype(np.int64)
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = bounds[i], bounds[i + 1]
+        next_start, next_end = (bounds[i + 1], bounds[i + 2]) if i + 2 < len(bounds) else (n - 1, n)
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        keep[i + 1] = a
+    return keep
+
+
+# Thin a line series (sorted by x) to max_points per group
+def downsample(df, x, y, max_points=MAX_POINTS, group=None):
+    if group is None:
+        if len(df) <= max_points:
+            return df.reset_index(drop=True)
+        xs = pd.to_datetime(df[x]).astype('int64') if not pd.api.types.is_numeric_dtype(df[x]) else df[x]
+        return df.iloc[lttb_indices(xs.to_numpy(), df[y].to_numpy(), max_points)].reset_index(drop=True)
+    parts = [downsample(part, x, y, max_points) for _, part in df.groupby(group, sort=False)]
+    return pd.concat(parts, ignore_index=True) if parts else df
+
+
+# Keep the n largest categories by value
+def top_categories(df, value, n=MAX_CATEGORIES):
+    return df.nlargest(n, value) if len(df) > n else df
+
+
+def _series(name, tables, compute, org_id=None, **range_key):
+    return cache.memoize(('chart', name, tuple(sorted(range_key.items()))), tables, compute, org_id)
+
+
+# Metered usage per grain ('hour' reads usage_hourly, 'day'/'month' read usage_daily)
+def usage_trend(org_id, grain='day', start=None, end=None, max_points=MAX_POINTS):
+    table, bucket = ('usage_hourly', 'hour') if grain == 'hour' else ('usage_daily', 'day')
+    def compute():
+        where, params = _range_clause(bucket, start, end)
+        df = db.read_sql(f"SELECT {bucket_sql(bucket, grain)} AS timestamp, SUM(quantity) AS quantity FROM {table} WHERE org_id = ?{where} GROUP BY 1 ORDER BY 1",
+                         params=[org_id] + params)
+        df['timestamp'] = pd.to_datetime(df['timestamp'])
+        return downsample(df, 'timestamp', 'quantity', max_points)
+    return _series('usage_trend', [table], compute, org_id, grain=grain, start=start, end=end, max_points=max_points)
+
+
+# Cumulative subscriptions by start day
+def subscription_growth(org_id, start=None, end=None, max_points=MAX_POINTS):
+    def compute():
+        where, params = _range_clause('start_date', start, end)
+        df = db.read_sql(f"""SELECT start_date, SUM(COUNT(*)) OVER (ORDER BY start_date) AS cum_subs
+                             FROM (SELECT {bucket_sql('start_date', 'day')} AS start_date FROM subscriptions WHERE org_id = ? AND start_date IS NOT NULL{where})
+                             GROUP BY start_date ORDER BY start_date""", params=[org_id] + params)
+        df['start_date'] = pd.to_datetime(df['start_date'])
+        return downsample(df, 'start_date', 'cum_subs', max_points)
+    return _series('subscription_growth', ['subscriptions'], compute, org_id, start=start, end=end, max_points=max_points)
+
+
+def churn_by_plan(org_id):
+    def compute():
+        df = db.read_sql("SELECT plan, SUM(status = 'canceled') * 100.0 / COUNT(*) AS churn_rate, COUNT(*) AS subs FROM subscriptions WHERE org_id = ? GROUP BY plan",
+                         params=(org_id,))
+        return top_categories(df, 'subs')
+    return _series('churn_by_plan', ['subscriptions'], compute, org_id)
+
+
+# Paid revenue per month from the revenue_monthly rollup
+def monthly_revenue(org_id, start_month=None, end_month=None, max_points=MAX_POINTS):
+    def compute():
+        where, params = _range_clause('month', start_month, end_month)
+        df = db.read_sql(f"SELECT month, paid_amount AS amount FROM revenue_monthly WHERE org_id = ? AND paid_count > 0{where} ORDER BY month",
+                         params=[org_id] + params)
+        df['month'] = pd.to_datetime(df['month'])
+        return downsample(df, 'month', 'amount', max_points)
+    return _series('monthly_revenue', ['revenue_monthly'], compute, org_id, start=start_month, end=end_month, max_points=max_points)
+
+
+# Payouts and payout batches summed per day and status
+def payout_trend(grain='day', start=None, end=None, max_points=MAX_POINTS):
+    def compute():
+        where, params = _range_clause('date', start, end)
+        df = db.read_sql(f"""SELECT {bucket_sql('date', grain)} AS date, status, SUM(amount) AS amount
+                             FROM (SELECT date, amount, status FROM payouts UNION ALL SELECT date, total_amount AS amount, status FROM payout_batches)
+                             WHERE date IS NOT NULL{where}
+                             GROUP BY 1, 2 ORDER BY 2, 1""", params=params)
+        df['date'] = pd.to_datetime(df['date'])
+        return downsample(df, 'date', 'amount', max_points, group='status')
+    return _series('payout_trend', ['payouts', 'payout_batches'], compute, grain=grain, start=start, end=end, max_points=max_points)
+
+
+# Recognized revenue per month from the recognized_revenue_monthly rollup, with report column names
+def recognized_revenue(org_id, start_month=None, end_month=None, max_points=MAX_POINTS):
+    def compute():
+        where, params = _range_clause('month', start_month, end_month)
+        df = db.read_sql(f"SELECT month AS Month, recognized_amount AS 'Recognized Revenue (USDC)' FROM recognized_revenue_monthly WHERE org_id = ?{where} ORDER BY month",
+                         params=[org_id] + params)
+        return df.tail(max_points).reset_index(drop=True)
+    return _series('recognized_revenue', ['recognized_revenue_monthly'], compute, org_id, start=start_month, end=end_month, max_points=max_points)
@@ -0,0 +1,174 @@
+import argparse
+import threading
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import cache
+import db
+import scheduler
+
+# Subscription cohort retention.
+# A subscription belongs to the cohort of its start month and counts as active in every
+# calendar month from its start month up to and including the month it was canceled
+# (subscriptions.canceled_at, stamped by trigger), or up to the current month while it is
+# still running. cohort_retention stores active_subs per (org, cohort_month, period) where
+# period = months since the cohort month; period 0 is the cohort size.
+#
+# Months before cohort_state.computed_through are closed and only recomputed when a
+# subscription written later reaches back into them: triggers on subscriptions record the
+# earliest such month in cohort_state.dirty_from (a backdated start_date, or a cancel date
+# that changed). A refresh only loads subscriptions still alive from the first open or dirty
+# month and rewrites the months from there, so a new month costs one pass over the live
+# subscriptions instead of the whole history.
+# Refreshes run off the page render: a daemon thread (start_refresher, started by app.py)
+# refreshes every org each REFRESH_INTERVAL, claimed through the scheduler so one process
+# does it; pages only read cohort_retention.
+
+REFRESH_INTERVAL = timedelta(minutes=15)
+MAX_COHORTS = 36
+JOB_NAME = 'cohort_refresh'
+
+_refresher = None
+_refresher_lock = threading.Lock()
+
+# Month number (year * 12 + month - 1) of an ISO date column
+_MONTH_SQL = "CAST(substr({col}, 1, 4) AS INTEGER) * 12 + CAST(substr({col}, 6, 2) AS INTEGER) - 1"
+
+
+def _month_index(when):
+    return when.year * 12 + when.month - 1
+
+
+def _month_label(index):
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+
+def create_tables(cur):
+    cur.execute("""CREATE TABLE IF NOT EXISTS cohort_retention
+                   (org_id INTEGER, cohort_month TEXT, period INTEGER, active_subs INTEGER, PRIMARY KEY (org_id, cohort_month, period)) WITHOUT ROWID""")
+    cur.execute("CREATE TABLE IF NOT EXISTS cohort_state (org_id INTEGER PRIMARY KEY, computed_through TEXT, refreshed_at TEXT, dirty_from TEXT, dirty_seq INTEGER DEFAULT 0)")
+
+
+# Active subscriptions per (cohort, calendar month), cohorts cohort_min..cohort_max and
+# calendar months first..last. starts/ends are month numbers; ends = last for subscriptions
+# that are still running. Each subscription adds +1 at max(start, first) and -1 after its end
+# on a (cohort x month) difference grid, so one bincount and one cumsum cover all of them.
+def active_matrix(starts, ends, first, last, cohort_min, cohort_max):
+    n_cohorts = cohort_max - cohort_min + 1
+    width = last - first + 2  # one spare column absorbs the -1 of subscriptions running through `last`
+    rows = starts - cohort_min
+    enter = np.maximum(starts, first) - first
+    leave = np.minimum(ends, last) - first + 1
+    keep = leave > enter
+    size = n_cohorts * width
+    grid = np.bincount(rows[keep] * width + enter[keep], minlength=size) - np.bincount(rows[keep] * width + leave[keep], minlength=size)
+    return np.cumsum(grid.reshape(n_cohorts, width), axis=1)[:, :-1]
+
+
+def _load_lifetimes(org_id, since_month):
+    start = _MONTH_SQL.format(col='start_date')
+    cancel = _MONTH_SQL.format(col='canceled_at')
+    rows = db.query(f"""SELECT {start}, CASE WHEN status = 'canceled' THEN {cancel} END
+                        FROM subscriptions
+                        WHERE org_id = ? AND start_date IS NOT NULL AND (COALESCE(status, '') != 'canceled' OR canceled_at IS NULL OR canceled_at >= ?)""",
+                    (org_id, f"{_month_label(since_month)}-01"))
+    data = np.array(rows, dtype=float).reshape(-1, 2)
+    return data[:, 0], data[:, 1]
+
+
+# Recompute the open months for one org; full=True recomputes every month from the first cohort
+def refresh(org_id, full=False, now=None):
+    now = now or datetime.now()
+    current = _month_index(now)
+    state = db.query_one("SELECT computed_through, dirty_from, dirty_seq FROM cohort_state WHERE org_id = ?", (org_id,))
+    if full or state is None or state[0] is None:
+        first_start = db.query_one("SELECT MIN(start_date) FROM subscriptions WHERE org_id = ? AND start_date IS NOT NULL", (org_id,))[0]
+        first = _month_index(datetime.fromisoformat(first_start[:10])) if first_start else current
+    else:
+        first = _month_index(datetime.strptime(min(state[0], state[1] or state[0]), '%Y-%m'))
+    first = min(first, current)
+
+    starts, ends = _load_lifetimes(org_id, first)
+    valid = ~np.isnan(starts) & (starts <= current)
+    starts = starts[valid].astype(np.int64)
+    ends = np.nan_to_num(ends[valid], nan=current).astype(np.int64)
+    ends = np.maximum(ends, starts)  # canceled_at before start_date still counts its start month
+
+    # Cohorts that already exist keep getting (possibly zero) cells even when nobody in them is left
+    known = {_month_index(datetime.strptime(row[0], '%Y-%m')) for row in
+             db.query("SELECT DISTINCT cohort_month FROM cohort_retention WHERE org_id = ? AND period = 0", (org_id,))}
+    known.update(np.unique(starts).tolist())
+    known = np.array(sorted(known), dtype=np.int64)
+    rows = []
+    if len(known):
+        cohort_min = int(known[0])
+        active = active_matrix(starts, ends, first, current, cohort_min, int(known[-1]))
+        cohorts = known - cohort_min
+        months = np.arange(first, current + 1)
+        cells = np.argwhere(months[None, :] >= known[:, None])
+        cohort_cells = known[cells[:, 0]]
+        month_cells = months[cells[:, 1]]
+        counts = active[cohorts[cells[:, 0]], cells[:, 1]]
+        labels = {c: _month_label(c) for c in known.tolist()}
+        rows = [(org_id, labels[c], m - c, n) for c, m, n in zip(cohort_cells.tolist(), month_cells.tolist(), counts.tolist())]
+
+    with db.transaction() as cur:
+        # Wipe the open months (period = month - cohort) so subscriptions that left are not kept
+        cur.execute(f"DELETE FROM cohort_retention WHERE org_id = ? AND ({_MONTH_SQL.format(col='cohort_month')}) + period >= ?", (org_id, first))
+        cur.executemany("INSERT INTO cohort_retention (org_id, cohort_month, period, active_subs) VALUES (?, ?, ?, ?)", rows)
+        # Months marked dirty while this refresh ran (dirty_seq moved on) stay marked
+        cur.execute("""INSERT INTO cohort_state (org_id, computed_through, refreshed_at) VALUES (?, ?, ?) ON CONFLICT (org_id) DO UPDATE SET computed_through = excluded.computed_through, refreshed_at = excluded.refreshed_at,
+                       dirty_from = CASE WHEN cohort_state.dirty_seq IS ? THEN NULL ELSE cohort_state.dirty_from END""",
+                    (org_id, _month_label(current), now.isoformat(), state[2] if state else None))
+    return len(rows)
+
+
+# Refresh every org with subscriptions; returns {org_id: cohort cells written}
+def refresh_all(full=False):
+    org_ids = [row[0] for row in db.query("SELECT DISTINCT org_id FROM subscriptions WHERE org_id IS NOT NULL")]
+    return {org_id: refresh(org_id, full=full) for org_id in org_ids}
+
+
+def _refresh_loop():
+    while True:
+        try:
+            if scheduler.claim(JOB_NAME, REFRESH_INTERVAL.total_seconds()):
+                refresh_all()
+        except Exception as e:
+            print(f"Cohort refresh failed, will retry: {e}")
+        time.sleep(REFRESH_INTERVAL.total_seconds())
+
+
+# Start the background refresher once per process
+def start_refresher():
+    global _refresher
+    if _refresher is None:
+        with _refresher_lock:
+            if _refresher is None:
+                _refresher = threading.Thread(target=_refresh_loop, name="cohort-refresher", daemon=True)
+                _refresher.start()
+
+
+# Retention matrix for the last max_cohorts cohorts: one row per cohort month, one column per
+# period, values in percent of the cohort size. Cohort sizes are returned alongside.
+def retention_matrix(org_id, max_cohorts=MAX_COHORTS):
+    df = cache.read_sql("""SELECT cohort_month, period, active_subs FROM cohort_retention
+                           WHERE org_id = ? AND cohort_month IN (SELECT DISTINCT cohort_month FROM cohort_retention WHERE org_id = ? ORDER BY cohort_month DESC LIMIT ?)""",
+                        params=(org_id, org_id, max_cohorts), org_id=org_id)
+    if df.empty:
+        return pd.DataFrame(), pd.Series(dtype='int64')
+    counts = df.pivot(index='cohort_month', columns='period', values='active_subs').sort_index()
+    sizes = counts[0].fillna(0).astype('int64') if 0 in counts.columns else pd.Series(0, index=counts.index)
+    retention = counts.divide(sizes.where(sizes > 0), axis=0) * 100
+    return retention, sizes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Refresh the cohort retention matrix (run monthly or from cron).")
+    parser.add_argument('--org-id', type=int, default=None, help="Only refresh this org (default: all)")
+    parser.add_argument('--full', action='store_true', help="Recompute closed months too")
+    args = parser.parse_args()
+    written = {args.org_id: refresh(args.org_id, full=args.full)} if args.org_id is not None else refresh_all(full=args.full)
+    for org_id, cells in written.items():
+        print(f"Org {org_id}: {cells} cohort cells written")
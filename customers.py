@@ -5,65 +5,29 @@ import dash_html_components as html
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output, State
 import pandas as pd
-import sqlite3
+import db
+import audit
+from loaders import load_customers_with_subscription
+from search import customer_ids as search_customers
 from datetime import datetime, timedelta
 import stripe
-from solana.rpc.api import Client
 import numpy as np
 
 # Initialize Dash app
 app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 
-# Initialize database connection
-conn = sqlite3.connect('stunr_db.sqlite', check_same_thread=False)
-c = conn.cursor()
-
 # Mock email sender
 def mock_email(to_email, subject, body, attachment=None):
     print(f"Email sent to {to_email}: Subject - {subject}\nBody - {body}\nAttachment - {attachment if attachment else 'None'}")
 
 # Audit logging function
-def log_audit(user_id, action, details):
-    timestamp = datetime.now().isoformat()
-    c.execute("INSERT INTO audit_logs (user_id, action, details, timestamp) VALUES (?, ?, ?, ?)",
-              (user_id, action, details, timestamp))
-    conn.commit()
+def log_audit(user_id, action, details, sync=False):
+    timestamp = audit.log_audit(user_id, action, details, sync=sync)
     print(f"Audit Log: {action} - {details} at {timestamp}")  # Using print for now
 
-# Connect to Solana devnet (for mock balance)
-client = Client("https://api.devnet.solana.com")
-
-# Add new columns to customers table if not exist
-try:
-    c.execute("ALTER TABLE customers ADD COLUMN street TEXT")
-    conn.commit()
-except:
-    pass
-try:
-    c.execute("ALTER TABLE customers ADD COLUMN city TEXT")
-    conn.commit()
-except:
-    pass
-try:
-    c.execute("ALTER TABLE customers ADD COLUMN state TEXT")
-    conn.commit()
-except:
-    pass
-try:
-    c.execute("ALTER TABLE customers ADD COLUMN zip_code TEXT")
-    conn.commit()
-except:
-    pass
-try:
-    c.execute("ALTER TABLE customers ADD COLUMN custom_field TEXT")
-    conn.commit()
-except:
-    pass
-
 # Fetch customers
-customers_df = pd.read_sql_query("SELECT id, name, email, address, street, city, state, zip_code, custom_field, country, created_at FROM customers WHERE org_id = ?", conn, params=(1,))
+customers_df = load_customers_with_subscription(1)
 if not customers_df.empty:
-    customers_df['sub_status'] = [c.execute("SELECT status FROM subscriptions WHERE customer_id = ? LIMIT 1", (row['id'],)).fetchone()[0] if c.execute("SELECT status FROM subscriptions WHERE customer_id = ? LIMIT 1", (row['id'],)).fetchone() else "None" for index, row in customers_df.iterrows()]
     customers_df['solana_balance'] = customers_df['address'].apply(lambda x: round(np.random.uniform(0, 100), 2) if x else 0.0)
 
 # Layout
@@ -116,11 +80,9 @@ def update_customer_grid(search, status, city, state, reset):
         return [dbc.Col(create_customer_card(row), width=4) for index, row in customers_df.iterrows()]
     filtered_df = customers_df.copy()
     if search:
-        filtered_df = filtered_df[
-            filtered_df['name'].str.contains(search, case=False) |
-            filtered_df['email'].str.contains(search, case=False) |
-            filtered_df['address'].str.contains(search, case=False)
-        ]
+        # Ranked FTS5 matches, best first
+        rank = {customer_id: i for i, customer_id in enumerate(search_customers(1, search))}
+        filtered_df = filtered_df[filtered_df['id'].isin(rank)].sort_values('id', key=lambda ids: ids.map(rank))
     if status != "All":
         filtered_df = filtered_df[filtered_df['sub_status'] == status]
     if city != "All":
@@ -170,7 +132,7 @@ def open_edit_modal(n_clicks, ids):
         return False, "", "", "", "", "", "", "", "", ""
     button_id = ctx.triggered[0]['prop_id'].split('.')[0]
     index = json.loads(button_id.replace("'", '"'))['index']
-    customer = c.execute("SELECT name, email, address, street, city, state, zip_code, custom_field, country FROM customers WHERE id = ?", (index,)).fetchone()
+    customer = db.query_one("SELECT name, email, address, street, city, state, zip_code, custom_field, country FROM customers WHERE id = ?", (index,))
     return True, customer[0], customer[1], customer[2], customer[3], customer[4], customer[5], customer[6], customer[7], customer[8]
 
 @app.callback(
@@ -195,9 +157,8 @@ def save_or_cancel_edit(save_clicks, cancel_clicks, name, email, address, street
     button_id = ctx.triggered[0]['prop_id'].split('.')[0]
     index = json.loads(id.replace("'", '"'))['index']
     if "save-edit" in button_id and save_clicks:
-        c.execute("UPDATE customers SET name = ?, email = ?, address = ?, street = ?, city = ?, state = ?, zip_code = ?, custom_field = ?, country = ? WHERE id = ?",
-                  (name, email, address, street, city, state, zip_code, custom_field, country, index))
-        conn.commit()
+        db.execute("UPDATE customers SET name = ?, email = ?, address = ?, street = ?, city = ?, state = ?, zip_code = ?, custom_field = ?, country = ? WHERE id = ?",
+                   (name, email, address, street, city, state, zip_code, custom_field, country, index))
         log_audit(1, "edited_customer", f"ID: {index}")  # Hardcoded user_id for now
         return False, 0
     elif "cancel-edit" in button_id and cancel_clicks:
@@ -217,19 +178,18 @@ def handle_actions(invoice_clicks, verify_clicks, invoice_ids, verify_ids):
     prop_id = ctx.triggered[0]['prop_id'].split('.')[0]
     if "invoice-button" in prop_id:
         index = json.loads(invoice_ids[[i for i, x in enumerate(invoice_clicks) if x][0]].replace("'", '"'))['index']
-        subs = c.execute("SELECT id, amount FROM subscriptions WHERE customer_id = ?", (index,)).fetchone()
+        subs = db.query_one("SELECT id, amount FROM subscriptions WHERE customer_id = ?", (index,))
         if subs:
             sub_id, amount = subs
             due_date = (datetime.now() + timedelta(days=30)).isoformat()
-            c.execute("INSERT INTO invoices (sub_id, date, amount, status, due_date) VALUES (?, ?, ?, ?, ?)",
-                      (sub_id, datetime.now().isoformat(), amount, "open", due_date))
-            conn.commit()
+            db.execute("INSERT INTO invoices (sub_id, date, amount, status, due_date) VALUES (?, ?, ?, ?, ?)",
+                       (sub_id, datetime.now().isoformat(), amount, "open", due_date))
             log_audit(1, "created_invoice", f"Customer ID: {index}, Amount: {amount}")
             return html.Div(f"Invoice created for ${amount} USDC, due on {due_date}", className="alert alert-success")
         return html.Div("No subscription found for this customer.", className="alert alert-danger")
     elif "verify-button" in prop_id:
         index = json.loads(verify_ids[[i for i, x in enumerate(verify_clicks) if x][0]].replace("'", '"'))['index']
-        customer = c.execute("SELECT name FROM customers WHERE id = ?", (index,)).fetchone()
+        customer = db.query_one("SELECT name FROM customers WHERE id = ?", (index,))
         return html.Div(f"Mock verification for {customer[0]}: Data hashed on Solana (ID: {index})", className="alert alert-info")
     return ""
 
@@ -0,0 +1,189 @@
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+import pandas as pd
+import migrations
+
+# Shared SQLite data-access layer for every page.
+# Reads go through one connection per thread so Streamlit/Dash sessions can read in
+# parallel under WAL; all writes go through a single writer connection behind a lock.
+# Pending schema migrations are applied once, when the writer connection is opened.
+
+DB_PATH = os.environ.get('STUNR_DB', 'stunr_db.sqlite')
+
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KB = 64 * 1024          # negative cache_size = KiB, so ~64MB per connection
+MMAP_SIZE = 256 * 1024 * 1024
+STATEMENT_CACHE = 256              # prepared statements kept per connection
+
+_local = threading.local()
+_write_lock = threading.RLock()
+_write_conn = None
+_all_conns = []
+_conns_lock = threading.Lock()
+_pending_writes = set()  # tables written by the open transaction
+_commit_listeners = []
+
+# Target table of an INSERT/REPLACE/UPDATE/DELETE statement
+WRITE_TARGET = re.compile(r"^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+[\"`\[]?(\w+)", re.IGNORECASE | re.MULTILINE)
+
+
+# Cursor handed out by transaction(); remembers which tables the transaction writes to
+class _TrackingCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        _pending_writes.update(t.lower() for t in WRITE_TARGET.findall(sql))
+        return super().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        _pending_writes.update(t.lower() for t in WRITE_TARGET.findall(sql))
+        return super().executemany(sql, seq_of_params)
+
+
+def _apply_pragmas(conn, read_only=False):
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA foreign_keys = ON")
+    if read_only:
+        conn.execute("PRAGMA query_only = ON")
+
+
+def _connect(read_only=False):
+    # isolation_level=None: we issue BEGIN/COMMIT ourselves so a batch is one transaction
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None,
+                           check_same_thread=False, cached_statements=STATEMENT_CACHE)
+    _apply_pragmas(conn, read_only=read_only)
+    with _conns_lock:
+        _all_conns.append(conn)
+    return conn
+
+
+# Per-thread read connection
+def get_read_conn():
+    conn = getattr(_local, 'read_conn', None)
+    if conn is None:
+        get_write_conn()  # makes sure migrations ran before the first read
+        conn = _connect(read_only=True)
+        _local.read_conn = conn
+    return conn
+
+
+# Process-wide writer connection (only ever used while holding _write_lock)
+def get_write_conn():
+    global _write_conn
+    with _write_lock:
+        if _write_conn is None:
+            conn = _connect()
+            migrations.migrate(conn)
+            _write_conn = conn
+        return _write_conn
+
+
+# Run a block of writes as one IMMEDIATE transaction on the writer connection.
+# durable=True commits with synchronous=FULL so the data is fsynced before returning.
+@contextmanager
+def transaction(durable=False):
+    with _write_lock:
+        conn = get_write_conn()
+        if conn.in_transaction:
+            # Nested use joins the outer transaction
+            yield conn.cursor(_TrackingCursor)
+            return
+        if durable:
+            conn.execute("PRAGMA synchronous = FULL")
+        _pending_writes.clear()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn.cursor(_TrackingCursor)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            written = set(_pending_writes)
+        finally:
+            _pending_writes.clear()
+            if durable:
+                conn.execute("PRAGMA synchronous = NORMAL")
+        if written:
+            for listener in _commit_listeners:
+                listener(written)
+
+
+# Register fn(tables) to be called after every commit with the set of tables it wrote
+def on_commit(fn):
+    _commit_listeners.append(fn)
+
+
+# PRAGMA data_version of the writer connection, which changes whenever another process
+# commits. None while another thread holds the writer, since the value could be mid-change.
+def data_version():
+    if not _write_lock.acquire(blocking=False):
+        return None
+    try:
+        return get_write_conn().execute("PRAGMA data_version").fetchone()[0]
+    finally:
+        _write_lock.release()
+
+
+# Single write statement; returns the cursor so callers can read lastrowid/rowcount
+def execute(sql, params=()):
+    with transaction() as cur:
+        cur.execute(sql, params)
+        return cur
+
+
+def executemany(sql, seq_of_params):
+    with transaction() as cur:
+        cur.executemany(sql, seq_of_params)
+        return cur
+
+
+def query(sql, params=()):
+    return get_read_conn().execute(sql, params).fetchall()
+
+
+def query_one(sql, params=()):
+    return get_read_conn().execute(sql, params).fetchone()
+
+
+def read_sql(sql, params=()):
+    return pd.read_sql_query(sql, get_read_conn(), params=params)
+
+
+def close_all():
+    global _write_conn
+    with _conns_lock:
+        for conn in _all_conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _all_conns.clear()
+    _write_conn = None
+    _local.__dict__.clear()
+
+
+# Fetch or initialize invoice settings
+def get_invoice_settings():
+    settings = query_one("SELECT * FROM invoice_settings")
+    if not settings:
+        execute("INSERT INTO invoice_settings (company_name, company_address, logo_url, footer_text, primary_color, font) VALUES (?, ?, ?, ?, ?, ?)",
+                ("STUNR.ai", "Mock Merchant Address", "", "Thank you for your business! Contact: support@stunr.ai", '#6772e5', 'Helvetica'))
+        settings = query_one("SELECT * FROM invoice_settings")
+    return settings
+
+
+# Fetch or initialize payment settings
+def get_payment_settings():
+    payment_settings = query_one("SELECT * FROM payment_settings")
+    if not payment_settings:
+        execute("INSERT INTO payment_settings (stripe_publishable_key, stripe_secret_key) VALUES (?, ?)",
+                ("pk_test_...", "sk_test_..."))  # Replace with real test keys
+        payment_settings = query_one("SELECT * FROM payment_settings")
+    return payment_settings
@@ -0,0 +1,141 @@
+import argparse
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+import db
+import scheduler
+
+# Dunning engine.
+# Runs off the request path: a daemon thread (start_scheduler, started by app.py) or cron
+# (python dunning.py) calls run_once every RUN_INTERVAL seconds. Each run reads open invoices
+# past their due date through idx_invoices_status_due and sends the next step of the retry
+# ladder to every invoice whose step is due: attempt n goes out LADDER[n - 1] days after the
+# due date, and an invoice that is further behind gets the latest step that is due.
+# Reminders are queued in email_outbox and logged in dunning_logs, BATCH_SIZE invoices per
+# transaction. Once the ladder is exhausted the subscription is marked 'unpaid'.
+# Only subscriptions with auto_dunning = 1 are dunned; a scheduler claim keeps several app
+# processes from running the same pass twice.
+
+LADDER = [int(days) for days in os.environ.get('STUNR_DUNNING_LADDER', '1,3,7,14').split(',')]
+RUN_INTERVAL = int(os.environ.get('STUNR_DUNNING_INTERVAL', 3600))  # seconds
+BATCH_SIZE = 1000
+JOB_NAME = 'dunning'
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def create_tables(cur):
+    cur.execute("""CREATE TABLE IF NOT EXISTS email_outbox
+                   (id INTEGER PRIMARY KEY, org_id INTEGER, to_email TEXT, subject TEXT, body TEXT, created_at TEXT, sent_at TEXT, status TEXT DEFAULT 'queued')""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_email_outbox_status ON email_outbox (status, id)")
+
+
+# Open invoices of auto-dunned subscriptions that are past due, with the last attempt sent
+def _overdue_invoices(now, org_id=None):
+    sql = """SELECT i.id, i.org_id, i.amount, i.due_date, c.email,
+                    (SELECT MAX(d.attempt) FROM dunning_logs d WHERE d.invoice_id = i.id) AS last_attempt
+             FROM invoices i JOIN subscriptions s ON s.id = i.sub_id JOIN customers c ON c.id = s.customer_id
+             WHERE i.status = 'open' AND i.due_date < ? AND COALESCE(s.auto_dunning, 1) = 1"""
+    params = [(now - timedelta(days=LADDER[0])).isoformat()]
+    if org_id is not None:
+        sql += " AND i.org_id = ?"
+        params.append(org_id)
+    cur = db.get_read_conn().cursor()
+    try:
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cur.close()
+
+
+# (invoice_id, org_id, attempt, email, amount, due_date) for the invoices whose next step is due
+def _due_steps(rows, now):
+    steps = []
+    for invoice_id, org_id, amount, due_date, email, last_attempt in rows:
+        try:
+            due = datetime.fromisoformat(due_date)
+        except (TypeError, ValueError):
+            continue
+        # Latest step that is due; steps missed while the engine was not running are skipped
+        attempt = sum(1 for days in LADDER if now >= due + timedelta(days=days))
+        if attempt > (last_attempt or 0):
+            steps.append((invoice_id, org_id, attempt, email, amount, due_date))
+    return steps
+
+
+def _reminder(attempt, invoice_id, amount, due_date):
+    if attempt == len(LADDER):
+        return "Final Notice: Payment Overdue", f"Invoice {invoice_id} is still unpaid. Amount: ${amount} USDC, Due: {due_date}. Your subscription has been marked unpaid."
+    return "Payment Reminder", f"Invoice {invoice_id} is overdue. Amount: ${amount} USDC, Due: {due_date}"
+
+
+def _apply(steps, now):
+    stamp = now.isoformat()
+    sent = 0
+    with db.transaction() as cur:
+        for invoice_id, org_id, attempt, email, amount, due_date in steps:
+            # Skip steps another run (or a manual attempt) already logged
+            cur.execute("""INSERT INTO dunning_logs (invoice_id, attempt, date, status) SELECT ?, ?, ?, 'sent'
+                           WHERE NOT EXISTS (SELECT 1 FROM dunning_logs WHERE invoice_id = ? AND attempt >= ?)""",
+                        (invoice_id, attempt, stamp, invoice_id, attempt))
+            if cur.rowcount == 0:
+                continue
+            sent += 1
+            if email:
+                subject, body = _reminder(attempt, invoice_id, amount, due_date)
+                cur.execute("INSERT INTO email_outbox (org_id, to_email, subject, body, created_at) VALUES (?, ?, ?, ?, ?)",
+                            (org_id, email, subject, body, stamp))
+            if attempt == len(LADDER):
+                cur.execute("UPDATE subscriptions SET status = 'unpaid' WHERE id = (SELECT sub_id FROM invoices WHERE id = ?) AND status != 'canceled'", (invoice_id,))
+    return sent
+
+
+# One dunning pass; returns the number of reminders sent
+def run_once(org_id=None, now=None):
+    now = now or datetime.now()
+    sent = 0
+    for rows in _overdue_invoices(now, org_id):
+        steps = _due_steps(rows, now)
+        if steps:
+            sent += _apply(steps, now)
+    return sent
+
+
+def _scheduler_loop():
+    while True:
+        try:
+            if scheduler.claim(JOB_NAME, RUN_INTERVAL):
+                sent = run_once()
+                if sent:
+                    print(f"Dunning: {sent} reminders sent")
+        except Exception as e:
+            print(f"Dunning run failed, will retry: {e}")
+        time.sleep(RUN_INTERVAL)
+
+
+# Start the background scheduler once per process
+def start_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = threading.Thread(target=_scheduler_loop, name="dunning-scheduler", daemon=True)
+                _scheduler.start()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Send due dunning reminders (run from cron, or --loop).")
+    parser.add_argument('--org-id', type=int, default=None, help="Only dun this org's invoices (default: all)")
+    parser.add_argument('--loop', action='store_true', help=f"Keep running every {RUN_INTERVAL}s")
+    args = parser.parse_args()
+    if args.loop:
+        start_scheduler()
+        _scheduler.join()
+    else:
+        print(f"{run_once(args.org_id)} dunning reminders sent")
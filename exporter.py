@@ -0,0 +1,172 @@
+import csv
+import gzip
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+import xlsxwriter
+import db
+import tables
+
+# Streaming list exports.
+# An export is only built when someone asks for it: the query runs on a cursor and rows are
+# written CHUNK_ROWS at a time straight to a file under EXPORT_DIR (plain CSV, gzip CSV or an
+# xlsxwriter workbook in constant-memory mode), so memory stays flat however many rows match.
+# Exports of more than BACKGROUND_ROWS rows run on a worker thread and the page offers the
+# download once the file is complete. A finished file is only read into the download button
+# on an explicit "Prepare Download" click, not on every rerun of the page. Finished files are
+# removed after EXPORT_TTL seconds.
+
+EXPORT_DIR = os.environ.get('STUNR_EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'stunr_exports'))
+CHUNK_ROWS = 5000
+BACKGROUND_ROWS = 50000
+EXPORT_TTL = 3600  # seconds
+EXCEL_MAX_ROWS = 1048575  # per sheet, below the header row
+MAX_WORKERS = 2
+
+# Format -> (file extension, mime type)
+FORMATS = {
+    'CSV': ('.csv', 'text/csv'),
+    'CSV (gzip)': ('.csv.gz', 'application/gzip'),
+    'Excel': ('.xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="export")
+
+
+# Yield the column names, then lists of up to chunk_rows rows
+def _stream(sql, params, chunk_rows=CHUNK_ROWS):
+    cur = db.get_read_conn().cursor()
+    try:
+        cur.execute(sql, params)
+        yield [d[0] for d in cur.description]
+        while True:
+            rows = cur.fetchmany(chunk_rows)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cur.close()
+
+
+def _write_csv(path, stream, compress, progress):
+    opener = gzip.open if compress else open
+    with opener(path, 'wt', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(next(stream))
+        for rows in stream:
+            writer.writerows(rows)
+            progress(len(rows))
+
+
+def _write_excel(path, stream, progress):
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    try:
+        header = next(stream)
+        sheet, row_number = None, EXCEL_MAX_ROWS
+        for rows in stream:
+            for row in rows:
+                if row_number == EXCEL_MAX_ROWS:
+                    sheet = workbook.add_worksheet()
+                    sheet.write_row(0, 0, header)
+                    row_number = 0
+                row_number += 1
+                sheet.write_row(row_number, 0, row)
+            progress(len(rows))
+        if sheet is None:
+            workbook.add_worksheet().write_row(0, 0, header)
+    finally:
+        workbook.close()
+
+
+def _update(job_id, **fields):
+    with _jobs_lock:
+        _jobs[job_id].update(fields)
+
+
+def _run(job_id, sql, params):
+    job = _jobs[job_id]
+    written = [0]
+    def progress(n):
+        written[0] += n
+        _update(job_id, rows=written[0])
+    tmp_path = job['path'] + '.part'
+    try:
+        stream = _stream(sql, params)
+        if job['format'] == 'Excel':
+            _write_excel(tmp_path, stream, progress)
+        else:
+            _write_csv(tmp_path, stream, job['format'] == 'CSV (gzip)', progress)
+        os.replace(tmp_path, job['path'])
+        _update(job_id, status='done', finished_at=time.time())
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        _update(job_id, status='failed', error=str(e), finished_at=time.time())
+
+
+# Delete finished exports older than EXPORT_TTL
+def cleanup(now=None):
+    now = now or time.time()
+    with _jobs_lock:
+        expired = [job_id for job_id, job in _jobs.items() if job.get('finished_at') and now - job['finished_at'] > EXPORT_TTL]
+        for job_id in expired:
+            job = _jobs.pop(job_id)
+            if os.path.exists(job['path']):
+                os.remove(job['path'])
+    return len(expired)
+
+
+# Start exporting the rows of a list table (same arguments as tables.paginated_table).
+# Runs in the calling thread unless more than BACKGROUND_ROWS rows match. Returns the job id.
+def start_export(name, fmt, select, from_where, params=(), search="", search_columns=(), filters=(), id_column='id'):
+    cleanup()
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    where, where_params = tables.build_where(from_where, params, search, search_columns, filters)
+    sql = f"SELECT {select} {where} ORDER BY {id_column} DESC"
+    background = tables.capped_count(where, where_params, cap=BACKGROUND_ROWS) > BACKGROUND_ROWS
+    job_id = uuid.uuid4().hex
+    extension, mime = FORMATS[fmt]
+    with _jobs_lock:
+        _jobs[job_id] = {'name': name, 'format': fmt, 'path': os.path.join(EXPORT_DIR, f"{name}_{job_id}{extension}"),
+                         'file_name': f"{name}{extension}", 'mime': mime, 'status': 'running', 'rows': 0,
+                         'error': None, 'started_at': time.time(), 'finished_at': None}
+    if background:
+        _executor.submit(_run, job_id, sql, where_params)
+    else:
+        _run(job_id, sql, where_params)
+    return job_id
+
+
+def job_status(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
+
+
+# Export format picker, "Prepare Export" button and, once the file is ready, its "Prepare Download" and download buttons
+def export_controls(key, name, select, from_where, params=(), search="", search_columns=(), filters=(), id_column='id'):
+    state_key = f"{key}_export_job"
+    col1, col2 = st.columns([1, 3])
+    with col1:
+        fmt = st.selectbox("Export Format", list(FORMATS), key=f"{key}_export_format")
+    with col2:
+        if st.button("Prepare Export", key=f"{key}_export"):
+            st.session_state[state_key] = start_export(name, fmt, select, from_where, params, search, search_columns, filters, id_column)
+
+    job = job_status(st.session_state[state_key]) if st.session_state.get(state_key) else None
+    if job is None:
+        return
+    if job['status'] == 'running':
+        st.info(f"Export running in the background: {job['rows']:,} rows written so far.")
+        st.button("Check Export Status", key=f"{key}_export_status")
+    elif job['status'] == 'failed':
+        st.error(f"Export failed: {job['error']}")
+    elif st.button(f"Prepare Download of {job['file_name']} ({job['rows']:,} rows)", key=f"{key}_export_prepare_download"):
+        with open(job['path'], 'rb') as f:
+            st.download_button(f"Download {job['file_name']}", f, job['file_name'], job['mime'], key=f"{key}_export_download")
@@ -0,0 +1,197 @@
+import argparse
+import os
+import threading
+import time
+from datetime import datetime
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import IsolationForest
+import cache
+import db
+import scheduler
+
+# Payout fraud scoring.
+# An IsolationForest is trained on past payouts (single payouts, batch payout items and
+# older batches without items), at most MAX_TRAINING_ROWS of the most recent ones. Each
+# payout is described by:
+#   log amount, amount z-score against the destination's history (all payouts when the
+#   destination has fewer than MIN_DESTINATION_HISTORY), log recipient age in days and
+#   payouts per 30 days.
+# Only the background thread (or "python fraud.py") trains: it retrains every RETRAIN_INTERVAL
+# seconds (again after RETRY_INTERVAL when training fails or there are too few payouts) and
+# saves the model to MODEL_PATH, which pages load once per process (again only when the file
+# changes). A payout is flagged when it scores below the
+# FLAG_QUANTILE of the training payouts' scores, so about one normal payout in a thousand is
+# flagged, or when its amount or z-score lies outside the training range.
+# Training rows are described as of their own date (history before them only); new payouts
+# against destination statistics kept in a cached frame that is dropped whenever a payout is
+# written, so a batch of any size is scored with one vectorized call. Until there are
+# MIN_TRAINING_ROWS payouts there is no model and nothing is flagged; the payout count is
+# cached the same way, so retries don't query again until new payouts arrive.
+
+MODEL_PATH = os.environ.get('STUNR_FRAUD_MODEL', os.path.splitext(db.DB_PATH)[0] + '_payout_fraud.joblib')
+RETRAIN_INTERVAL = int(os.environ.get('STUNR_FRAUD_RETRAIN_INTERVAL', 86400))  # seconds
+RETRY_INTERVAL = 600  # seconds
+MAX_TRAINING_ROWS = 200000
+MIN_TRAINING_ROWS = 50
+FLAG_QUANTILE = 0.001
+MIN_DESTINATION_HISTORY = 5  # payouts before a destination's own amounts are the baseline
+MIN_STD_FRACTION = 0.05
+N_ESTIMATORS = 100
+JOB_NAME = 'fraud_retrain'
+
+HISTORY_SQL = """SELECT date, amount, destination FROM payouts WHERE amount IS NOT NULL
+                 UNION ALL SELECT b.date, i.amount, i.destination FROM payout_items i JOIN payout_batches b ON b.id = i.batch_id WHERE i.amount IS NOT NULL
+                 UNION ALL SELECT b.date, b.total_amount, NULL FROM payout_batches b
+                           WHERE b.total_amount IS NOT NULL AND NOT EXISTS (SELECT 1 FROM payout_items i WHERE i.batch_id = b.id)"""
+
+_bundle = None   # {'model', 'amount_mean', 'amount_std', 'trained_at', 'rows', 'bounds', 'threshold'}
+_bundle_mtime = None
+_lock = threading.Lock()
+_retrainer = None
+
+
+def _history():
+    return db.read_sql(f"SELECT * FROM ({HISTORY_SQL}) ORDER BY date DESC LIMIT ?", params=(MAX_TRAINING_ROWS,))
+
+
+# Per-destination payout count, mean and mean square of amounts, and first payout date
+def destination_stats():
+    return cache.memoize(('fraud_destination_stats',), ['payouts', 'payout_items', 'payout_batches'], lambda: db.read_sql(
+        f"""SELECT destination, COUNT(*) AS n, AVG(amount) AS mean, AVG(amount * amount) AS mean_sq, MIN(date) AS first_date
+            FROM ({HISTORY_SQL}) WHERE destination IS NOT NULL GROUP BY destination"""))
+
+
+def _features(amounts, dates, n, mean, mean_sq, first, amount_mean, amount_std):
+    # A floor keeps a few near-identical payouts from making every later amount look extreme
+    std = np.maximum(np.sqrt(np.clip(mean_sq - mean ** 2, 0, None)), MIN_STD_FRACTION * np.abs(mean))
+    own = (n >= MIN_DESTINATION_HISTORY) & (std > 0)
+    z = np.where(own, (amounts - np.where(own, mean, 0)) / np.where(own, std, 1), (amounts - amount_mean) / (amount_std or 1))
+    age = np.nan_to_num((dates - first) / np.timedelta64(1, 'D'), nan=0.0).clip(0)
+    frequency = n / np.maximum(age, 30) * 30
+    return np.column_stack([np.log1p(np.clip(amounts, 0, None)), z, np.log1p(age), frequency])
+
+
+# Features of new payouts, against each destination's full history
+def features(destinations, amounts, dates, stats, amount_mean, amount_std):
+    by_destination = stats.set_index('destination')
+    destinations = pd.Series(destinations).astype(str)
+    def column(name):
+        return destinations.map(by_destination[name])
+    return _features(np.asarray(amounts, dtype=float), pd.to_datetime(pd.Series(dates), errors='coerce', format='ISO8601').to_numpy(),
+                     column('n').fillna(0).to_numpy(dtype=float), column('mean').to_numpy(dtype=float), column('mean_sq').to_numpy(dtype=float),
+                     pd.to_datetime(column('first_date'), errors='coerce', format='ISO8601').to_numpy(), amount_mean, amount_std)
+
+
+# Features of past payouts, each against its destination's history before it
+def _history_features(history, amount_mean, amount_std):
+    history = history.assign(date=pd.to_datetime(history['date'], errors='coerce', format='ISO8601')).sort_values('date', kind='stable')
+    amounts = history['amount'].astype(float)
+    known = history['destination'].notna().to_numpy()
+    by_destination = history.groupby(history['destination'].fillna(''), sort=False)
+    n = np.where(known, by_destination.cumcount().to_numpy(dtype=float), 0)
+    prior_sum = (by_destination['amount'].cumsum() - amounts).to_numpy(dtype=float)
+    prior_sq = ((amounts ** 2).groupby(history['destination'].fillna(''), sort=False).cumsum() - amounts ** 2).to_numpy(dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean, mean_sq = prior_sum / n, prior_sq / n
+    first = by_destination['date'].transform('min').to_numpy()
+    first = np.where(known, first, np.datetime64('NaT'))
+    return _features(amounts.to_numpy(), history['date'].to_numpy(), n, mean, mean_sq, first, amount_mean, amount_std)
+
+
+# Payouts there are to train on
+def _history_size():
+    return int(cache.memoize(('fraud_history_size',), ['payouts', 'payout_items', 'payout_batches'], lambda: db.read_sql(
+        f"SELECT COUNT(*) AS n FROM ({HISTORY_SQL})"))['n'].iloc[0])
+
+
+def train():
+    if _history_size() < MIN_TRAINING_ROWS:
+        return None
+    history = _history()
+    amount_mean, amount_std = float(history['amount'].mean()), float(history['amount'].std() or 1.0)
+    X = _history_features(history, amount_mean, amount_std)
+    model = IsolationForest(n_estimators=N_ESTIMATORS, random_state=0, n_jobs=-1).fit(X)
+    bundle = {'model': model, 'amount_mean': amount_mean, 'amount_std': amount_std, 'trained_at': datetime.now().isoformat(), 'rows': len(history),
+              'bounds': (X[:, :2].min(axis=0), X[:, :2].max(axis=0)), 'threshold': float(np.quantile(model.score_samples(X), FLAG_QUANTILE))}
+    os.makedirs(os.path.dirname(os.path.abspath(MODEL_PATH)), exist_ok=True)
+    joblib.dump(bundle, MODEL_PATH + '.tmp')
+    os.replace(MODEL_PATH + '.tmp', MODEL_PATH)
+    return bundle
+
+
+# The current model bundle: loaded once, reloaded when the retrainer saves a new one; None until it has
+def model():
+    global _bundle, _bundle_mtime
+    try:
+        mtime = os.path.getmtime(MODEL_PATH)
+    except OSError:
+        return None
+    if _bundle is not None and mtime == _bundle_mtime:
+        return _bundle
+    with _lock:
+        if _bundle is None or mtime != _bundle_mtime:
+            _bundle, _bundle_mtime = joblib.load(MODEL_PATH), mtime
+    return _bundle
+
+
+# Anomaly flags (and scores, lower is more anomalous, below 0 flagged) for payouts of amounts to destinations
+def score(destinations, amounts, now=None):
+    bundle = model()
+    if bundle is None:
+        return np.zeros(len(amounts), dtype=bool), np.zeros(len(amounts))
+    now = now or datetime.now()
+    X = features(destinations, amounts, [now.isoformat()] * len(amounts), destination_stats(), bundle['amount_mean'], bundle['amount_std'])
+    scores = bundle['model'].score_samples(X) - bundle.get('threshold', bundle['model'].offset_)
+    # Trees can't tell values past the training range from the most extreme ones seen, so an
+    # amount or z-score outside it is flagged whatever the score
+    low, high = bundle['bounds']
+    unseen = ((X[:, :2] < low) | (X[:, :2] > high)).any(axis=1)
+    return (scores < 0) | unseen, scores
+
+
+def flag(destinations, amounts):
+    return score(destinations, amounts)[0]
+
+
+def _retrain_loop():
+    while True:
+        delay = RETRAIN_INTERVAL
+        try:
+            if scheduler.claim(JOB_NAME, RETRAIN_INTERVAL):
+                try:
+                    bundle = train()
+                except Exception:
+                    scheduler.release(JOB_NAME)
+                    raise
+                if bundle:
+                    print(f"Fraud model retrained on {bundle['rows']} payouts")
+                else:
+                    # Too few payouts yet: look again soon, without waiting out RETRAIN_INTERVAL
+                    scheduler.release(JOB_NAME)
+                    delay = RETRY_INTERVAL
+        except Exception as e:
+            print(f"Fraud model retraining failed, will retry in {RETRY_INTERVAL}s: {e}")
+            delay = RETRY_INTERVAL
+        time.sleep(delay)
+
+
+# Start the background retrainer once per process
+def start_retrainer():
+    global _retrainer
+    if _retrainer is None:
+        with _lock:
+            if _retrainer is None:
+                _retrainer = threading.Thread(target=_retrain_loop, name="fraud-retrainer", daemon=True)
+                _retrainer.start()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train the payout fraud model.")
+    parser.parse_args()
+    bundle = train()
+    if bundle is None:
+        print(f"Not enough payouts to train on (need {MIN_TRAINING_ROWS})")
+    else:
+        print(f"Trained on {bundle['rows']} payouts, saved to {MODEL_PATH}")
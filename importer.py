@@ -0,0 +1,185 @@
+import argparse
+import re
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import audit
+import db
+
+# Streaming bulk import for "Migrate Existing Customers".
+# The CSV is read in chunks, validated column-wise, deduplicated on email and wallet
+# address, and every chunk is written with executemany in a single transaction
+# (customers, their subscriptions and opening-balance invoices together).
+
+REQUIRED_COLUMNS = ['name', 'email', 'address', 'country']
+TEXT_COLUMNS = ['street', 'city', 'state', 'zip_code', 'custom_field', 'subscription_plan', 'subscription_start_date', 'wallet_address']
+CHUNK_SIZE = 20000
+HELPER_COLUMNS = ['email_key', 'opening', 'bill_day', 'plan_amount', 'start']
+INVOICE_DUE_DAYS = 30
+
+
+@dataclass
+class ImportResult:
+    rows: int = 0
+    imported: int = 0
+    subscriptions: int = 0
+    invoices: int = 0
+    rejected: list = field(default_factory=list)
+
+    @property
+    def rejected_count(self):
+        return sum(len(df) for df in self.rejected)
+
+    def rejected_df(self):
+        if not self.rejected:
+            return pd.DataFrame(columns=REQUIRED_COLUMNS + ['reason'])
+        return pd.concat(self.rejected, ignore_index=True)
+
+
+# Plan name -> monthly price: active products first, then a "$10/month" style price in the name
+def _plan_prices():
+    return {name.strip().lower(): price for name, price in db.query("SELECT name, price FROM products WHERE active = 1")}
+
+
+def _plan_amounts(plans, prices):
+    amounts = plans.str.strip().str.lower().map(prices)
+    parsed = pd.to_numeric(plans.str.extract(r"\$\s*(\d+(?:\.\d+)?)", flags=re.IGNORECASE)[0], errors='coerce')
+    return amounts.fillna(parsed)
+
+
+# Most recent date on or before today that falls on billing_day (clamped to short months)
+def _last_bill_dates(billing_days, today):
+    this_month = pd.Timestamp(today.year, today.month, 1)
+    prev_month = this_month - pd.offsets.MonthBegin(1)
+    days = billing_days.to_numpy(dtype=np.int64)
+    this_day = np.minimum(days, this_month.days_in_month)
+    prev_day = np.minimum(days, prev_month.days_in_month)
+    use_this = this_day <= today.day
+    this_dates = this_month + pd.to_timedelta(this_day - 1, unit='D')
+    prev_dates = prev_month + pd.to_timedelta(prev_day - 1, unit='D')
+    return pd.Series(np.where(use_this, this_dates, prev_dates), index=billing_days.index).dt.strftime('%Y-%m-%d')
+
+
+def _reject(result, chunk, mask, reason):
+    if mask.any():
+        rejected = chunk.loc[mask].drop(columns=[col for col in HELPER_COLUMNS if col in chunk.columns])
+        rejected['reason'] = reason
+        result.rejected.append(rejected)
+    return chunk.loc[~mask]
+
+
+def _import_chunk(chunk, org_id, prices, seen_emails, seen_addresses, result, now):
+    for col in TEXT_COLUMNS:
+        if col not in chunk.columns:
+            chunk[col] = ''
+    for col in REQUIRED_COLUMNS + TEXT_COLUMNS:
+        chunk[col] = chunk[col].fillna('').astype(str).str.strip()
+    # wallet_address, when given, is the customer's Solana address
+    chunk['address'] = chunk['wallet_address'].where(chunk['wallet_address'] != '', chunk['address'])
+    chunk['country'] = chunk['country'].str.upper()
+    chunk['email_key'] = chunk['email'].str.lower()
+
+    missing = np.zeros(len(chunk), dtype=bool)
+    for col in REQUIRED_COLUMNS:
+        missing |= (chunk[col] == '').to_numpy()
+    chunk = _reject(result, chunk, pd.Series(missing, index=chunk.index), "missing required field")
+    chunk = _reject(result, chunk, ~chunk['email'].str.contains('@', regex=False), "invalid email")
+
+    opening = pd.to_numeric(chunk.get('opening_balance', pd.Series(np.nan, index=chunk.index)), errors='coerce').fillna(0.0)
+    billing_day = pd.to_numeric(chunk.get('billing_day', pd.Series(np.nan, index=chunk.index)), errors='coerce')
+    amounts = _plan_amounts(chunk['subscription_plan'], prices)
+    start = pd.to_datetime(chunk['subscription_start_date'].replace('', None), errors='coerce')
+    chunk = chunk.assign(opening=opening, bill_day=billing_day, plan_amount=amounts, start=start)
+
+    chunk = _reject(result, chunk, (chunk['subscription_plan'] != '') & chunk['plan_amount'].isna(), "unknown subscription_plan")
+    chunk = _reject(result, chunk, chunk['bill_day'].notna() & ~chunk['bill_day'].between(1, 31), "billing_day must be 1-31")
+    chunk = _reject(result, chunk, (chunk['subscription_start_date'] != '') & chunk['start'].isna(), "invalid subscription_start_date")
+    chunk = _reject(result, chunk, (chunk['opening'] > 0) & (chunk['subscription_plan'] == ''), "opening_balance requires subscription_plan")
+
+    dup_email = chunk['email_key'].duplicated() | chunk['email_key'].isin(seen_emails)
+    chunk = _reject(result, chunk, dup_email, "duplicate email")
+    dup_address = chunk['address'].duplicated() | chunk['address'].isin(seen_addresses)
+    chunk = _reject(result, chunk, dup_address, "duplicate wallet address")
+    if chunk.empty:
+        return
+
+    created_at = now.isoformat()
+    with db.transaction() as cur:
+        # Explicit ids let subscriptions/invoices reference new customers without a lastrowid per row
+        next_customer = cur.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM customers").fetchone()[0]
+        customer_ids = np.arange(next_customer, next_customer + len(chunk))
+        cur.executemany("INSERT INTO customers (id, name, email, address, street, city, state, zip_code, custom_field, created_at, country, org_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        zip(customer_ids.tolist(), chunk['name'], chunk['email'], chunk['address'], chunk['street'], chunk['city'], chunk['state'],
+                            chunk['zip_code'], chunk['custom_field'], [created_at] * len(chunk), chunk['country'], [org_id] * len(chunk)))
+
+        subs = chunk.assign(customer_id=customer_ids)[chunk['subscription_plan'] != '']
+        if not subs.empty:
+            start_dates = subs['start'].fillna(pd.Timestamp(now.date())).dt.strftime('%Y-%m-%d')
+            last_bill = start_dates.copy()
+            with_day = subs['bill_day'].notna()
+            if with_day.any():
+                last_bill[with_day] = _last_bill_dates(subs.loc[with_day, 'bill_day'], now)
+            next_sub = cur.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM subscriptions").fetchone()[0]
+            sub_ids = np.arange(next_sub, next_sub + len(subs))
+            cur.executemany("INSERT INTO subscriptions (id, customer_id, plan, amount, start_date, last_bill_date, status, org_id) VALUES (?, ?, ?, ?, ?, ?, 'active', ?)",
+                            zip(sub_ids.tolist(), subs['customer_id'].tolist(), subs['subscription_plan'], subs['plan_amount'].astype(float).tolist(),
+                                start_dates, last_bill, [org_id] * len(subs)))
+            result.subscriptions += len(subs)
+
+            owing = subs.assign(sub_id=sub_ids)[subs['opening'] > 0]
+            if not owing.empty:
+                due_date = (now + timedelta(days=INVOICE_DUE_DAYS)).isoformat()
+                cur.executemany("INSERT INTO invoices (sub_id, date, amount, status, due_date, org_id) VALUES (?, ?, ?, 'open', ?, ?)",
+                                zip(owing['sub_id'].tolist(), [created_at] * len(owing), owing['opening'].astype(float).tolist(),
+                                    [due_date] * len(owing), [org_id] * len(owing)))
+                result.invoices += len(owing)
+
+    seen_emails.update(chunk['email_key'])
+    seen_addresses.update(chunk['address'])
+    result.imported += len(chunk)
+
+
+# Import a customer CSV (path or file-like) into org_id.
+# progress(result) is called after every chunk; returns an ImportResult.
+def import_customers(source, org_id, user_id=None, chunk_size=CHUNK_SIZE, progress=None):
+    result = ImportResult()
+    prices = _plan_prices()
+    seen_emails = set()
+    seen_addresses = set()
+    for email, address in db.query("SELECT lower(email), address FROM customers WHERE org_id = ?", (org_id,)):
+        if email:
+            seen_emails.add(email)
+        if address:
+            seen_addresses.add(address)
+
+    reader = pd.read_csv(source, dtype=str, keep_default_na=False, chunksize=chunk_size)
+    for chunk in reader:
+        missing = [col for col in REQUIRED_COLUMNS if col not in chunk.columns]
+        if missing:
+            raise ValueError(f"CSV must have columns: {', '.join(REQUIRED_COLUMNS)} (missing {', '.join(missing)})")
+        result.rows += len(chunk)
+        _import_chunk(chunk, org_id, prices, seen_emails, seen_addresses, result, datetime.now())
+        if progress:
+            progress(result)
+
+    audit.log_audit(user_id, "migrated_customers",
+                    f"Imported: {result.imported}, Subscriptions: {result.subscriptions}, Opening invoices: {result.invoices}, Rejected: {result.rejected_count}")
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bulk import customers from a previous billing provider's CSV export.")
+    parser.add_argument('csv', help="CSV with name,email,address,country and optional street,city,state,zip_code,opening_balance,billing_day,subscription_plan,subscription_start_date,wallet_address,custom_field")
+    parser.add_argument('--org-id', type=int, required=True)
+    parser.add_argument('--user-id', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--rejects', help="Write rejected rows with a reason column to this CSV")
+    args = parser.parse_args()
+
+    result = import_customers(args.csv, args.org_id, args.user_id, args.chunk_size,
+                              progress=lambda r: print(f"{r.rows} rows read, {r.imported} imported, {r.rejected_count} rejected"))
+    print(f"Done: {result.imported} customers, {result.subscriptions} subscriptions, {result.invoices} opening invoices, {result.rejected_count} rejected")
+    if args.rejects and result.rejected:
+        result.rejected_df().to_csv(args.rejects, index=False)
+        print(f"Rejected rows written to {args.rejects}")
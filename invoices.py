@@ -1,115 +1,100 @@
 import streamlit as st
 import pandas as pd
-import sqlite3
+import db
+import cache
+import tables
+import exporter
+import audit
 from datetime import datetime, timedelta
-import io
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.units import inch
+import os
+import tempfile
+import pdf_render
+import dunning
+import billing
 import stripe
 
-# Initialize database connection
-conn = sqlite3.connect('stunr_db.sqlite', check_same_thread=False)
-c = conn.cursor()
-
 # Mock email sender
 def mock_email(to_email, subject, body, attachment=None):
     st.info(f"Email sent to {to_email}: Subject - {subject}\nBody - {body}\nAttachment - {attachment if attachment else 'None'}")
 
 # Audit logging function
-def log_audit(user_id, action, details):
-    timestamp = datetime.now().isoformat()
-    c.execute("INSERT INTO audit_logs (user_id, action, details, timestamp) VALUES (?, ?, ?, ?)",
-              (user_id, action, details, timestamp))
-    conn.commit()
+def log_audit(user_id, action, details, sync=False):
+    timestamp = audit.log_audit(user_id, action, details, sync=sync)
     st.write(f"Audit Log: {action} - {details} at {timestamp}")  # Optional feedback
 
 # Fetch or initialize invoice settings
-settings = c.execute("SELECT * FROM invoice_settings").fetchone()
-if not settings:
-    c.execute("INSERT INTO invoice_settings (company_name, company_address, logo_url, footer_text, primary_color, font) VALUES (?, ?, ?, ?, ?, ?)",
-              ("STUNR.ai", "Mock Merchant Address", "", "Thank you for your business! Contact: support@stunr.ai", '#6772e5', 'Helvetica'))
-    conn.commit()
-    settings = c.execute("SELECT * FROM invoice_settings").fetchone()
+settings = db.get_invoice_settings()
 
 st.header("Invoices")
-invoice_tab1, invoice_tab2, invoice_tab3, invoice_tab4 = st.tabs(["Invoice List", "Generate PDF", "Dunning", "Credit Notes"])
+invoice_tab1, invoice_tab2, invoice_tab3, invoice_tab4, invoice_tab5 = st.tabs(["Invoice List", "Generate PDF", "Dunning", "Credit Notes", "Billing Run"])
 
 with invoice_tab1:
     st.subheader("Invoice List")
-    invoices_df = pd.read_sql_query("SELECT id AS ID, sub_id AS 'Subscription ID', date AS 'Issue Date', amount AS 'Amount (USDC)', status AS Status, due_date AS 'Due Date' FROM invoices WHERE sub_id IN (SELECT id FROM subscriptions WHERE customer_id IN (SELECT id FROM customers WHERE org_id = ?))", conn, params=(st.session_state['org_id'],))
+    invoice_columns = "id AS ID, sub_id AS 'Subscription ID', date AS 'Issue Date', amount AS 'Amount (USDC)', status AS Status, due_date AS 'Due Date'"
+    invoice_search = [('id', 'id'), ('sub_id', 'id'), ('status', 'keyword')]
+    search_query = st.text_input("Search Invoices (ID, Subscription ID, Status)", placeholder="Search by ID or status...")
+    status_filter = st.selectbox("Filter Status", ["All", "open", "paid"])
+    invoice_filters = [("status = ?", (status_filter,))] if status_filter != "All" else []
+    invoices_df = tables.paginated_table("invoices", invoice_columns, "FROM invoices WHERE org_id = ?", params=(st.session_state['org_id'],),
+                                         search=search_query, search_columns=invoice_search, filters=invoice_filters, org_id=st.session_state['org_id'])
     if not invoices_df.empty:
-        search_query = st.text_input("Search Invoices (ID, Subscription ID, Status)", placeholder="Search by ID or status...")
-        if search_query:
-            invoices_df = invoices_df[
-                invoices_df['ID'].astype(str).str.contains(search_query, case=False) |
-                invoices_df['Subscription ID'].astype(str).str.contains(search_query, case=False) |
-                invoices_df['Status'].str.contains(search_query, case=False)
-            ]
-        st.dataframe(invoices_df, use_container_width=True, hide_index=True)
-        csv = invoices_df.to_csv(index=False)
-        st.download_button("Export Invoices to CSV", csv, "invoices.csv", "text/csv")
-    else:
+        exporter.export_controls("invoices", "invoices", invoice_columns, "FROM invoices WHERE org_id = ?", params=(st.session_state['org_id'],),
+                                 search=search_query, search_columns=invoice_search, filters=invoice_filters)
+    elif not search_query and status_filter == "All":
         st.write("No invoices yet.")
 
 with invoice_tab2:
     st.subheader("Generate Invoice PDF")
-    invoices = c.execute("SELECT id, sub_id, date, amount, due_date FROM invoices WHERE sub_id IN (SELECT id FROM subscriptions WHERE customer_id IN (SELECT id FROM customers WHERE org_id = ?))", (st.session_state['org_id'],)).fetchall()
+    invoices = db.query("SELECT id, sub_id, date, amount, due_date FROM invoices WHERE org_id = ?", (st.session_state['org_id'],))
     if invoices:
         selected_invoice = st.selectbox("Select Invoice", [f"ID: {inv[0]} - {inv[2]} - ${inv[3]} USDC" for inv in invoices])
         invoice_id = int(selected_invoice.split("ID: ")[1].split(" - ")[0])
-        invoice_data = c.execute("SELECT i.id, i.sub_id, i.date, i.amount, i.due_date, s.customer_id, c.name, c.email, c.address FROM invoices i JOIN subscriptions s ON i.sub_id = s.id JOIN customers c ON s.customer_id = c.id WHERE i.id = ?", (invoice_id,)).fetchone()
-        if invoice_data:
-            invoice_id, sub_id, issue_date, amount, due_date, customer_id, customer_name, customer_email, customer_address = invoice_data
-            buffer = io.BytesIO()
-            can = canvas.Canvas(buffer, pagesize=letter)
-            can.setFont(settings[6], 16)
-            can.drawString(inch, 10 * inch, settings[1])  # Company Name
-            can.drawString(inch, 9.5 * inch, settings[2])  # Company Address
-            can.line(inch, 9 * inch, 6 * inch, 9 * inch)
-            can.drawString(inch, 8.5 * inch, f"Invoice #: {invoice_id}")
-            can.drawString(inch, 8 * inch, f"Date: {issue_date}")
-            can.drawString(inch, 7.5 * inch, f"Due Date: {due_date}")
-            can.drawString(4 * inch, 8.5 * inch, f"Bill To:")
-            can.drawString(4 * inch, 8 * inch, customer_name)
-            can.drawString(4 * inch, 7.5 * inch, customer_email)
-            can.drawString(4 * inch, 7 * inch, customer_address)
-            can.line(inch, 6.5 * inch, 6 * inch, 6.5 * inch)
-            can.drawString(inch, 6 * inch, "Description")
-            can.drawString(4 * inch, 6 * inch, "Amount")
-            can.line(inch, 5.5 * inch, 6 * inch, 5.5 * inch)
-            can.drawString(inch, 5 * inch, "Subscription Fee")
-            can.drawString(4 * inch, 5 * inch, f"${amount} USDC")
-            can.line(inch, 4.5 * inch, 6 * inch, 4.5 * inch)
-            can.drawString(4 * inch, 4 * inch, f"Total: ${amount} USDC")
-            can.setFont(settings[6], 10)
-            can.drawString(inch, 3 * inch, settings[4])  # Footer Text
-            can.showPage()
-            can.save()
-            buffer.seek(0)
-            st.download_button("Download PDF", buffer, f"invoice_{invoice_id}.pdf", "application/pdf")
-        else:
-            st.error("Invoice data not found.")
+        if st.button("Prepare PDF", key="prepare_invoice_pdf"):
+            pdf = pdf_render.render_invoice(invoice_id)
+            if pdf is not None:
+                st.download_button("Download PDF", pdf, f"invoice_{invoice_id}.pdf", "application/pdf")
+            else:
+                st.error("Invoice data not found.")
+
+        st.subheader("Batch PDF Export")
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            batch_start = st.date_input("From", value=datetime.now().date().replace(day=1), key="pdf_batch_start")
+        with col2:
+            batch_end = st.date_input("To", value=datetime.now().date(), key="pdf_batch_end")
+        with col3:
+            batch_status = st.selectbox("Status", ["All", "open", "paid"], key="pdf_batch_status")
+        if st.button("Render PDFs to ZIP", key="render_pdf_batch"):
+            # A ZIP of its own per render, so concurrent renders with the same filters don't overwrite each other
+            zip_fd, zip_path = tempfile.mkstemp(prefix=f"invoices_{st.session_state['org_id']}_", suffix=".zip")
+            os.close(zip_fd)
+            try:
+                with st.spinner("Rendering invoices..."):
+                    total, rendered = pdf_render.render_batch(st.session_state['org_id'], zip_path, batch_start, batch_end, None if batch_status == "All" else batch_status)
+                st.write(f"{total} invoices ({rendered} rendered, {total - rendered} from cache)")
+                with open(zip_path, 'rb') as f:
+                    st.download_button("Download ZIP", f, f"invoices_{batch_start}_{batch_end}.zip", "application/zip")
+            finally:
+                os.remove(zip_path)
     else:
         st.write("No invoices to generate PDF for.")
 
 with invoice_tab3:
     st.subheader("Dunning Management")
-    invoices = c.execute("SELECT id, sub_id, date, amount, status, due_date FROM invoices WHERE status = 'open' AND sub_id IN (SELECT id FROM subscriptions WHERE customer_id IN (SELECT id FROM customers WHERE org_id = ?))", (st.session_state['org_id'],)).fetchall()
+    invoices = db.query("SELECT id, sub_id, date, amount, status, due_date FROM invoices WHERE status = 'open' AND org_id = ?", (st.session_state['org_id'],))
     if invoices:
         selected_invoice = st.selectbox("Select Overdue Invoice", [f"ID: {inv[0]} - {inv[2]} - ${inv[3]} USDC" for inv in invoices])
         invoice_id = int(selected_invoice.split("ID: ")[1].split(" - ")[0])
-        invoice_data = c.execute("SELECT id, sub_id, date, amount, due_date, status FROM invoices WHERE id = ?", (invoice_id,)).fetchone()
+        invoice_data = db.query_one("SELECT id, sub_id, date, amount, due_date, status FROM invoices WHERE id = ?", (invoice_id,))
         if invoice_data:
             invoice_id, sub_id, issue_date, amount, due_date, status = invoice_data
             if datetime.now() > datetime.fromisoformat(due_date):
                 attempt = st.number_input("Dunning Attempt #", min_value=1, value=1)
                 if st.button("Initiate Dunning"):
-                    c.execute("INSERT INTO dunning_logs (invoice_id, attempt, date, status) VALUES (?, ?, ?, ?)",
-                              (invoice_id, attempt, datetime.now().isoformat(), "pending"))
-                    conn.commit()
-                    sub = c.execute("SELECT customer_id FROM subscriptions WHERE id = ?", (sub_id,)).fetchone()
-                    customer = c.execute("SELECT email FROM customers WHERE id = ?", (sub[0],)).fetchone()
+                    db.execute("INSERT INTO dunning_logs (invoice_id, attempt, date, status) VALUES (?, ?, ?, ?)",
+                               (invoice_id, attempt, datetime.now().isoformat(), "pending"))
+                    sub = db.query_one("SELECT customer_id FROM subscriptions WHERE id = ?", (sub_id,))
+                    customer = db.query_one("SELECT email FROM customers WHERE id = ?", (sub[0],))
                     mock_email(customer[0], "Payment Reminder", f"Invoice {invoice_id} is overdue. Amount: ${amount} USDC, Due: {due_date}")
                     log_audit(st.session_state['user_id'], "initiated_dunning", f"Invoice ID: {invoice_id}, Attempt: {attempt}")
                     st.success(f"Dunning attempt {attempt} initiated for invoice {invoice_id}!")
@@ -119,20 +104,42 @@ with invoice_tab3:
             st.error("Invoice data not found.")
     else:
         st.write("No overdue invoices for dunning.")
+    st.caption(f"Automatic dunning sends reminders {', '.join(str(days) for days in dunning.LADDER)} days after the due date.")
+    if st.button("Run Dunning Now"):
+        sent = dunning.run_once(st.session_state['org_id'])
+        log_audit(st.session_state['user_id'], "ran_dunning", f"Reminders sent: {sent}")
+        st.success(f"{sent} dunning reminders sent.")
 
 with invoice_tab4:
     st.subheader("Credit Notes")
-    sub_id = st.selectbox("Select Subscription", [f"ID: {sub[0]} - {sub[2]}" for sub in c.execute("SELECT id, customer_id, plan FROM subscriptions WHERE customer_id IN (SELECT id FROM customers WHERE org_id = ?)", (st.session_state['org_id'],)).fetchall()])
+    sub_id = st.selectbox("Select Subscription", [f"ID: {sub[0]} - {sub[2]}" for sub in db.query("SELECT id, customer_id, plan FROM subscriptions WHERE org_id = ?", (st.session_state['org_id'],))])
     sub_id = int(sub_id.split("ID: ")[1].split(" - ")[0])
     amount = st.number_input("Credit Amount (USDC)", min_value=0.01, value=1.0)
     reason = st.text_input("Reason for Credit")
     if st.button("Issue Credit Note"):
-        c.execute("INSERT INTO credit_notes (sub_id, amount, reason) VALUES (?, ?, ?)", (sub_id, amount, reason))
-        conn.commit()
+        db.execute("INSERT INTO credit_notes (sub_id, amount, reason) VALUES (?, ?, ?)", (sub_id, amount, reason))
         log_audit(st.session_state['user_id'], "issued_credit_note", f"Sub ID: {sub_id}, Amount: {amount}")
         st.success(f"Credit note of ${amount} USDC issued for Subscription ID {sub_id}!")
-    credit_notes_df = pd.read_sql_query("SELECT id AS ID, sub_id AS 'Subscription ID', amount AS 'Amount (USDC)', reason AS Reason FROM credit_notes WHERE sub_id IN (SELECT id FROM subscriptions WHERE customer_id IN (SELECT id FROM customers WHERE org_id = ?))", conn, params=(st.session_state['org_id'],))
+    credit_notes_df = cache.read_sql("SELECT id AS ID, sub_id AS 'Subscription ID', amount AS 'Amount (USDC)', reason AS Reason FROM credit_notes WHERE org_id = ?", params=(st.session_state['org_id'],), org_id=st.session_state['org_id'])
     if not credit_notes_df.empty:
         st.dataframe(credit_notes_df, use_container_width=True, hide_index=True)
     else:
-        st.write("No credit notes issued yet.")
\ No newline at end of file
+        st.write("No credit notes issued yet.")
+
+with invoice_tab5:
+    st.subheader("Billing Run")
+    billing_period = st.text_input("Billing Period (YYYY-MM)", value=datetime.now().strftime('%Y-%m'))
+    if st.button("Run Billing"):
+        try:
+            billing.period_bounds(billing_period)
+        except ValueError:
+            st.error("Billing period must be a month written as YYYY-MM.")
+        else:
+            with st.spinner(f"Billing {billing_period}..."):
+                result = billing.run(billing_period, st.session_state['org_id'])
+            log_audit(st.session_state['user_id'], "billing_run", f"Period: {billing_period}, Invoices: {result['invoices']}, Amount: {result['amount']}")
+            st.success(f"{result['invoices']} invoices created for {billing_period}: ${result['amount']} USDC ({result['prorated']} prorated).")
+    runs_df = cache.read_sql("SELECT id AS ID, period AS Period, started_at AS 'Started At', finished_at AS 'Finished At', invoices_created AS Invoices, amount_billed AS 'Amount (USDC)', status AS Status FROM billing_runs WHERE org_id = ? ORDER BY id DESC LIMIT 20",
+                             params=(st.session_state['org_id'],), org_id=st.session_state['org_id'])
+    if not runs_df.empty:
+        st.dataframe(runs_df, use_container_width=True, hide_index=True)
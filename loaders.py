@@ -0,0 +1,25 @@
+import db
+
+# Set-based loaders shared by several pages.
+
+CUSTOMER_COLUMNS = ['id', 'name', 'email', 'address', 'street', 'city', 'state', 'zip_code', 'custom_field', 'country', 'created_at']
+
+# Which subscription counts as a customer's "current" one: any non-canceled subscription
+# beats a canceled one, then the most recent start_date, then the newest id.
+CURRENT_SUBSCRIPTION_ORDER = "CASE WHEN status = 'canceled' THEN 1 ELSE 0 END, start_date DESC, id DESC"
+
+
+# Customers of an org with their current subscription's status, plan and amount in one query.
+# The winning subscription is picked per customer through idx_subscriptions_customer, which
+# beats a window over the whole org. Customers without a subscription get sub_status 'None'.
+def load_customers_with_subscription(org_id):
+    columns = ", ".join(f"c.{col}" for col in CUSTOMER_COLUMNS)
+    return db.read_sql(f"""SELECT {columns},
+                                  COALESCE(s.status, 'None') AS sub_status,
+                                  s.id AS sub_id, s.plan AS sub_plan, s.amount AS sub_amount
+                           FROM customers c
+                           LEFT JOIN subscriptions s
+                                  ON s.id = (SELECT id FROM subscriptions WHERE customer_id = c.id
+                                             ORDER BY {CURRENT_SUBSCRIPTION_ORDER} LIMIT 1)
+                           WHERE c.org_id = ?
+                           ORDER BY c.id""", params=(org_id,))
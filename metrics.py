@@ -0,0 +1,37 @@
+import cache
+
+# Dashboard metrics computed in SQL.
+# The KPI cards come from a single aggregate query and every chart reads an already
+# bucketed series (per plan, per month or per day), so the dashboard never holds an
+# org's raw subscriptions, invoices or usage logs in memory.
+
+# Deferred revenue still to be recognized, wherever a page shows a deferred total
+DEFERRED_BALANCE = "COALESCE(SUM(amount - COALESCE(recognized_amount, 0)), 0.0)"
+
+
+# Active Subs, MRR, churn, total revenue, deferred revenue, customers and recent payments in one round trip
+def kpis(org_id):
+    row = cache.read_sql(f"""SELECT s.active_subs, s.mrr, s.canceled_subs, s.total_subs, r.total_revenue, d.deferred_total, c.total_customers, p.recent_payments
+                            FROM (SELECT COUNT(*) AS total_subs, COALESCE(SUM(status = 'active'), 0) AS active_subs,
+                                         COALESCE(SUM(CASE WHEN status = 'active' THEN amount ELSE 0 END), 0.0) AS mrr,
+                                         COALESCE(SUM(status = 'canceled'), 0) AS canceled_subs
+                                  FROM subscriptions WHERE org_id = :org) s,
+                                 (SELECT COALESCE(SUM(paid_amount), 0.0) AS total_revenue FROM revenue_monthly WHERE org_id = :org) r,
+                                 (SELECT {DEFERRED_BALANCE} AS deferred_total FROM deferred_revenue WHERE org_id = :org) d,
+                                 (SELECT COUNT(*) AS total_customers FROM customers WHERE org_id = :org) c,
+                                 (SELECT COALESCE(SUM(amount), 0.0) AS recent_payments
+                                  FROM (SELECT amount FROM invoices WHERE org_id = :org AND status = 'paid' ORDER BY date DESC LIMIT 5)) p""",
+                         params={'org': org_id}, org_id=org_id).to_dict('records')[0]
+    row['churn_rate'] = (row['canceled_subs'] / row['total_subs'] * 100) if row['total_subs'] > 0 else 0.0
+    return row
+
+
+# Deferred revenue of the schedules starting between start_date and end_date (YYYY-MM-DD)
+def deferred_total(org_id, start_date, end_date):
+    return cache.read_sql(f"SELECT {DEFERRED_BALANCE} AS total FROM deferred_revenue WHERE org_id = ? AND start_date BETWEEN ? AND ?",
+                          params=(org_id, start_date, end_date), org_id=org_id)['total'].iloc[0]
+
+
+def customer_segments(org_id):
+    return cache.read_sql("SELECT segment, COUNT(*) as count FROM customer_segments WHERE customer_id IN (SELECT id FROM customers WHERE org_id = ?)", params=(org_id,), org_id=org_id)
+
@@ -0,0 +1,367 @@
+from datetime import datetime
+
+# Versioned schema migrations.
+# Each migration runs once in its own transaction and is recorded in schema_migrations;
+# db.py applies anything pending the first time a process touches the database.
+
+
+def _columns(cur, table):
+    return [row[1] for row in cur.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def _add_column(cur, table, column, decl):
+    if column not in _columns(cur, table):
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+# 1: tables as they exist in the shipped stunr_db.sqlite, so a fresh database works too
+def _baseline_schema(cur):
+    cur.execute("""CREATE TABLE IF NOT EXISTS audit_logs
+             (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, action TEXT, details TEXT, timestamp TEXT)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS users
+             (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE, email TEXT, password TEXT, name TEXT, role TEXT DEFAULT 'user', created_at TEXT, org_id INTEGER)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS subscriptions
+             (id INTEGER PRIMARY KEY, customer_id INTEGER, plan TEXT, amount FLOAT, start_date TEXT, last_bill_date TEXT, status TEXT, trial_days INTEGER, coupon_pct FLOAT, tax_rate FLOAT, entitlement TEXT, auto_dunning INTEGER DEFAULT 1)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS usage_logs
+             (id INTEGER PRIMARY KEY, sub_id INTEGER, timestamp TEXT, quantity INTEGER)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS invoices
+             (id INTEGER PRIMARY KEY, sub_id INTEGER, date TEXT, amount FLOAT, status TEXT, due_date TEXT)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS credit_notes
+             (id INTEGER PRIMARY KEY, sub_id INTEGER, amount FLOAT, reason TEXT)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS payouts
+             (id INTEGER PRIMARY KEY, date TEXT, amount FLOAT, destination TEXT, tx_sig TEXT, status TEXT)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS dunning_logs
+             (id INTEGER PRIMARY KEY, invoice_id INTEGER, attempt INTEGER, date TEXT, status TEXT)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS customers
+             (id INTEGER PRIMARY KEY, name TEXT, email TEXT, address TEXT, created_at TEXT, country TEXT DEFAULT 'US', org_id INTEGER, physical_address TEXT, custom_field TEXT)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS transactions
+             (id INTEGER PRIMARY KEY, tx_sig TEXT, amount FLOAT, from_addr TEXT, timestamp TEXT, status TEXT)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS recognized_revenue
+             (id INTEGER PRIMARY KEY, sub_id INTEGER, month TEXT, amount FLOAT, recognized_amount FLOAT, prorated BOOL DEFAULT 0)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS deferred_revenue
+             (id INTEGER PRIMARY KEY, sub_id INTEGER, amount FLOAT, start_date TEXT, end_date TEXT, status TEXT DEFAULT 'deferred')""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS customer_segments
+             (id INTEGER PRIMARY KEY, customer_id INTEGER, segment TEXT, usage_level FLOAT, last_updated TEXT)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS upsell_logs
+             (id INTEGER PRIMARY KEY, sub_id INTEGER, customer_id INTEGER, upsell_type TEXT, status TEXT, reward_tx TEXT, timestamp TEXT)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS webhooks
+             (id INTEGER PRIMARY KEY, event TEXT, url TEXT)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS invoice_settings
+             (id INTEGER PRIMARY KEY, company_name TEXT, company_address TEXT, logo_url TEXT, footer_text TEXT, primary_color TEXT DEFAULT '#6772e5', font TEXT DEFAULT 'Helvetica')""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS payment_settings
+             (id INTEGER PRIMARY KEY, stripe_publishable_key TEXT, stripe_secret_key TEXT)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS products
+             (id INTEGER PRIMARY KEY, name TEXT, description TEXT, price FLOAT, image_url TEXT, billing_frequency TEXT, active INTEGER DEFAULT 1)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS tax_rules
+             (id INTEGER PRIMARY KEY, country TEXT, rate FLOAT)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS recipients
+             (id INTEGER PRIMARY KEY, name TEXT, email TEXT, wallet_address TEXT, bank_details TEXT, verified BOOL DEFAULT 0)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS payout_batches
+             (id INTEGER PRIMARY KEY, date TEXT, status TEXT, total_amount FLOAT, csv_file BLOB, tx_sig TEXT)""")
+
+
+# 2: physical address columns (previously retried with ALTER TABLE on every page import)
+def _customer_address_columns(cur):
+    for column in ['street', 'city', 'state', 'zip_code', 'custom_field']:
+        _add_column(cur, 'customers', column, 'TEXT')
+
+
+# 3: indexes for the access paths every page filters on
+def _hot_path_indexes(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_customers_org ON customers (org_id, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_customers_address ON customers (address, org_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_customer ON subscriptions (customer_id, status)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_invoices_sub ON invoices (sub_id, date)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_invoices_status_due ON invoices (status, due_date)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_usage_logs_sub_ts ON usage_logs (sub_id, timestamp, quantity)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_transactions_from_addr ON transactions (from_addr)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tax_rules_country ON tax_rules (country, rate)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_recognized_revenue_sub ON recognized_revenue (sub_id, month)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_deferred_revenue_sub ON deferred_revenue (sub_id, start_date)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_credit_notes_sub ON credit_notes (sub_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_dunning_logs_invoice ON dunning_logs (invoice_id, attempt)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_customer_segments_customer ON customer_segments (customer_id, segment)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_org ON users (org_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_webhooks_event ON webhooks (event)")
+
+
+# Child tables that hang off a subscription via sub_id
+SUB_SCOPED_TABLES = ['invoices', 'usage_logs', 'recognized_revenue', 'deferred_revenue', 'credit_notes']
+
+
+# 4: carry org_id on subscription-scoped tables so tenant queries are one index range scan.
+# Triggers fill org_id on insert (unless the writer already supplied it) and follow re-parenting.
+def _denormalize_org_id(cur):
+    for table in ['subscriptions'] + SUB_SCOPED_TABLES + ['dunning_logs']:
+        _add_column(cur, table, 'org_id', 'INTEGER')
+
+    cur.execute("UPDATE subscriptions SET org_id = (SELECT org_id FROM customers WHERE customers.id = subscriptions.customer_id)")
+    for table in SUB_SCOPED_TABLES:
+        cur.execute(f"UPDATE {table} SET org_id = (SELECT org_id FROM subscriptions WHERE subscriptions.id = {table}.sub_id)")
+    cur.execute("UPDATE dunning_logs SET org_id = (SELECT org_id FROM invoices WHERE invoices.id = dunning_logs.invoice_id)")
+
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS trg_subscriptions_org_insert AFTER INSERT ON subscriptions
+                   WHEN NEW.org_id IS NULL
+                   BEGIN
+                       UPDATE subscriptions SET org_id = (SELECT org_id FROM customers WHERE id = NEW.customer_id) WHERE id = NEW.id;
+                   END""")
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS trg_subscriptions_org_reparent AFTER UPDATE OF customer_id ON subscriptions
+                   BEGIN
+                       UPDATE subscriptions SET org_id = (SELECT org_id FROM customers WHERE id = NEW.customer_id) WHERE id = NEW.id;
+                   END""")
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS trg_customers_org_cascade AFTER UPDATE OF org_id ON customers
+                   BEGIN
+                       UPDATE subscriptions SET org_id = NEW.org_id WHERE customer_id = NEW.id;
+                   END""")
+    cascade = "\n".join(f"        UPDATE {table} SET org_id = NEW.org_id WHERE sub_id = NEW.id;" for table in SUB_SCOPED_TABLES)
+    cur.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_subscriptions_org_cascade AFTER UPDATE OF org_id ON subscriptions
+                    BEGIN
+{cascade}
+                    END""")
+    for table in SUB_SCOPED_TABLES:
+        cur.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_org_insert AFTER INSERT ON {table}
+                        WHEN NEW.org_id IS NULL
+                        BEGIN
+                            UPDATE {table} SET org_id = (SELECT org_id FROM subscriptions WHERE id = NEW.sub_id) WHERE id = NEW.id;
+                        END""")
+        cur.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_org_reparent AFTER UPDATE OF sub_id ON {table}
+                        BEGIN
+                            UPDATE {table} SET org_id = (SELECT org_id FROM subscriptions WHERE id = NEW.sub_id) WHERE id = NEW.id;
+                        END""")
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS trg_invoices_org_cascade AFTER UPDATE OF org_id ON invoices
+                   BEGIN
+                       UPDATE dunning_logs SET org_id = NEW.org_id WHERE invoice_id = NEW.id;
+                   END""")
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS trg_dunning_logs_org_insert AFTER INSERT ON dunning_logs
+                   WHEN NEW.org_id IS NULL
+                   BEGIN
+                       UPDATE dunning_logs SET org_id = (SELECT org_id FROM invoices WHERE id = NEW.invoice_id) WHERE id = NEW.id;
+                   END""")
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS trg_dunning_logs_org_reparent AFTER UPDATE OF invoice_id ON dunning_logs
+                   BEGIN
+                       UPDATE dunning_logs SET org_id = (SELECT org_id FROM invoices WHERE id = NEW.invoice_id) WHERE id = NEW.id;
+                   END""")
+
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_org ON subscriptions (org_id, status, start_date)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_invoices_org_date ON invoices (org_id, date)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_invoices_org_status ON invoices (org_id, status, due_date)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_usage_logs_org_ts ON usage_logs (org_id, timestamp, quantity)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_recognized_revenue_org ON recognized_revenue (org_id, month, recognized_amount)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_deferred_revenue_org ON deferred_revenue (org_id, start_date)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_credit_notes_org ON credit_notes (org_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_dunning_logs_org ON dunning_logs (org_id, date)")
+
+
+# 5: incrementally maintained revenue rollups (see rollups.py), backfilled from history
+def _revenue_rollups(cur):
+    import rollups
+    rollups.create_tables(cur)
+    rollups.create_triggers(cur)
+    rollups.rebuild(cur)
+
+
+# 6: subscriptions.canceled_at, stamped when status turns 'canceled', and the cohort retention tables
+def _cohort_retention(cur):
+    import cohorts
+    _add_column(cur, 'subscriptions', 'canceled_at', 'TEXT')
+    # No cancel date was recorded before; the last billing date is the closest thing we have
+    cur.execute("UPDATE subscriptions SET canceled_at = COALESCE(last_bill_date, start_date) WHERE status = 'canceled' AND canceled_at IS NULL")
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS trg_subscriptions_canceled_insert AFTER INSERT ON subscriptions
+                   WHEN NEW.status = 'canceled' AND NEW.canceled_at IS NULL
+                   BEGIN
+                       UPDATE subscriptions SET canceled_at = strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime') WHERE id = NEW.id;
+                   END""")
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS trg_subscriptions_canceled_update AFTER UPDATE OF status ON subscriptions
+                   WHEN NEW.status IS NOT OLD.status
+                   BEGIN
+                       UPDATE subscriptions SET canceled_at = CASE WHEN NEW.status = 'canceled' THEN COALESCE(NEW.canceled_at, strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime')) END WHERE id = NEW.id;
+                   END""")
+    cohorts.create_tables(cur)
+
+
+# 7: usage ingestion: client idempotency keys and minute/hour/day usage rollups (see usage.py)
+def _usage_rollups(cur):
+    import usage
+    _add_column(cur, 'usage_logs', 'idempotency_key', 'TEXT')
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_usage_logs_idempotency ON usage_logs (org_id, sub_id, idempotency_key) WHERE idempotency_key IS NOT NULL")
+    usage.create_tables(cur)
+    usage.create_triggers(cur)
+    usage.rebuild(cur)
+
+
+# 8: indexes behind the paginated list tables (tables.py): NOCASE indexes let "col LIKE 'term%'"
+# search use a range scan, and the filters/keyset order are covered per table
+def _list_search_indexes(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_transactions_sig ON transactions (tx_sig COLLATE NOCASE)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_transactions_status ON transactions (status)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users (username COLLATE NOCASE)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_email ON users (email COLLATE NOCASE)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_name ON users (name COLLATE NOCASE)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_products_name ON products (name COLLATE NOCASE)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_products_description ON products (description COLLATE NOCASE)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_products_active_billing ON products (active, billing_frequency, price)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_invoices_org_sub ON invoices (org_id, sub_id)")
+    # (org_id) alone is stored as (org_id, rowid): one org's invoices already in id order for the keyset
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_invoices_org_id ON invoices (org_id)")
+
+
+# 9: FTS5 search over customers and users (see search.py)
+def _full_text_search(cur):
+    import search
+    search.create_tables(cur)
+    search.rebuild(cur)
+
+
+# 10: background dunning: reminder outbox and cross-process job claims (see dunning.py, scheduler.py)
+def _dunning_engine(cur):
+    import dunning
+    import scheduler
+    dunning.create_tables(cur)
+    scheduler.create_tables(cur)
+
+
+# 11: billing runs: the period an invoice bills, unique per subscription (see billing.py)
+def _billing_runs(cur):
+    import billing
+    _add_column(cur, 'invoices', 'period', 'TEXT')
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_invoices_sub_period ON invoices (sub_id, period) WHERE period IS NOT NULL")
+    billing.create_tables(cur)
+
+
+# 12: revenue recognition: schedules per invoice, recognized rows per schedule (see revrec.py)
+def _revenue_recognition(cur):
+    import revrec
+    _add_column(cur, 'deferred_revenue', 'invoice_id', 'INTEGER')
+    _add_column(cur, 'deferred_revenue', 'recognized_amount', 'FLOAT DEFAULT 0')
+    _add_column(cur, 'recognized_revenue', 'deferred_id', 'INTEGER')
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_deferred_revenue_invoice ON deferred_revenue (invoice_id) WHERE invoice_id IS NOT NULL")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_deferred_revenue_end ON deferred_revenue (end_date, start_date)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_recognized_revenue_deferred ON recognized_revenue (deferred_id, month)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_recognized_revenue_month ON recognized_revenue (month, deferred_id)")
+    revrec.create_tables(cur)
+    revrec.retire_legacy(cur)
+
+
+# 13: invoice net/tax split and the tax_monthly rollup (see tax_engine.py)
+def _invoice_tax(cur):
+    import tax_engine
+    _add_column(cur, 'invoices', 'net_amount', 'FLOAT')
+    _add_column(cur, 'invoices', 'tax_rate', 'FLOAT')
+    _add_column(cur, 'invoices', 'tax_amount', 'FLOAT')
+    _add_column(cur, 'invoices', 'tax_review', 'INTEGER DEFAULT 0')
+    tax_engine.create_tables(cur)
+    tax_engine.backfill_net(cur)
+    tax_engine.rebuild(cur)
+
+
+# 14: Solana Pay payment intents confirmed by reference key (see payment_watcher.py)
+def _payment_intents(cur):
+    import payment_watcher
+    payment_watcher.create_tables(cur)
+
+
+# 15: per-recipient payout status for batch payouts (see payouts.py)
+def _payout_items(cur):
+    import payouts
+    payouts.create_tables(cur)
+
+
+# 16: payout batches paid through Stripe (see stripe_exec.py)
+def _payout_batch_method(cur):
+    _add_column(cur, 'payout_batches', 'method', "TEXT DEFAULT 'usdc'")
+
+
+# 17: billing runs belong to the org they billed (see billing.py)
+def _billing_run_org(cur):
+    _add_column(cur, 'billing_runs', 'org_id', 'INTEGER')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_billing_runs_org ON billing_runs (org_id, id)")
+
+
+# 18: failed Stripe payout items are retried under a new idempotency key per attempt (see stripe_exec.py)
+def _payout_item_attempts(cur):
+    _add_column(cur, 'payout_items', 'attempts', 'INTEGER DEFAULT 0')
+
+
+# Lower cohort_state.dirty_from to month (an ISO date expression) when it falls in an org's closed cohort months
+def _cohort_dirty(ref, column, condition="1"):
+    month = f"substr({ref}.{column}, 1, 7)"
+    return f"""UPDATE cohort_state SET dirty_from = MIN(COALESCE(dirty_from, {month}), {month}), dirty_seq = COALESCE(dirty_seq, 0) + 1
+               WHERE org_id = {ref}.org_id AND {month} < computed_through AND ({condition});"""
+
+
+# 19: subscriptions written into closed cohort months get those months recomputed (see cohorts.py)
+def _cohort_dirty_months(cur):
+    _add_column(cur, 'cohort_state', 'dirty_from', 'TEXT')
+    _add_column(cur, 'cohort_state', 'dirty_seq', 'INTEGER DEFAULT 0')
+    changed = "NEW.status IS NOT OLD.status OR NEW.canceled_at IS NOT OLD.canceled_at"
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_subscriptions_cohort_insert AFTER INSERT ON subscriptions BEGIN\n{_cohort_dirty('NEW', 'start_date')}\nEND")
+    cur.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_subscriptions_cohort_update AFTER UPDATE OF org_id, start_date, status, canceled_at ON subscriptions BEGIN
+                    {_cohort_dirty('OLD', 'start_date', "NEW.start_date IS NOT OLD.start_date OR NEW.org_id IS NOT OLD.org_id")}
+                    {_cohort_dirty('NEW', 'start_date', "NEW.start_date IS NOT OLD.start_date OR NEW.org_id IS NOT OLD.org_id")}
+                    {_cohort_dirty('OLD', 'canceled_at', changed)}
+                    {_cohort_dirty('NEW', 'canceled_at', changed)}
+                    END""")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_subscriptions_cohort_delete AFTER DELETE ON subscriptions BEGIN\n{_cohort_dirty('OLD', 'start_date')}\nEND")
+
+
+MIGRATIONS = [
+    (1, "baseline_schema", _baseline_schema),
+    (2, "customer_address_columns", _customer_address_columns),
+    (3, "hot_path_indexes", _hot_path_indexes),
+    (4, "denormalize_org_id", _denormalize_org_id),
+    (5, "revenue_rollups", _revenue_rollups),
+    (6, "cohort_retention", _cohort_retention),
+    (7, "usage_rollups", _usage_rollups),
+    (8, "list_search_indexes", _list_search_indexes),
+    (9, "full_text_search", _full_text_search),
+    (10, "dunning_engine", _dunning_engine),
+    (11, "billing_runs", _billing_runs),
+    (12, "revenue_recognition", _revenue_recognition),
+    (13, "invoice_tax", _invoice_tax),
+    (14, "payment_intents", _payment_intents),
+    (15, "payout_items", _payout_items),
+    (16, "payout_batch_method", _payout_batch_method),
+    (17, "billing_run_org", _billing_run_org),
+    (18, "payout_item_attempts", _payout_item_attempts),
+    (19, "cohort_dirty_months", _cohort_dirty_months),
+]
+
+
+def current_version(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY, name TEXT, applied_at TEXT)")
+    row = conn.execute("SELECT MAX(version) FROM schema_migrations").fetchone()
+    return row[0] or 0
+
+
+# Apply pending migrations on an autocommit connection; returns the versions applied
+def migrate(conn):
+    applied = []
+    version = current_version(conn)
+    for number, name, step in MIGRATIONS:
+        if number <= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Another process may have applied it while we waited for the write lock
+            if conn.execute("SELECT 1 FROM schema_migrations WHERE version = ?", (number,)).fetchone() is None:
+                cur = conn.cursor()
+                step(cur)
+                cur.execute("INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                            (number, name, datetime.now().isoformat()))
+                applied.append(number)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    if applied:
+        conn.execute(f"PRAGMA user_version = {applied[-1]}")
+        # Refresh planner statistics so the new indexes are picked up
+        conn.execute("ANALYZE")
+    return applied
+
+
+if __name__ == '__main__':
+    import db
+    # Opening the writer connection applies anything pending
+    conn = db.get_write_conn()
+    print(f"Schema at version {current_version(conn)} (latest {MIGRATIONS[-1][0]})")
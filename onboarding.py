@@ -1,43 +1,16 @@
 import streamlit as st
-import sqlite3
+import db
+import audit
+from importer import import_customers
 import pandas as pd
 from datetime import datetime
 import base64  # For potential wallet hashing
 
-# Initialize database connection
-conn = sqlite3.connect('stunr_db.sqlite', check_same_thread=False)
-c = conn.cursor()
-
 # Audit logging function
-def log_audit(user_id, action, details):
-    timestamp = datetime.now().isoformat()
-    c.execute("INSERT INTO audit_logs (user_id, action, details, timestamp) VALUES (?, ?, ?, ?)",
-              (user_id, action, details, timestamp))
-    conn.commit()
+def log_audit(user_id, action, details, sync=False):
+    timestamp = audit.log_audit(user_id, action, details, sync=sync)
     st.write(f"Audit Log: {action} - {details} at {timestamp}")  # Optional feedback
 
-# Add new columns to customers table if not exist
-try:
-    c.execute("ALTER TABLE customers ADD COLUMN street TEXT")
-    conn.commit()
-except:
-    pass
-try:
-    c.execute("ALTER TABLE customers ADD COLUMN city TEXT")
-    conn.commit()
-except:
-    pass
-try:
-    c.execute("ALTER TABLE customers ADD COLUMN state TEXT")
-    conn.commit()
-except:
-    pass
-try:
-    c.execute("ALTER TABLE customers ADD COLUMN zip_code TEXT")
-    conn.commit()
-except:
-    pass
-
 st.header("Onboarding")
 onboard_tab1, onboard_tab2 = st.tabs(["New Customer", "Migrate Existing"])
 
@@ -55,10 +28,9 @@ with onboard_tab1:
     if st.button("Signup with Wallet"):
         if wallet_address:
             created_at = datetime.now().isoformat()
-            c.execute("INSERT INTO customers (name, email, address, street, city, state, zip_code, custom_field, created_at, country, org_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                      (name, email, wallet_address, street, city, state, zip_code, custom_field, created_at, country, st.session_state['org_id']))
-            conn.commit()
-            customer_id = c.lastrowid
+            cur = db.execute("INSERT INTO customers (name, email, address, street, city, state, zip_code, custom_field, created_at, country, org_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (name, email, wallet_address, street, city, state, zip_code, custom_field, created_at, country, st.session_state['org_id']))
+            customer_id = cur.lastrowid
             st.session_state['current_customer_id'] = customer_id
             log_audit(st.session_state['user_id'], "new_customer_onboard", f"Wallet: {wallet_address}")
             st.success("Onboarded with wallet! Setup subscription next.")
@@ -68,21 +40,17 @@ with onboard_tab1:
 with onboard_tab2:
     st.subheader("Migrate Existing Customers")
     uploaded_file = st.file_uploader("Upload CSV (columns: name,email,address,street,city,state,zip_code,country,opening_balance,billing_day,subscription_plan,subscription_start_date,wallet_address,custom_field)", type="csv")
-    if uploaded_file:
-        migrate_df = pd.read_csv(uploaded_file)
-        if all(col in migrate_df.columns for col in ['name', 'email', 'address', 'country']):
-            for index, row in migrate_df.iterrows():
-                created_at = datetime.now().isoformat()
-                street = row.get('street', '')
-                city = row.get('city', '')
-                state = row.get('state', '')
-                zip_code = row.get('zip_code', '')
-                custom_field = row.get('custom_field', '')
-                c.execute("INSERT INTO customers (name, email, address, street, city, state, zip_code, custom_field, created_at, country, org_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                          (row['name'], row['email'], row['address'], street, city, state, zip_code, custom_field, created_at, row['country'], st.session_state['org_id']))
-                conn.commit()
-                log_audit(st.session_state['user_id'], "migrated_customer", f"Name: {row['name']}")
-            st.success("Migration complete! All customers imported.")
-        else:
-            st.error("CSV must have columns: name, email, address, country.")
+    if uploaded_file and st.button("Import Customers"):
+        progress_text = st.empty()
+        try:
+            result = import_customers(uploaded_file, st.session_state['org_id'], st.session_state['user_id'],
+                                      progress=lambda r: progress_text.write(f"{r.rows} rows read, {r.imported} imported, {r.rejected_count} rejected..."))
+            st.success(f"Migration complete! {result.imported} customers, {result.subscriptions} subscriptions and {result.invoices} opening invoices imported.")
+            if result.rejected:
+                rejected_df = result.rejected_df()
+                st.warning(f"{len(rejected_df)} rows were rejected.")
+                st.dataframe(rejected_df, use_container_width=True, hide_index=True)
+                st.download_button("Download Rejected Rows", rejected_df.to_csv(index=False), "rejected_customers.csv", "text/csv")
+        except ValueError as e:
+            st.error(str(e))
     st.info("Blockchain Verification: Data hashed on Solana for integrity (mock).")
\ No newline at end of file
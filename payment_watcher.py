@@ -0,0 +1,192 @@
+import argparse
+import asyncio
+import threading
+from datetime import datetime, timedelta
+from decimal import Decimal
+from urllib.parse import quote
+import httpx
+from solders.keypair import Keypair
+import db
+import solana_rpc
+
+# Solana Pay confirmation service.
+# Every USDC payment intent gets its own reference key, which the payer's wallet adds to
+# the transfer as a read-only account. One asyncio loop watches every pending intent: each
+# poll sends the getSignaturesForAddress calls for all references as JSON-RPC batches of
+# RPC_BATCH, fetches the transactions it finds in one more batch, and checks that the
+# recipient received at least the intent's amount of the mint. Confirmed transfers are
+# written to transactions and the intent is marked 'confirmed'; pages only read the status.
+# Run it as its own process (python payment_watcher.py) or in-process with start_in_thread.
+# Point STUNR_SOLANA_RPC at a local validator or RPC stand-in to test it.
+
+RPC_URL = solana_rpc.RPC_URL
+USDC_MINT = str(solana_rpc.USDC_MINT)
+POLL_INTERVAL = 2.0  # seconds
+INTENT_TTL = timedelta(minutes=30)
+RPC_BATCH = 100
+MAX_CONCURRENT_BATCHES = 4
+SIGNATURES_PER_REFERENCE = 10
+COMMITMENT = solana_rpc.COMMITMENT
+MAX_RETRIES = solana_rpc.MAX_RETRIES
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def create_tables(cur):
+    cur.execute("""CREATE TABLE IF NOT EXISTS payment_intents
+                   (id INTEGER PRIMARY KEY, org_id INTEGER, reference TEXT UNIQUE, recipient TEXT, mint TEXT, amount FLOAT, description TEXT,
+                    status TEXT DEFAULT 'pending', created_at TEXT, expires_at TEXT, tx_sig TEXT, payer TEXT, confirmed_at TEXT)""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_payment_intents_pending ON payment_intents (status, expires_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_payment_intents_org ON payment_intents (org_id, created_at)")
+
+
+# New pending intent; returns (intent id, reference)
+def create_intent(org_id, amount, description, recipient, mint=USDC_MINT, now=None):
+    now = now or datetime.now()
+    reference = str(Keypair().pubkey())
+    with db.transaction() as cur:
+        cur.execute("INSERT INTO payment_intents (org_id, reference, recipient, mint, amount, description, created_at, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (org_id, reference, str(recipient), str(mint), amount, description, now.isoformat(), (now + INTENT_TTL).isoformat()))
+        return cur.lastrowid, reference
+
+
+def payment_uri(recipient, amount, reference, description, mint=USDC_MINT):
+    return f"solana:{recipient}?amount={amount}&spl-token={mint}&reference={reference}&label=STUNR.ai&message={quote(description or '')}"
+
+
+def intent_status(intent_id):
+    row = db.query_one("SELECT status, tx_sig, payer, confirmed_at, amount FROM payment_intents WHERE id = ?", (intent_id,))
+    if row is None:
+        return None
+    return dict(zip(['status', 'tx_sig', 'payer', 'confirmed_at', 'amount'], row))
+
+
+# Results of one JSON-RPC batch, in call order (None for calls that failed).
+# Rate limits and server errors are retried with exponential backoff.
+async def rpc_batch(http, url, calls):
+    payload = [{'jsonrpc': '2.0', 'id': i, 'method': method, 'params': params} for i, (method, params) in enumerate(calls)]
+    delay = 0.5
+    for attempt in range(MAX_RETRIES):
+        response = await http.post(url, json=payload)
+        if response.status_code == 429 or response.status_code >= 500:
+            if attempt == MAX_RETRIES - 1:
+                response.raise_for_status()
+            await asyncio.sleep(float(response.headers.get('Retry-After', delay)))
+            delay *= 2
+            continue
+        response.raise_for_status()
+        body = response.json()
+        replies = body if isinstance(body, list) else [body]
+        results = [None] * len(calls)
+        for reply in replies:
+            if isinstance(reply.get('id'), int) and 0 <= reply['id'] < len(calls):
+                results[reply['id']] = reply.get('result')
+        return results
+
+
+# (payer, amount received) when tx credits at least amount of mint to recipient, else None.
+# recipient may be the receiving token account or its owner.
+def match_transfer(tx, recipient, mint, amount):
+    if not tx or not tx.get('meta') or tx['meta'].get('err') is not None:
+        return None
+    keys = [key['pubkey'] if isinstance(key, dict) else key for key in tx['transaction']['message']['accountKeys']]
+    def balances(field):
+        totals = {}
+        for entry in tx['meta'].get(field) or []:
+            account = keys[entry['accountIndex']]
+            if entry.get('mint') == mint and recipient in (account, entry.get('owner')):
+                token = entry['uiTokenAmount']
+                totals[account] = Decimal(token['amount']).scaleb(-int(token['decimals']))
+        return totals
+    pre, post = balances('preTokenBalances'), balances('postTokenBalances')
+    received = sum((post[account] - pre.get(account, Decimal(0)) for account in post), Decimal(0))
+    if received <= 0 or received < Decimal(str(amount)):
+        return None
+    return keys[0], float(received)
+
+
+async def _check_batch(http, url, intents):
+    references = await rpc_batch(http, url, [('getSignaturesForAddress', [intent[1], {'limit': SIGNATURES_PER_REFERENCE, 'commitment': COMMITMENT}])
+                                             for intent in intents])
+    candidates = [(intent, entry['signature']) for intent, found in zip(intents, references) for entry in (found or [])
+                  if entry.get('err') is None]
+    if not candidates:
+        return []
+    txs = await rpc_batch(http, url, [('getTransaction', [signature, {'encoding': 'jsonParsed', 'commitment': COMMITMENT, 'maxSupportedTransactionVersion': 0}])
+                                      for _, signature in candidates])
+    matches, matched = [], set()
+    for (intent, signature), tx in zip(candidates, txs):
+        intent_id, _, recipient, mint, amount = intent
+        if intent_id in matched:
+            continue
+        found = match_transfer(tx, recipient, mint, amount)
+        if found:
+            matched.add(intent_id)
+            matches.append((intent_id, signature, found[0], found[1], tx.get('blockTime')))
+    return matches
+
+
+def _record(matches, now):
+    confirmed = 0
+    with db.transaction() as cur:
+        for intent_id, signature, payer, received, block_time in matches:
+            cur.execute("UPDATE payment_intents SET status = 'confirmed', tx_sig = ?, payer = ?, confirmed_at = ? WHERE id = ? AND status = 'pending'",
+                        (signature, payer, now.isoformat(), intent_id))
+            if cur.rowcount == 0:
+                continue
+            confirmed += 1
+            timestamp = datetime.fromtimestamp(block_time).isoformat() if block_time else now.isoformat()
+            # COLLATE NOCASE lets the lookup use idx_transactions_sig
+            cur.execute("INSERT INTO transactions (tx_sig, amount, from_addr, timestamp, status) SELECT ?, ?, ?, ?, 'confirmed' WHERE NOT EXISTS (SELECT 1 FROM transactions WHERE tx_sig = ? COLLATE NOCASE)",
+                        (signature, received, payer, timestamp, signature))
+    return confirmed
+
+
+# One pass over every pending intent; returns the number confirmed
+async def poll_once(http, url=RPC_URL, now=None):
+    now = now or datetime.now()
+    pending = db.query("SELECT id, reference, recipient, mint, amount, expires_at FROM payment_intents WHERE status = 'pending'")
+    # Only take the write lock when something has actually expired
+    if any(expires_at <= now.isoformat() for *_, expires_at in pending):
+        db.execute("UPDATE payment_intents SET status = 'expired' WHERE status = 'pending' AND expires_at <= ?", (now.isoformat(),))
+    intents = [intent[:5] for intent in pending if intent[5] > now.isoformat()]
+    if not intents:
+        return 0
+    limit = asyncio.Semaphore(MAX_CONCURRENT_BATCHES)
+    async def check(batch):
+        async with limit:
+            return await _check_batch(http, url, batch)
+    results = await asyncio.gather(*(check(intents[i:i + RPC_BATCH]) for i in range(0, len(intents), RPC_BATCH)))
+    matches = [match for batch in results for match in batch]
+    return _record(matches, now) if matches else 0
+
+
+async def watch(url=RPC_URL, interval=POLL_INTERVAL):
+    async with httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_keepalive_connections=MAX_CONCURRENT_BATCHES)) as http:
+        while True:
+            try:
+                confirmed = await poll_once(http, url)
+                if confirmed:
+                    print(f"Payment watcher: {confirmed} intents confirmed")
+            except Exception as e:
+                print(f"Payment watcher poll failed, will retry: {e}")
+            await asyncio.sleep(interval)
+
+
+# Run the watcher on a daemon thread of this process (once)
+def start_in_thread(url=RPC_URL):
+    global _watcher
+    if _watcher is None:
+        with _watcher_lock:
+            if _watcher is None:
+                _watcher = threading.Thread(target=asyncio.run, args=(watch(url),), name="payment-watcher", daemon=True)
+                _watcher.start()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Confirm pending Solana Pay intents.")
+    parser.add_argument('--rpc-url', default=RPC_URL)
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL, help="Seconds between polls")
+    args = parser.parse_args()
+    asyncio.run(watch(args.rpc_url, args.interval))
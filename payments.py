@@ -1,42 +1,37 @@
 import streamlit as st
-from solana.rpc.api import Client
 from solders.keypair import Keypair
 from solders.pubkey import Pubkey as PublicKey
-from solders.message import Message
-from solders.transaction import Transaction
 from solders.system_program import TransferParams, transfer
 from spl.token.constants import TOKEN_PROGRAM_ID
-from spl.token.instructions import get_associated_token_address, create_associated_token_account, TransferCheckedParams, transfer_checked
+from spl.token.instructions import TransferCheckedParams, transfer_checked
 import json
+import uuid
 import qrcode
 import io
 import time
-import sqlite3
+import db
+import fraud
+import charts
+import audit
+import payment_watcher
+import payouts
+import solana_rpc
+import stripe_exec
 from datetime import datetime
 import pandas as pd
 import altair as alt
 import numpy as np
 import stripe
 
-# Initialize database connection
-conn = sqlite3.connect('stunr_db.sqlite', check_same_thread=False)
-c = conn.cursor()
-
 # Mock email sender
 def mock_email(to_email, subject, body, attachment=None):
     st.info(f"Email sent to {to_email}: Subject - {subject}\nBody - {body}\nAttachment - {attachment if attachment else 'None'}")
 
 # Audit logging function
-def log_audit(user_id, action, details):
-    timestamp = datetime.now().isoformat()
-    c.execute("INSERT INTO audit_logs (user_id, action, details, timestamp) VALUES (?, ?, ?, ?)",
-              (user_id, action, details, timestamp))
-    conn.commit()
+def log_audit(user_id, action, details, sync=False):
+    timestamp = audit.log_audit(user_id, action, details, sync=sync)
     st.write(f"Audit Log: {action} - {details} at {timestamp}")  # Optional feedback
 
-# Connect to Solana devnet
-client = Client("https://api.devnet.solana.com")
-
 # Load your merchant wallet (adjusted path)
 try:
     with open('C:/Users/Tyler/Desktop/stunr-mvp/wallet.json') as f:  # Absolute path to your project folder
@@ -47,30 +42,32 @@ except FileNotFoundError:
     st.stop()
 
 # Correct USDC mint on Solana devnet
-USDC_MINT = PublicKey.from_string("4zMMC9srt5Ri5X14GAgXhaHii3GnPAEERYPJgZJDncDU")
+USDC_MINT = solana_rpc.USDC_MINT
 USDC_DECIMALS = 6
 
-# Get or create USDC token account
-def get_or_create_token_account(owner):
-    token_account = get_associated_token_address(owner.pubkey(), USDC_MINT)
-    account_info = client.get_account_info(token_account)
-    if account_info.value is None:
-        recent_blockhash = client.get_latest_blockhash().value.blockhash
-        instructions = [create_associated_token_account(owner.pubkey(), owner.pubkey(), USDC_MINT)]
-        message = Message.new_with_blockhash(instructions, owner.pubkey(), recent_blockhash)
-        txn = Transaction([owner], message, recent_blockhash)
-        client.send_transaction(txn)
-    return token_account
+# USDC token accounts of owners, created (paid by the merchant) where missing
+def get_or_create_token_accounts(owners):
+    return solana_rpc.ensure_token_accounts(owners, merchant_keypair, USDC_MINT)
 
-merchant_usdc_account = get_or_create_token_account(merchant_keypair)
+# Send USDC from the merchant account; returns the signature
+def send_usdc(dest_account, amount):
+    instructions = [transfer_checked(TransferCheckedParams(
+        program_id=TOKEN_PROGRAM_ID,
+        source=merchant_usdc_account,
+        mint=USDC_MINT,
+        dest=dest_account,
+        owner=merchant_keypair.pubkey(),
+        amount=int(amount * 10**USDC_DECIMALS),
+        decimals=USDC_DECIMALS
+    ))]
+    tx_sig = solana_rpc.send(instructions, [merchant_keypair])
+    solana_rpc.invalidate_balance(merchant_usdc_account)
+    return tx_sig
+
+merchant_usdc_account = get_or_create_token_accounts([merchant_keypair.pubkey()])[merchant_keypair.pubkey()]
 
 # Fetch or initialize payment settings
-payment_settings = c.execute("SELECT * FROM payment_settings").fetchone()
-if not payment_settings:
-    c.execute("INSERT INTO payment_settings (stripe_publishable_key, stripe_secret_key) VALUES (?, ?)",
-              ("pk_test_...", "sk_test_..."))  # Replace with real test keys
-    conn.commit()
-    payment_settings = c.execute("SELECT * FROM payment_settings").fetchone()
+payment_settings = db.get_payment_settings()
 stripe.api_key = payment_settings[2]  # Secret key
 
 st.header("Payments")
@@ -84,48 +81,58 @@ with payments_tab1:
 
     if st.button("Generate Payment Intent", key="generate_payment"):
         if payment_method == "Solana USDC":
-            payment_uri = f"solana:{merchant_usdc_account}?amount={amount}&spl-token={USDC_MINT}&label=STUNR.ai&message={description}"
-            qr = qrcode.QRCode(version=1, box_size=10, border=5)
-            qr.add_data(payment_uri)
-            qr.make(fit=True)
-            img = qr.make_image(fill='black', back_color='white')
-            buf = io.BytesIO()
-            img.save(buf, format="PNG")
-            buf.seek(0)
-            st.image(buf, caption="Scan with Solana wallet (e.g., Phantom) to pay")
-            st.write(f"Send {amount} USDC to: {merchant_usdc_account}")
-            with st.spinner("Waiting for payment..."):
-                initial_balance_resp = client.get_token_account_balance(merchant_usdc_account)
-                initial_balance = initial_balance_resp.value.ui_amount or 0.0
-                while True:
-                    time.sleep(10)
-                    new_balance_resp = client.get_token_account_balance(merchant_usdc_account)
-                    new_balance = new_balance_resp.value.ui_amount or 0.0
-                    if new_balance > initial_balance:
-                        st.success(f"Payment received! New balance: {new_balance} USDC")
-                        webhooks = c.execute("SELECT url FROM webhooks WHERE event = 'payment_success'").fetchall()
-                        for hook in webhooks:
-                            url = hook[0]
-                            payload = json.dumps({"event": "payment_success", "amount": amount})
-                            st.info(f"Mock POST to {url}: {payload}")
-                        break
+            intent_id, reference = payment_watcher.create_intent(st.session_state['org_id'], amount, description, merchant_usdc_account)
+            st.session_state['payment_intent'] = {'id': intent_id, 'amount': amount, 'notified': False,
+                                                   'uri': payment_watcher.payment_uri(merchant_usdc_account, amount, reference, description)}
+        else:
+            # Created on the Stripe worker pool; each click gets its own key, which the pool's retries reuse
+            st.session_state['stripe_intent_key'] = f"stunr-intent-{uuid.uuid4().hex}"
+            st.session_state['stripe_intent'] = stripe_exec.submit_payment_intent(
+                amount, description, ['card'] if payment_method == "Credit Card (via Stripe)" else ['us_bank_account'],
+                st.session_state['stripe_intent_key'])
+
+    stripe_intent = st.session_state.get('stripe_intent')
+    if stripe_intent:
+        if not stripe_intent.done():
+            st.info("Creating Stripe payment intent...")
+            st.button("Refresh", key="refresh_stripe_intent")
+        elif stripe_intent.exception():
+            st.error(f"Stripe error: {stripe_intent.exception()}")
+        else:
+            st.write(f"Client Secret: {stripe_intent.result().client_secret}")
+            st.info("Use Stripe Elements or test card (4242 4242 4242 4242) to complete payment.")
+
+    # The payment watcher confirms the transfer by its reference key; the page only reads the intent's status
+    pending_intent = st.session_state.get('payment_intent')
+    if pending_intent:
+        qr = qrcode.QRCode(version=1, box_size=10, border=5)
+        qr.add_data(pending_intent['uri'])
+        qr.make(fit=True)
+        img = qr.make_image(fill='black', back_color='white')
+        buf = io.BytesIO()
+        img.save(buf, format="PNG")
+        buf.seek(0)
+        st.image(buf, caption="Scan with Solana wallet (e.g., Phantom) to pay")
+        st.write(f"Send {pending_intent['amount']} USDC to: {merchant_usdc_account}")
+        status = payment_watcher.intent_status(pending_intent['id'])
+        if status is None or status['status'] == 'expired':
+            st.warning("Payment intent expired. Generate a new one to retry.")
+        elif status['status'] == 'confirmed':
+            st.success(f"Payment received! {status['amount']} USDC from {status['payer']} (tx {status['tx_sig']})")
+            if not pending_intent['notified']:
+                webhooks = db.query("SELECT url FROM webhooks WHERE event = 'payment_success'")
+                for hook in webhooks:
+                    url = hook[0]
+                    payload = json.dumps({"event": "payment_success", "amount": status['amount'], "tx_sig": status['tx_sig']})
+                    st.info(f"Mock POST to {url}: {payload}")
+                pending_intent['notified'] = True
         else:
-            try:
-                intent = stripe.PaymentIntent.create(
-                    amount=int(amount * 100),
-                    currency="usd",
-                    description=description,
-                    payment_method_types=['card'] if payment_method == "Credit Card (via Stripe)" else ['us_bank_account'],
-                )
-                st.write(f"Client Secret: {intent.client_secret}")
-                st.info("Use Stripe Elements or test card (4242 4242 4242 4242) to complete payment.")
-            except Exception as e:
-                st.error(f"Stripe error: {e}")
+            st.info("Waiting for payment...")
+            st.button("Check Payment Status", key="check_payment")
 
 with payments_tab2:
     st.subheader("Payouts Management")
-    balance_resp = client.get_token_account_balance(merchant_usdc_account)
-    current_balance = balance_resp.value.ui_amount or 0.0
+    current_balance = solana_rpc.token_balance(merchant_usdc_account)
     st.write(f"Available USDC Balance: {current_balance}")
 
     payout_tab1, payout_tab2, payout_tab3 = st.tabs(["Single Payout", "Batch Payouts", "Payout History & Analytics"])
@@ -137,6 +144,7 @@ with payments_tab2:
         payout_type = st.selectbox("Payout Type", ["Crypto (USDC)", "Fiat (via Stripe)"])
         verified = st.checkbox("Recipient Verified (Mock KYC/Tax Check)", value=True)
         approve = st.checkbox("Approve Payout", value=True)
+        approve_flagged = st.checkbox("Send Even If Flagged as Potential Fraud", value=False)
         schedule_date = st.date_input("Schedule Payout For (Optional)", value=None)
         mock_mode = st.checkbox("Mock Mode (No Real Transfer)", value=True)
 
@@ -147,45 +155,29 @@ with payments_tab2:
                 st.warning("Payout not approved - pending.")
             else:
                 if destination_addr and payout_amount <= current_balance:
-                    payout_data = np.array([payout_amount]).reshape(-1, 1)
-                    fraud_model = IsolationForest(contamination=0.1)
-                    fraud_model.fit(payout_data)
-                    anomaly = fraud_model.predict(payout_data)
-                    if anomaly[0] == -1:
-                        st.warning("Potential fraud detected! Review payout.")
+                    if fraud.flag([destination_addr], [payout_amount])[0] and not approve_flagged:
+                        st.warning("Potential fraud detected! Review payout, then tick 'Send Even If Flagged' to send it.")
                     else:
-                        destination_pubkey = PublicKey.from_string(destination_addr)
-                        destination_usdc_account = get_or_create_token_account(destination_pubkey)
                         fee_estimate = 0.0001
                         net_payout = payout_amount - fee_estimate
 
                         if payout_type == "Fiat (via Stripe)":
+                            # The payout row exists before the transfer so its id keys the request
+                            payout_id = db.execute("INSERT INTO payouts (date, amount, destination, status) VALUES (?, ?, ?, 'processing')",
+                                                   (schedule_date.isoformat() if schedule_date else datetime.now().isoformat(), payout_amount, destination_addr)).lastrowid
                             try:
-                                stripe.Transfer.create(
-                                    amount=int(payout_amount * 100),
-                                    currency="usd",
-                                    destination="acct_...",
-                                )
-                                tx_sig = "stripe_mock_tx"
+                                tx_sig = stripe_exec.transfer(payout_amount, destination_addr, stripe_exec.payout_key(payout_id))['id']
                                 status = "success"
                                 st.success(f"Fiat payout sent via Stripe! Tx ID: {tx_sig}")
-                            except Exception as e:
+                            except stripe.error.StripeError as e:
+                                tx_sig, status = None, "failed"
                                 st.error(f"Stripe payout error: {e}")
+                            db.execute("UPDATE payouts SET tx_sig = ?, status = ? WHERE id = ?", (tx_sig, status, payout_id))
                         else:
                             if not mock_mode:
-                                recent_blockhash = client.get_latest_blockhash().value.blockhash
-                                instructions = [transfer_checked(TransferCheckedParams(
-                                    program_id=TOKEN_PROGRAM_ID,
-                                    source=merchant_usdc_account,
-                                    mint=USDC_MINT,
-                                    dest=destination_usdc_account,
-                                    owner=merchant_keypair.pubkey(),
-                                    amount=int(payout_amount * 10**USDC_DECIMALS),
-                                    decimals=USDC_DECIMALS
-                                ))]
-                                message = Message.new_with_blockhash(instructions, merchant_keypair.pubkey(), recent_blockhash)
-                                txn = Transaction([merchant_keypair], message, recent_blockhash)
-                                tx_sig = client.send_transaction(txn).value
+                                destination_pubkey = PublicKey.from_string(destination_addr)
+                                destination_usdc_account = get_or_create_token_accounts([destination_pubkey])[destination_pubkey]
+                                tx_sig = send_usdc(destination_usdc_account, payout_amount)
                                 status = "success"
                                 st.success(f"Payout sent! Tx Sig: {tx_sig}")
                             else:
@@ -193,11 +185,10 @@ with payments_tab2:
                                 status = "mock_success"
                                 st.success(f"Mock payout of {net_payout} USDC to {destination_addr} (fee: {fee_estimate}).")
 
-                        payout_date = schedule_date.isoformat() if schedule_date else datetime.now().isoformat()
-                        c.execute("INSERT INTO payouts (date, amount, destination, tx_sig, status) VALUES (?, ?, ?, ?, ?)",
-                                  (payout_date, payout_amount, destination_addr, tx_sig, status))
-                        conn.commit()
-                        log_audit(st.session_state['user_id'], "initiated_payout", f"Amount: {payout_amount}, Dest: {destination_addr}")
+                            payout_date = schedule_date.isoformat() if schedule_date else datetime.now().isoformat()
+                            db.execute("INSERT INTO payouts (date, amount, destination, tx_sig, status) VALUES (?, ?, ?, ?, ?)",
+                                       (payout_date, payout_amount, destination_addr, tx_sig, status))
+                        log_audit(st.session_state['user_id'], "initiated_payout", f"Amount: {payout_amount}, Dest: {destination_addr}", sync=True)
                 else:
                     st.error("Invalid address or insufficient balance.")
 
@@ -219,75 +210,58 @@ with payments_tab2:
                     st.error("Insufficient balance for batch.")
                 else:
                     st.dataframe(batch_df)
+                    # Flagged rows are left out unless the operator approves them
+                    anomalies = fraud.flag(batch_df['destination'], batch_df['amount'])
+                    if anomalies.any():
+                        st.warning(f"Potential fraud in {anomalies.sum()} payouts! Review them:")
+                        st.dataframe(batch_df[anomalies])
+                        if st.radio("Flagged Payouts", ["Exclude from batch", "Approve and send"]) == "Exclude from batch":
+                            batch_df = batch_df[~anomalies]
+                            total_batch = batch_df['amount'].sum()
                     if st.button("Process Batch"):
                         if not verified_batch:
                             st.error("Batch not verified - cannot proceed.")
                         elif not approve_batch:
                             st.warning("Batch not approved - pending.")
+                        elif batch_df.empty:
+                            st.warning("No payouts left to send.")
                         else:
-                            batch_amounts = batch_df['amount'].values.reshape(-1, 1)
-                            fraud_model = IsolationForest(contamination=0.1)
-                            fraud_model.fit(batch_amounts)
-                            anomalies = fraud_model.predict(batch_amounts)
-                            if -1 in anomalies:
-                                st.warning("Potential fraud in batch! Review amounts.")
+                            batch_method = "stripe" if batch_type == "Fiat (via Stripe)" else "usdc"
+                            batch_id = payouts.create_batch(zip(batch_df['destination'], batch_df['amount']), schedule_batch, batch_method)
+                            if schedule_batch:
+                                batch_status = "scheduled"
                             else:
-                                batch_id = datetime.now().timestamp()
-                                batch_status = "pending" if schedule_batch else "processing"
-                                batch_date = schedule_batch.isoformat() if schedule_batch else datetime.now().isoformat()
-                                tx_sigs = []
-                                for index, row in batch_df.iterrows():
-                                    dest = row['destination']
-                                    amt = row['amount']
-                                    if batch_type == "Fiat (via Stripe)":
-                                        try:
-                                            stripe.Transfer.create(
-                                                amount=int(amt * 100),
-                                                currency="usd",
-                                                destination="acct_...",
-                                            )
-                                            tx_sigs.append("stripe_mock")
-                                        except Exception as e:
-                                            tx_sigs.append("error")
-                                    else:
-                                        if not mock_batch:
-                                            dest_pubkey = PublicKey.from_string(dest)
-                                            dest_acc = get_or_create_token_account(dest_pubkey)
-                                            recent_blockhash = client.get_latest_blockhash().value.blockhash
-                                            instructions = [transfer_checked(TransferCheckedParams(
-                                                program_id=TOKEN_PROGRAM_ID,
-                                                source=merchant_usdc_account,
-                                                mint=USDC_MINT,
-                                                dest=dest_acc,
-                                                owner=merchant_keypair.pubkey(),
-                                                amount=int(amt * 10**USDC_DECIMALS),
-                                                decimals=USDC_DECIMALS
-                                            ))]
-                                            message = Message.new_with_blockhash(instructions, merchant_keypair.pubkey(), recent_blockhash)
-                                            txn = Transaction([merchant_keypair], message, recent_blockhash)
-                                            tx_sig = client.send_transaction(txn).value
-                                            tx_sigs.append(tx_sig)
-                                        else:
-                                            tx_sigs.append("mock_batch_sig")
+                                with st.spinner(f"Sending {len(batch_df)} payouts..."):
+                                    counts, batch_status = payouts.run_batch(batch_id, merchant_keypair, mock=mock_batch and batch_method == "usdc")
+                                if counts.get('failed'):
+                                    st.warning(f"{counts['failed']} payouts failed. Resume the batch below to retry them.")
+                            log_audit(st.session_state['user_id'], "processed_batch_payout", f"Total: {total_batch}, Flagged: {anomalies.sum()}", sync=True)
+                            st.success(f"Batch processed! Total: {total_batch} USDC, Status: {batch_status}")
 
-                                batch_tx_sig = ",".join(tx_sigs)
-                                c.execute("INSERT INTO payout_batches (date, status, total_amount, tx_sig) VALUES (?, ?, ?, ?)",
-                                          (batch_date, batch_status, total_batch, batch_tx_sig))
-                                conn.commit()
-                                log_audit(st.session_state['user_id'], "processed_batch_payout", f"Total: {total_batch}")
-                                st.success(f"Batch processed! Total: {total_batch} USDC, Status: {batch_status}")
+        # Batches interrupted or with failed payouts continue from their unfinished items
+        unfinished = payouts.unfinished_batches()
+        if unfinished:
+            st.subheader("Unfinished Batches")
+            resume_id = st.selectbox("Batch", unfinished, format_func=lambda batch_id: f"Batch {batch_id}: " + ", ".join(f"{n} {s}" for s, n in sorted(payouts.batch_summary(batch_id)[0].items())))
+            st.dataframe(db.read_sql("SELECT destination, amount, status, tx_sig, error FROM payout_items WHERE batch_id = ? AND status != 'confirmed'", params=(resume_id,)), use_container_width=True)
+            mock_resume = st.checkbox("Mock Mode", value=False, key="mock_resume")
+            if st.button("Resume Batch"):
+                with st.spinner("Resuming batch..."):
+                    counts, batch_status = payouts.run_batch(resume_id, merchant_keypair, mock=mock_resume)
+                log_audit(st.session_state['user_id'], "resumed_batch_payout", f"Batch: {resume_id}, Status: {batch_status}", sync=True)
+                st.success(f"Batch {resume_id}: {batch_status}")
 
     with payout_tab3:
         st.subheader("Payout History & Analytics")
-        payouts_df = pd.read_sql_query("SELECT id, date, amount, destination, status FROM payouts", conn)
-        batches_df = pd.read_sql_query("SELECT id, date, status, total_amount AS amount FROM payout_batches", conn)
+        payouts_df = db.read_sql("SELECT id, date, amount, destination, status FROM payouts")
+        batches_df = db.read_sql("SELECT id, date, status, total_amount AS amount FROM payout_batches")
         combined_df = pd.concat([payouts_df, batches_df], ignore_index=True)
         st.dataframe(combined_df, use_container_width=True)
-        if not combined_df.empty:
-            combined_df['date'] = pd.to_datetime(combined_df['date'])
-            payout_chart = alt.Chart(combined_df).mark_line().encode(
+        payout_trend = charts.payout_trend()
+        if not payout_trend.empty:
+            payout_chart = alt.Chart(payout_trend).mark_line().encode(
                 x='date:T',
-                y='sum(amount):Q',
+                y='amount:Q',
                 color='status'
             ).properties(title="Payout Trends").interactive()
             st.altair_chart(payout_chart, use_container_width=True)
\ No newline at end of file
@@ -0,0 +1,231 @@
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from solders.hash import Hash
+from solders.keypair import Keypair
+from solders.message import Message
+from solders.pubkey import Pubkey
+from solders.transaction import Transaction
+from spl.token.constants import TOKEN_PROGRAM_ID
+from spl.token.instructions import get_associated_token_address, TransferCheckedParams, transfer_checked
+import db
+import solana_rpc
+import stripe_exec
+
+# USDC batch payouts.
+# A batch is a payout_batches row plus one payout_items row per recipient, which carries that
+# recipient's status (pending -> sent -> confirmed, or failed) and transaction signature.
+# run_batch sends every pending item:
+#  - missing token accounts of all recipients are created up front, several per transaction,
+#    and confirmed before any transfer is signed; items whose account isn't on chain yet stay
+#    pending for the next run;
+#  - transfer_checked instructions are packed greedily into as few transactions as fit
+#    TX_SIZE_LIMIT;
+#  - SIGN_WAVE transactions at a time are signed with the cached blockhash and their items
+#    recorded as 'sent' with the signature in one transaction, and only then sent,
+#    SEND_CONCURRENCY at a time;
+#  - 'sent' items are settled by signature with batched getSignatureStatuses calls.
+# An item only goes back to 'failed' when the node rejected its transaction, and back to
+# 'pending' once its signature has gone unseen for DROPPED_AFTER seconds (its blockhash has
+# expired). A crash or a send that timed out leaves it 'sent', so running a batch again
+# (python payouts.py BATCH_ID) settles it by signature before signing anything new, and an
+# interrupted batch picks up where it stopped without paying anyone twice.
+# Fiat batches (method 'stripe') use the same tables and are paid through stripe_exec.
+
+TX_SIZE_LIMIT = 1232  # bytes, Solana's packet data size
+SEND_CONCURRENCY = 8
+CONFIRM_TIMEOUT = 90  # seconds
+CONFIRM_POLL = 2      # seconds
+SIGN_WAVE = 64        # transactions signed and sent per blockhash
+DROPPED_AFTER = 150   # seconds unseen after sending: its blockhash has expired, the transaction can't land
+USDC_DECIMALS = 6
+MOCK_SIGNATURE = "mock_batch_sig"
+
+
+def create_tables(cur):
+    cur.execute("""CREATE TABLE IF NOT EXISTS payout_items
+                   (id INTEGER PRIMARY KEY, batch_id INTEGER, destination TEXT, amount FLOAT, status TEXT DEFAULT 'pending', tx_sig TEXT, error TEXT, sent_at TEXT, updated_at TEXT,
+                    attempts INTEGER DEFAULT 0)""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_payout_items_batch ON payout_items (batch_id, status)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_payout_items_sig ON payout_items (tx_sig)")
+
+
+# New batch of (destination, amount) rows; returns its id. Scheduled batches are sent by the CLI once due.
+# method is 'usdc' (destinations are wallet addresses) or 'stripe' (connected account ids).
+def create_batch(rows, scheduled_date=None, method='usdc'):
+    rows = [(str(destination).strip(), float(amount)) for destination, amount in rows]
+    now = datetime.now().isoformat()
+    with db.transaction() as cur:
+        cur.execute("INSERT INTO payout_batches (date, status, total_amount, method) VALUES (?, ?, ?, ?)",
+                    (scheduled_date.isoformat() if scheduled_date else now, 'scheduled' if scheduled_date else 'processing', sum(amount for _, amount in rows), method))
+        batch_id = cur.lastrowid
+        cur.executemany("INSERT INTO payout_items (batch_id, destination, amount, updated_at) VALUES (?, ?, ?, ?)",
+                        [(batch_id, destination, amount, now) for destination, amount in rows])
+    return batch_id
+
+
+def _set_status(item_ids, status, tx_sig=None, error=None, sent=False):
+    now = datetime.now().isoformat()
+    with db.transaction() as cur:
+        cur.executemany("UPDATE payout_items SET status = ?, tx_sig = COALESCE(?, tx_sig), error = ?, sent_at = CASE WHEN ? THEN ? ELSE sent_at END, updated_at = ? WHERE id = ?",
+                        [(status, tx_sig, error, sent, now, now, item_id) for item_id in item_ids])
+
+
+def _tx_size(instructions, payer):
+    return len(bytes(Transaction.new_unsigned(Message.new_with_blockhash(instructions, payer, Hash.default()))))
+
+
+# Group [(item_id, instruction)] into transactions that fit TX_SIZE_LIMIT
+def pack(transfers, payer):
+    groups, current = [], []
+    for transfer in transfers:
+        if current and _tx_size([ix for _, ix in current + [transfer]], payer) > TX_SIZE_LIMIT:
+            groups.append(current)
+            current = []
+        current.append(transfer)
+    if current:
+        groups.append(current)
+    return groups
+
+
+# Sign packed transactions and record their items as 'sent' with the signatures, before any is sent
+def _sign(groups, payer):
+    blockhash = solana_rpc.latest_blockhash()
+    txns = [Transaction([payer], Message.new_with_blockhash([ix for _, ix in group], payer.pubkey(), blockhash), blockhash) for group in groups]
+    now = datetime.now().isoformat()
+    with db.transaction() as cur:
+        cur.executemany("UPDATE payout_items SET status = 'sent', tx_sig = ?, error = NULL, sent_at = ?, updated_at = ? WHERE id = ?",
+                        [(str(txn.signatures[0]), now, now, item_id) for group, txn in zip(groups, txns) for item_id, _ in group])
+    return txns
+
+
+# Send one recorded transaction; returns the node's error if it rejected it (preflight: it can't land), else None.
+# Anything else (a timeout, a bad reply) may have reached the cluster, so its items stay 'sent' to be settled by signature.
+def _send_group(txn):
+    try:
+        solana_rpc.send_transaction(txn)
+    except solana_rpc.RpcError as e:
+        return str(e)
+    except Exception as e:
+        print(f"Payout transaction {txn.signatures[0]} may not have been sent, settling by signature: {e}")
+    return None
+
+
+# Settle 'sent' items from their signatures; returns how many are still in flight.
+# The full history is searched, so a transaction that landed long ago is never taken for a dropped one.
+def _check_sent(batch_id):
+    sent = db.query("SELECT id, tx_sig, sent_at FROM payout_items WHERE batch_id = ? AND status = 'sent'", (batch_id,))
+    if not sent:
+        return 0
+    statuses = solana_rpc.signature_statuses({tx_sig for _, tx_sig, _ in sent}, search_history=True)
+    dropped_before = (datetime.now() - timedelta(seconds=DROPPED_AFTER)).isoformat()
+    confirmed, failed, dropped, in_flight = [], {}, [], 0
+    for item_id, tx_sig, sent_at in sent:
+        status = statuses.get(tx_sig)
+        if status is None:
+            if (sent_at or '') < dropped_before:
+                dropped.append(item_id)
+            else:
+                in_flight += 1
+        elif status.get('err') is not None:
+            failed.setdefault(json.dumps(status['err']), []).append(item_id)
+        elif status.get('confirmationStatus') in ('confirmed', 'finalized'):
+            confirmed.append(item_id)
+        else:
+            in_flight += 1
+    if confirmed:
+        _set_status(confirmed, 'confirmed')
+    for error, item_ids in failed.items():
+        _set_status(item_ids, 'failed', error=error)
+    if dropped:
+        _set_status(dropped, 'pending', error="transaction dropped")
+    return in_flight
+
+
+def _send_pending(batch_id, payer):
+    items = db.query("SELECT id, destination, amount FROM payout_items WHERE batch_id = ? AND status IN ('pending', 'failed') ORDER BY id", (batch_id,))
+    if not items:
+        return
+    owners, invalid = {}, []
+    for item_id, destination, amount in items:
+        try:
+            owners[item_id] = Pubkey.from_string(destination)
+        except ValueError:
+            invalid.append(item_id)
+    if invalid:
+        _set_status(invalid, 'failed', error="invalid destination address")
+    accounts = solana_rpc.ensure_token_accounts(set(owners.values()), payer, solana_rpc.USDC_MINT)
+    no_account = [item_id for item_id, owner in owners.items() if owner not in accounts]
+    if no_account:
+        _set_status(no_account, 'pending', error="token account not created yet")
+    source = get_associated_token_address(payer.pubkey(), solana_rpc.USDC_MINT)
+    transfers = [(item_id, transfer_checked(TransferCheckedParams(
+                    program_id=TOKEN_PROGRAM_ID, source=source, mint=solana_rpc.USDC_MINT, dest=accounts[owners[item_id]],
+                    owner=payer.pubkey(), amount=int(round(amount * 10**USDC_DECIMALS)), decimals=USDC_DECIMALS)))
+                 for item_id, _, amount in items if item_id in owners and owners[item_id] in accounts]
+    groups = pack(transfers, payer.pubkey())
+    with ThreadPoolExecutor(max_workers=SEND_CONCURRENCY) as pool:
+        for i in range(0, len(groups), SIGN_WAVE):
+            wave = groups[i:i + SIGN_WAVE]
+            for group, error in zip(wave, pool.map(_send_group, _sign(wave, payer))):
+                if error:
+                    _set_status([item_id for item_id, _ in group], 'failed', error=error)
+    solana_rpc.invalidate_balance(source)
+
+
+# Item counts per status, and the batch status they add up to
+def batch_summary(batch_id):
+    counts = dict(db.query("SELECT status, COUNT(*) FROM payout_items WHERE batch_id = ? GROUP BY status", (batch_id,)))
+    if counts.get('pending') or counts.get('sent'):
+        status = 'processing'
+    elif counts.get('failed'):
+        status = 'partial'
+    else:
+        status = 'completed'
+    return counts, status
+
+
+# Send (or resume) a batch, USDC ones paid by payer; returns (item counts per status, batch status)
+def run_batch(batch_id, payer=None, mock=False):
+    db.execute("UPDATE payout_batches SET status = 'processing' WHERE id = ?", (batch_id,))
+    if db.query_one("SELECT method FROM payout_batches WHERE id = ?", (batch_id,))[0] == 'stripe':
+        stripe_exec.run_batch(batch_id, mock)
+    elif mock:
+        ids = [row[0] for row in db.query("SELECT id FROM payout_items WHERE batch_id = ? AND status IN ('pending', 'failed')", (batch_id,))]
+        _set_status(ids, 'confirmed', tx_sig=MOCK_SIGNATURE)
+    elif payer is None:
+        raise ValueError(f"batch {batch_id} is a USDC batch and needs the paying wallet")
+    else:
+        _check_sent(batch_id)
+        _send_pending(batch_id, payer)
+        deadline = time.monotonic() + CONFIRM_TIMEOUT
+        while _check_sent(batch_id) and time.monotonic() < deadline:
+            time.sleep(CONFIRM_POLL)
+    counts, status = batch_summary(batch_id)
+    db.execute("UPDATE payout_batches SET status = ? WHERE id = ?", (status, batch_id))
+    return counts, status
+
+
+# Batches still to send: scheduled ones that are due and ones left unfinished
+def unfinished_batches(now=None):
+    now = now or datetime.now()
+    return [row[0] for row in db.query("""SELECT b.id FROM payout_batches b
+                                          WHERE ((b.status = 'scheduled' AND b.date <= ?) OR b.status IN ('processing', 'partial'))
+                                                AND EXISTS (SELECT 1 FROM payout_items i WHERE i.batch_id = b.id) ORDER BY b.id""", (now.isoformat(),))]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Send or resume USDC batch payouts.")
+    parser.add_argument('batch_ids', type=int, nargs='*', help="Batches to run (default: due and unfinished ones)")
+    parser.add_argument('--wallet', default=None, help="Path to the paying wallet's keypair JSON (needed for USDC batches)")
+    parser.add_argument('--mock', action='store_true', help="Mark items paid without sending anything")
+    args = parser.parse_args()
+    payer = None
+    if args.wallet:
+        with open(args.wallet) as f:
+            payer = Keypair.from_bytes(bytes(json.load(f)))
+    for batch_id in args.batch_ids or unfinished_batches():
+        counts, status = run_batch(batch_id, payer, args.mock)
+        print(f"Batch {batch_id}: {status} ({', '.join(f'{n} {s}' for s, n in sorted(counts.items()))})")
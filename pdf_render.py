@@ -0,0 +1,231 @@
+import argparse
+import hashlib
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from reportlab.pdfgen import canvas
+from reportlab.pdfbase import pdfmetrics
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.units import inch
+from reportlab.lib.utils import ImageReader
+import db
+
+# Invoice PDF rendering.
+# A rendered PDF is stored under CACHE_DIR, named by a hash of the invoice's printed content
+# and the invoice_settings version (a hash of the settings row), so an invoice is drawn again
+# only when its data or the branding changes. Batches render the missing PDFs across a
+# process pool; each worker loads the font and the logo once when it starts. The pool spawns
+# fresh interpreters rather than forking, since the app process runs many threads. Renders in
+# the app's own process (a single invoice) get the settings passed in, so concurrent sessions
+# never share them. Rendered files are then zipped in invoice order.
+# Using a cached PDF touches it; at most every PRUNE_INTERVAL seconds, PDFs unused for
+# CACHE_MAX_DAYS are deleted, then the least recently used until the cache fits CACHE_MAX_MB.
+
+CACHE_DIR = os.environ.get('STUNR_PDF_CACHE', os.path.join(tempfile.gettempdir(), 'stunr_pdf_cache'))
+CACHE_MAX_DAYS = int(os.environ.get('STUNR_PDF_CACHE_DAYS', 30))
+CACHE_MAX_MB = int(os.environ.get('STUNR_PDF_CACHE_MB', 1024))
+PRUNE_INTERVAL = 3600  # seconds
+CHUNK_SIZE = 64  # invoices handed to a worker at a time
+
+# Everything printed on an invoice, in print order
+INVOICE_SQL = """SELECT i.id, i.sub_id, i.date, i.amount, i.due_date, s.customer_id, c.name, c.email, c.address
+                 FROM invoices i JOIN subscriptions s ON i.sub_id = s.id JOIN customers c ON s.customer_id = c.id"""
+
+# Per-process state of pool workers, set by _init_worker
+_settings = None
+_logo = None
+
+_last_prune = 0.0
+_prune_lock = threading.Lock()
+
+
+def settings_version(settings):
+    return hashlib.sha256(repr(tuple(settings)).encode()).hexdigest()[:16]
+
+
+def cache_path(row, version):
+    digest = hashlib.sha256(f"{version}|{tuple(row)!r}".encode()).hexdigest()
+    return os.path.join(CACHE_DIR, digest[:2], f"{digest}.pdf")
+
+
+# Delete PDFs unused for CACHE_MAX_DAYS, then the least recently used over CACHE_MAX_MB.
+# Returns the number of files deleted.
+def prune_cache(now=None):
+    now = now or time.time()
+    files = []
+    for root, _, names in os.walk(CACHE_DIR):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+    files.sort()
+    budget = sum(size for _, size, _ in files) - CACHE_MAX_MB * 1024 * 1024
+    deleted = 0
+    for mtime, size, path in files:
+        if mtime >= now - CACHE_MAX_DAYS * 86400 and budget <= 0:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        budget -= size
+        deleted += 1
+    return deleted
+
+
+def _maybe_prune():
+    global _last_prune
+    if time.time() - _last_prune < PRUNE_INTERVAL or not _prune_lock.acquire(blocking=False):
+        return
+    try:
+        _last_prune = time.time()
+        prune_cache()
+    except Exception as e:
+        print(f"PDF cache pruning failed: {e}")
+    finally:
+        _prune_lock.release()
+
+
+# Use a cached PDF: True (and marked as recently used) when it exists
+def _cached(path):
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+
+# Check the font and load the logo of settings; returns the logo (None without one)
+def _load_branding(settings):
+    pdfmetrics.getFont(settings[6])
+    if settings[3]:
+        try:
+            return ImageReader(settings[3])
+        except Exception as e:
+            print(f"Invoice logo {settings[3]} could not be loaded: {e}")
+    return None
+
+
+# Load the font and logo once for this worker process
+def _init_worker(settings):
+    global _settings, _logo
+    _settings, _logo = settings, _load_branding(settings)
+
+
+def draw_invoice(row, settings, logo=None):
+    invoice_id, sub_id, issue_date, amount, due_date, customer_id, customer_name, customer_email, customer_address = row
+    buffer = io.BytesIO()
+    can = canvas.Canvas(buffer, pagesize=letter)
+    if logo is not None:
+        can.drawImage(logo, 6 * inch, 9.6 * inch, width=1.5 * inch, height=0.75 * inch, preserveAspectRatio=True, mask='auto')
+    can.setFont(settings[6], 16)
+    can.drawString(inch, 10 * inch, settings[1])  # Company Name
+    can.drawString(inch, 9.5 * inch, settings[2])  # Company Address
+    can.line(inch, 9 * inch, 6 * inch, 9 * inch)
+    can.drawString(inch, 8.5 * inch, f"Invoice #: {invoice_id}")
+    can.drawString(inch, 8 * inch, f"Date: {issue_date}")
+    can.drawString(inch, 7.5 * inch, f"Due Date: {due_date}")
+    can.drawString(4 * inch, 8.5 * inch, f"Bill To:")
+    can.drawString(4 * inch, 8 * inch, customer_name or "")
+    can.drawString(4 * inch, 7.5 * inch, customer_email or "")
+    can.drawString(4 * inch, 7 * inch, customer_address or "")
+    can.line(inch, 6.5 * inch, 6 * inch, 6.5 * inch)
+    can.drawString(inch, 6 * inch, "Description")
+    can.drawString(4 * inch, 6 * inch, "Amount")
+    can.line(inch, 5.5 * inch, 6 * inch, 5.5 * inch)
+    can.drawString(inch, 5 * inch, "Subscription Fee")
+    can.drawString(4 * inch, 5 * inch, f"${amount} USDC")
+    can.line(inch, 4.5 * inch, 6 * inch, 4.5 * inch)
+    can.drawString(4 * inch, 4 * inch, f"Total: ${amount} USDC")
+    can.setFont(settings[6], 10)
+    can.drawString(inch, 3 * inch, settings[4])  # Footer Text
+    can.showPage()
+    can.save()
+    return buffer.getvalue()
+
+
+# Render one invoice into the cache
+def _render_to(row, path, settings, logo):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    with open(tmp_path, 'wb') as f:
+        f.write(draw_invoice(row, settings, logo))
+    os.replace(tmp_path, path)
+    return path
+
+
+# Render one invoice in a pool worker, with the branding its initializer loaded
+def _render_in_worker(row, path):
+    return _render_to(row, path, _settings, _logo)
+
+
+# PDF bytes of one invoice, from the cache when it is up to date
+def render_invoice(invoice_id):
+    row = db.query_one(f"{INVOICE_SQL} WHERE i.id = ?", (invoice_id,))
+    if row is None:
+        return None
+    settings = db.get_invoice_settings()
+    path = cache_path(row, settings_version(settings))
+    if not _cached(path):
+        _render_to(row, path, settings, _load_branding(settings))
+    with open(path, 'rb') as f:
+        pdf = f.read()
+    _maybe_prune()
+    return pdf
+
+
+def _invoice_rows(org_id, start_date=None, end_date=None, status=None):
+    sql, params = f"{INVOICE_SQL} WHERE i.org_id = ?", [org_id]
+    if start_date is not None:
+        sql += " AND i.date >= ?"
+        params.append(str(start_date))
+    if end_date is not None:
+        sql += " AND i.date <= ?"
+        params.append(str(end_date) + '~')  # whole end day
+    if status is not None:
+        sql += " AND i.status = ?"
+        params.append(status)
+    return db.query(sql + " ORDER BY i.id", params)
+
+
+# Render an org's invoices in a date range / status into a ZIP at zip_path.
+# Returns (invoices in the ZIP, PDFs that had to be rendered).
+def render_batch(org_id, zip_path, start_date=None, end_date=None, status=None, workers=None):
+    rows = _invoice_rows(org_id, start_date, end_date, status)
+    settings = db.get_invoice_settings()
+    version = settings_version(settings)
+    paths = [cache_path(row, version) for row in rows]
+    missing = [(row, path) for row, path in zip(rows, paths) if not _cached(path)]
+    if len(missing) == 1:
+        _render_to(*missing[0], settings, _load_branding(settings))
+    elif missing:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker, initargs=(tuple(settings),)) as pool:
+            list(pool.map(_render_in_worker, [row for row, _ in missing], [path for _, path in missing], chunksize=CHUNK_SIZE))
+    # PDF page streams are already compressed, so the entries are stored as-is
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zf:
+        for row, path in zip(rows, paths):
+            zf.write(path, f"invoice_{row[0]}.pdf")
+    _maybe_prune()
+    return len(rows), len(missing)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render invoice PDFs into a ZIP (e.g. at month end).")
+    parser.add_argument('--org-id', type=int, required=True)
+    parser.add_argument('--start', help="First issue date (YYYY-MM-DD)")
+    parser.add_argument('--end', help="Last issue date (YYYY-MM-DD)")
+    parser.add_argument('--status', help="Only invoices with this status (open, paid)")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: one per CPU)")
+    parser.add_argument('--out', default='invoices.zip')
+    args = parser.parse_args()
+    total, rendered = render_batch(args.org_id, args.out, args.start, args.end, args.status, args.workers)
+    print(f"{total} invoices written to {args.out} ({rendered} rendered, {total - rendered} from cache)")
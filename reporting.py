@@ -2,30 +2,22 @@ import streamlit as st
 import pandas as pd
 import altair as alt
 from datetime import datetime, timedelta
-import sqlite3
-
-# Initialize database connection
-conn = sqlite3.connect('stunr_db.sqlite', check_same_thread=False)
-c = conn.cursor()
-
-# Audit logging function
-def log_audit(user_id, action, details):
-    timestamp = datetime.now().isoformat()
-    c.execute("INSERT INTO audit_logs (user_id, action, details, timestamp) VALUES (?, ?, ?, ?)",
-              (user_id, action, details, timestamp))
-    conn.commit()
-    st.write(f"Audit Log: {action} - {details} at {timestamp}")  # Optional feedback
+import db
+import metrics
+import rollups
+import cohorts
+import charts
 
 st.header("Reporting")
-report_tab1, report_tab2 = st.tabs(["Revenue Report", "Custom Report"])
+report_tab1, report_tab2, report_tab3 = st.tabs(["Revenue Report", "Custom Report", "Cohort Retention"])
 
 with report_tab1:
     st.subheader("Revenue Report")
     start_date = st.date_input("Start Date", value=datetime.now() - timedelta(days=30))
     end_date = st.date_input("End Date", value=datetime.now())
     if start_date and end_date and start_date <= end_date:
-        recognized_df = pd.read_sql_query("SELECT month AS Month, SUM(recognized_amount) AS 'Recognized Revenue (USDC)' FROM recognized_revenue WHERE sub_id IN (SELECT id FROM subscriptions WHERE customer_id IN (SELECT id FROM customers WHERE org_id = ?)) AND month BETWEEN ? AND ? GROUP BY month", conn, params=(st.session_state['org_id'], start_date.strftime('%Y-%m'), end_date.strftime('%Y-%m')))
-        deferred_df = pd.read_sql_query("SELECT start_date AS 'Start Date', end_date AS 'End Date', SUM(amount) AS 'Deferred Revenue (USDC)' FROM deferred_revenue WHERE sub_id IN (SELECT id FROM subscriptions WHERE customer_id IN (SELECT id FROM customers WHERE org_id = ?)) AND start_date BETWEEN ? AND ? GROUP BY start_date, end_date", conn, params=(st.session_state['org_id'], start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')))
+        recognized_df = charts.recognized_revenue(st.session_state['org_id'], start_date.strftime('%Y-%m'), end_date.strftime('%Y-%m'))
+        deferred_df = db.read_sql(f"SELECT start_date AS 'Start Date', end_date AS 'End Date', {metrics.DEFERRED_BALANCE} AS 'Deferred Revenue (USDC)' FROM deferred_revenue WHERE org_id = ? AND start_date BETWEEN ? AND ? GROUP BY start_date, end_date", params=(st.session_state['org_id'], start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')))
         if not recognized_df.empty:
             st.subheader("Recognized Revenue")
             st.dataframe(recognized_df, use_container_width=True, hide_index=True)
@@ -53,11 +45,10 @@ with report_tab2:
             start_date = end_date - timedelta(days=90)
         else:
             start_date = datetime(1970, 1, 1)  # All time
-        subs_df = pd.read_sql_query("SELECT id, customer_id, plan, amount, start_date, status FROM subscriptions WHERE customer_id IN (SELECT id FROM customers WHERE org_id = ?) AND start_date BETWEEN ? AND ?", conn, params=(st.session_state['org_id'], start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')))
-        invoices_df = pd.read_sql_query("SELECT sub_id, date, amount, status FROM invoices WHERE sub_id IN (SELECT id FROM subscriptions WHERE customer_id IN (SELECT id FROM customers WHERE org_id = ?)) AND date BETWEEN ? AND ?", conn, params=(st.session_state['org_id'], start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')))
-        if not subs_df.empty and not invoices_df.empty:
+        subs_df = db.read_sql("SELECT id, customer_id, plan, amount, start_date, status FROM subscriptions WHERE org_id = ? AND start_date BETWEEN ? AND ?", params=(st.session_state['org_id'], start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')))
+        invoice_count, _, _, paid_amount, _, _ = rollups.revenue_between(st.session_state['org_id'], start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+        if not subs_df.empty and invoice_count > 0:
             subs_df['start_date'] = pd.to_datetime(subs_df['start_date'])
-            invoices_df['date'] = pd.to_datetime(invoices_df['date'])
             if metric == "Active Subscriptions":
                 active_subs = len(subs_df[subs_df['status'] == 'active'])
                 st.write(f"Active Subscriptions: {active_subs}")
@@ -70,10 +61,26 @@ with report_tab2:
                 churn_rate = (total_canceled / total_subs * 100) if total_subs > 0 else 0.0
                 st.write(f"Churn Rate: {churn_rate:.1f}%")
             elif metric == "Total Revenue":
-                total_revenue = invoices_df[invoices_df['status'] == 'paid']['amount'].sum()
+                total_revenue = paid_amount
                 st.write(f"Total Revenue: ${total_revenue:.2f} USDC")
             elif metric == "Deferred Revenue":
-                deferred_total = pd.read_sql_query("SELECT SUM(amount) as total FROM deferred_revenue WHERE sub_id IN (SELECT id FROM subscriptions WHERE customer_id IN (SELECT id FROM customers WHERE org_id = ?)) AND start_date BETWEEN ? AND ?", conn, params=(st.session_state['org_id'], start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')))['total'].iloc[0] if not pd.read_sql_query("SELECT SUM(amount) as total FROM deferred_revenue WHERE sub_id IN (SELECT id FROM subscriptions WHERE customer_id IN (SELECT id FROM customers WHERE org_id = ?)) AND start_date BETWEEN ? AND ?", conn, params=(st.session_state['org_id'], start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))).empty else 0.0
+                deferred_total = metrics.deferred_total(st.session_state['org_id'], start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
                 st.write(f"Deferred Revenue: ${deferred_total:.2f} USDC")
         else:
-            st.write("No data available for the selected period.")
\ No newline at end of file
+            st.write("No data available for the selected period.")
+
+with report_tab3:
+    st.subheader("Cohort Retention")
+    max_cohorts = st.slider("Cohorts (months)", min_value=3, max_value=cohorts.MAX_COHORTS, value=12)
+    show_counts = st.checkbox("Show active subscription counts instead of %")
+    retention_df, cohort_sizes = cohorts.retention_matrix(st.session_state['org_id'], max_cohorts=max_cohorts)
+    if not retention_df.empty:
+        table = retention_df.multiply(cohort_sizes, axis=0).div(100).round() if show_counts else retention_df.round(1)
+        table.insert(0, 'Cohort Size', cohort_sizes)
+        st.dataframe(table, use_container_width=True)
+        curve = retention_df.mean(axis=0).reset_index()
+        curve.columns = ['Period', 'Retention (%)']
+        chart = alt.Chart(curve).mark_line(point=True).encode(x='Period:O', y='Retention (%):Q', color=alt.value('#04837b')).properties(title="Average Retention by Months Since Start").interactive()
+        st.altair_chart(chart, use_container_width=True)
+    else:
+        st.write("No subscription data for cohorts.")
\ No newline at end of file
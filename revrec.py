@@ -0,0 +1,142 @@
+import argparse
+from datetime import date, datetime, timedelta
+import numpy as np
+import db
+
+# Revenue recognition.
+# Every invoice gets a deferred_revenue schedule for its pre-tax amount over the service
+# period it bills: the billing period for invoices from a billing run, otherwise one month
+# from the invoice date.
+# Recognizing a month spreads each schedule overlapping it by day: the amount recognized by
+# the end of the month is amount * days served / days in the schedule, rounded to the cent,
+# and the month gets the difference to the amount recognized by its start, so a schedule's
+# months always add up to its amount. One month is computed for all schedules in a single
+# NumPy pass and replaces only that month's rows in recognized_revenue, so a closed month can
+# be recomputed without touching any other month. deferred_revenue.recognized_amount and
+# status are brought up to date for the schedules the month touched.
+# Invoices from before revenue recognition were recognized in full when issued: their
+# deferred_revenue rows are linked to the invoice and marked 'legacy' (retire_legacy, run by
+# the migration), and their recognized_revenue rows (deferred_id NULL) stay as they are. Such
+# invoices are never scheduled again and legacy schedules are never recognized, so no month
+# counts an invoice twice.
+
+RECOGNIZED_EPSILON = 0.005
+
+
+def create_tables(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS revenue_recognition_runs (month TEXT PRIMARY KEY, computed_at TEXT, schedules INTEGER, recognized_amount FLOAT)")
+
+
+def month_bounds(month):
+    start = datetime.strptime(month, '%Y-%m').date()
+    return start, (start + timedelta(days=32)).replace(day=1)
+
+
+# Link schedules from before revenue recognition (no invoice_id) to the invoice they were made
+# for (same subscription, issued the same day) and mark them 'legacy'; returns how many
+def retire_legacy(cur):
+    invoices = {}
+    for invoice_id, sub_id, day in cur.execute("""SELECT id, sub_id, substr(date, 1, 10) FROM invoices
+                                                  WHERE id NOT IN (SELECT invoice_id FROM deferred_revenue WHERE invoice_id IS NOT NULL) ORDER BY id""").fetchall():
+        invoices.setdefault((sub_id, day), []).append(invoice_id)
+    links = []
+    for deferred_id, sub_id, day in cur.execute("SELECT id, sub_id, substr(start_date, 1, 10) FROM deferred_revenue WHERE invoice_id IS NULL ORDER BY id").fetchall():
+        candidates = invoices.get((sub_id, day))
+        links.append((candidates.pop(0) if candidates else None, deferred_id))
+    cur.executemany("UPDATE deferred_revenue SET invoice_id = ?, status = 'legacy' WHERE id = ?", links)
+    return len(links)
+
+
+# Create the missing schedules for invoices; returns how many were created
+def schedule_invoices(org_id=None):
+    start = "CASE WHEN i.period IS NOT NULL THEN i.period || '-01' ELSE substr(i.date, 1, 10) END"
+    sql = f"""INSERT INTO deferred_revenue (sub_id, invoice_id, amount, start_date, end_date, status, org_id, recognized_amount)
+              SELECT i.sub_id, i.id, COALESCE(i.net_amount, i.amount), {start}, date({start}, '+1 month'), 'deferred', i.org_id, 0
+              FROM invoices i
+              WHERE i.date IS NOT NULL AND i.amount IS NOT NULL AND NOT EXISTS (SELECT 1 FROM deferred_revenue d WHERE d.invoice_id = i.id)"""
+    params = []
+    if org_id is not None:
+        sql += " AND i.org_id = ?"
+        params.append(org_id)
+    with db.transaction() as cur:
+        cur.execute(sql, params)
+        return cur.rowcount
+
+
+# Amount recognized in [month_start, month_end) per schedule. Returns (recognized, prorated).
+def recognize(amount, start_day, end_day, month_start, month_end):
+    total = np.maximum((end_day - start_day).astype(np.int64), 1)
+    by_start = np.clip((np.minimum(end_day, np.datetime64(month_start)) - start_day).astype(np.int64), 0, total)
+    by_end = np.clip((np.minimum(end_day, np.datetime64(month_end)) - start_day).astype(np.int64), 0, total)
+    recognized = np.round(amount * by_end / total, 2) - np.round(amount * by_start / total, 2)
+    month_days = (np.datetime64(month_end) - np.datetime64(month_start)).astype(np.int64)
+    return recognized, (by_end - by_start) < month_days
+
+
+# Recompute one month ('YYYY-MM'); returns (schedules recognized, amount recognized)
+def recognize_month(month, org_id=None, schedule=True):
+    if schedule:
+        schedule_invoices(org_id)
+    month_start, month_end = month_bounds(month)
+    sql = """SELECT id, sub_id, org_id, amount, substr(start_date, 1, 10), substr(end_date, 1, 10) FROM deferred_revenue
+             WHERE end_date > ? AND start_date < ? AND amount IS NOT NULL AND status IS NOT 'legacy'"""
+    params = [month_start.isoformat(), month_end.isoformat()]
+    org_filter, org_params = "", []
+    if org_id is not None:
+        org_filter, org_params = " AND org_id = ?", [org_id]
+    rows = db.query(sql + org_filter, params + org_params)
+
+    inserts, recognized_by_id, total = [], {}, 0.0
+    if rows:
+        ids, sub_ids, org_ids, amount, starts, ends = zip(*rows)
+        recognized, prorated = recognize(np.array(amount, dtype=float), np.array(starts, dtype='datetime64[D]'),
+                                         np.array(ends, dtype='datetime64[D]'), month_start, month_end)
+        keep = np.flatnonzero(recognized != 0)
+        inserts = [(ids[i], sub_ids[i], org_ids[i], month, amount[i], float(recognized[i]), bool(prorated[i])) for i in keep.tolist()]
+        recognized_by_id = {ids[i]: float(recognized[i]) for i in keep.tolist()}
+        total = float(recognized[keep].sum())
+
+    with db.transaction() as cur:
+        # Deferred balances move by the difference between the month's new and old amounts
+        cur.execute(f"SELECT deferred_id, recognized_amount FROM recognized_revenue WHERE month = ? AND deferred_id IS NOT NULL{org_filter}", [month] + org_params)
+        previous = dict(cur.fetchall())
+        deltas = [(round(recognized_by_id.get(i, 0.0) - previous.get(i, 0.0), 2), i) for i in recognized_by_id.keys() | previous.keys()]
+        cur.execute(f"DELETE FROM recognized_revenue WHERE month = ? AND deferred_id IS NOT NULL{org_filter}", [month] + org_params)
+        cur.executemany("INSERT INTO recognized_revenue (deferred_id, sub_id, org_id, month, amount, recognized_amount, prorated) VALUES (?, ?, ?, ?, ?, ?, ?)", inserts)
+        cur.executemany(f"""UPDATE deferred_revenue SET recognized_amount = round(COALESCE(recognized_amount, 0) + ?1, 2),
+                                   status = CASE WHEN COALESCE(recognized_amount, 0) + ?1 >= amount - {RECOGNIZED_EPSILON} THEN 'recognized'
+                                                 WHEN COALESCE(recognized_amount, 0) + ?1 > 0 THEN 'recognizing' ELSE 'deferred' END
+                            WHERE id = ?2""", [d for d in deltas if d[0] != 0])
+        if org_id is None:
+            cur.execute("INSERT INTO revenue_recognition_runs (month, computed_at, schedules, recognized_amount) VALUES (?, ?, ?, ?) ON CONFLICT (month) DO UPDATE SET computed_at = excluded.computed_at, schedules = excluded.schedules, recognized_amount = excluded.recognized_amount",
+                        (month, datetime.now().isoformat(), len(inserts), total))
+    return len(inserts), round(total, 2)
+
+
+# Recognize every month after the last one computed, up to and including through_month
+# (default: the current month). The current month is always recomputed.
+def catch_up(through_month=None):
+    through_month = through_month or date.today().strftime('%Y-%m')
+    schedule_invoices()
+    last = db.query_one("SELECT MAX(month) FROM revenue_recognition_runs WHERE month < ?", (through_month,))[0]
+    if last is None:
+        first = db.query_one("SELECT MIN(substr(start_date, 1, 7)) FROM deferred_revenue")[0]
+        first = first or through_month
+    else:
+        first = (month_bounds(last)[1]).strftime('%Y-%m')
+    results = {}
+    month = min(first, through_month)
+    while month <= through_month:
+        results[month] = recognize_month(month, schedule=False)
+        month = month_bounds(month)[1].strftime('%Y-%m')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Recognize deferred revenue month by month.")
+    parser.add_argument('--month', default=None, help="Recompute only this month (YYYY-MM), e.g. after a late invoice in a closed month")
+    parser.add_argument('--through', default=None, help="Catch up through this month (default: current month)")
+    args = parser.parse_args()
+    results = {args.month: recognize_month(args.month)} if args.month else catch_up(args.through)
+    for month, (schedules, amount) in results.items():
+        print(f"{month}: {schedules} schedules, {amount:.2f} USDC recognized")
@@ -0,0 +1,114 @@
+import argparse
+import cache
+import db
+
+# Materialized per-org revenue rollups.
+# revenue_monthly / revenue_daily hold invoice counts and invoiced/paid/open totals per bucket and
+# recognized_revenue_monthly holds recognized revenue per month. Triggers (installed by
+# migration 5) apply every invoice/recognition insert, update and delete as a delta, so pages
+# read a few hundred rollup rows instead of scanning history. rebuild() recomputes from scratch.
+
+INVOICE_ROLLUPS = [
+    # (table, bucket column, bucket expression over an invoice date)
+    ('revenue_monthly', 'month', "substr({date}, 1, 7)"),
+    ('revenue_daily', 'day', "substr({date}, 1, 10)"),
+]
+
+INVOICE_MEASURES = ['invoice_count', 'invoiced_amount', 'paid_count', 'paid_amount', 'open_count', 'open_amount']
+
+
+def _invoice_values(row):
+    amount = f"COALESCE({row}.amount, 0)"
+    return [
+        "1",
+        amount,
+        f"({row}.status = 'paid')",
+        f"CASE WHEN {row}.status = 'paid' THEN {amount} ELSE 0 END",
+        f"({row}.status = 'open')",
+        f"CASE WHEN {row}.status = 'open' THEN {amount} ELSE 0 END",
+    ]
+
+
+def create_tables(cur):
+    for table, bucket, _ in INVOICE_ROLLUPS:
+        cur.execute(f"""CREATE TABLE IF NOT EXISTS {table}
+                        (org_id INTEGER, {bucket} TEXT, invoice_count INTEGER DEFAULT 0, invoiced_amount FLOAT DEFAULT 0,
+                         paid_count INTEGER DEFAULT 0, paid_amount FLOAT DEFAULT 0, open_count INTEGER DEFAULT 0, open_amount FLOAT DEFAULT 0,
+                         PRIMARY KEY (org_id, {bucket})) WITHOUT ROWID""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS recognized_revenue_monthly
+                   (org_id INTEGER, month TEXT, recognized_amount FLOAT DEFAULT 0, PRIMARY KEY (org_id, month)) WITHOUT ROWID""")
+
+
+# Upsert statement that adds (sign=+1) or removes (sign=-1) one invoice row's contribution
+def _invoice_delta(table, bucket, bucket_expr, row, sign):
+    values = _invoice_values(row)
+    signed = [f"{'-' if sign < 0 else ''}{value}" for value in values]
+    updates = ", ".join(f"{m} = {m} + excluded.{m}" for m in INVOICE_MEASURES)
+    return (f"INSERT INTO {table} (org_id, {bucket}, {', '.join(INVOICE_MEASURES)}) "
+            f"SELECT {row}.org_id, {bucket_expr.format(date=row + '.date')}, {', '.join(signed)} "
+            f"WHERE {row}.org_id IS NOT NULL AND {row}.date IS NOT NULL "
+            f"ON CONFLICT (org_id, {bucket}) DO UPDATE SET {updates};")
+
+
+def _recognized_delta(row, sign):
+    amount = f"{'-' if sign < 0 else ''}COALESCE({row}.recognized_amount, 0)"
+    return (f"INSERT INTO recognized_revenue_monthly (org_id, month, recognized_amount) "
+            f"SELECT {row}.org_id, substr({row}.month, 1, 7), {amount} "
+            f"WHERE {row}.org_id IS NOT NULL AND {row}.month IS NOT NULL "
+            f"ON CONFLICT (org_id, month) DO UPDATE SET recognized_amount = recognized_amount + excluded.recognized_amount;")
+
+
+# Rows inserted without org_id get it from the org_id triggers, which then fire the UPDATE trigger here
+def create_triggers(cur):
+    add_new = "\n".join(_invoice_delta(t, b, e, 'NEW', 1) for t, b, e in INVOICE_ROLLUPS)
+    remove_old = "\n".join(_invoice_delta(t, b, e, 'OLD', -1) for t, b, e in INVOICE_ROLLUPS)
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_invoices_rollup_insert AFTER INSERT ON invoices BEGIN\n{add_new}\nEND")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_invoices_rollup_update AFTER UPDATE OF org_id, date, amount, status ON invoices BEGIN\n{remove_old}\n{add_new}\nEND")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_invoices_rollup_delete AFTER DELETE ON invoices BEGIN\n{remove_old}\nEND")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_recognized_revenue_rollup_insert AFTER INSERT ON recognized_revenue BEGIN\n{_recognized_delta('NEW', 1)}\nEND")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_recognized_revenue_rollup_update AFTER UPDATE OF org_id, month, recognized_amount ON recognized_revenue BEGIN\n{_recognized_delta('OLD', -1)}\n{_recognized_delta('NEW', 1)}\nEND")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_recognized_revenue_rollup_delete AFTER DELETE ON recognized_revenue BEGIN\n{_recognized_delta('OLD', -1)}\nEND")
+
+
+# Recompute every rollup (or one org's) from the raw tables
+def rebuild(cur, org_id=None):
+    org_filter = "WHERE org_id IS NOT NULL" if org_id is None else "WHERE org_id = ?"
+    params = () if org_id is None else (org_id,)
+    measures = ", ".join(f"SUM({value})" for value in _invoice_values('invoices'))
+    for table, bucket, bucket_expr in INVOICE_ROLLUPS:
+        cur.execute(f"DELETE FROM {table} {org_filter}", params)
+        bucket_sql = bucket_expr.format(date='invoices.date')
+        cur.execute(f"""INSERT INTO {table} (org_id, {bucket}, {', '.join(INVOICE_MEASURES)})
+                        SELECT org_id, {bucket_sql}, {measures} FROM invoices
+                        {org_filter} AND date IS NOT NULL
+                        GROUP BY org_id, {bucket_sql}""", params)
+    cur.execute(f"DELETE FROM recognized_revenue_monthly {org_filter}", params)
+    cur.execute(f"""INSERT INTO recognized_revenue_monthly (org_id, month, recognized_amount)
+                    SELECT org_id, substr(month, 1, 7), SUM(COALESCE(recognized_amount, 0)) FROM recognized_revenue
+                    {org_filter} AND month IS NOT NULL
+                    GROUP BY org_id, substr(month, 1, 7)""", params)
+
+
+def monthly_revenue(org_id):
+    return cache.read_sql("SELECT month, invoice_count, invoiced_amount, paid_count, paid_amount, open_count, open_amount FROM revenue_monthly WHERE org_id = ? ORDER BY month", params=(org_id,), org_id=org_id)
+
+
+# Totals over revenue_daily for an inclusive YYYY-MM-DD range
+def revenue_between(org_id, start_day, end_day):
+    return db.query_one("""SELECT COALESCE(SUM(invoice_count), 0), COALESCE(SUM(invoiced_amount), 0), COALESCE(SUM(paid_count), 0),
+                                  COALESCE(SUM(paid_amount), 0), COALESCE(SUM(open_count), 0), COALESCE(SUM(open_amount), 0)
+                           FROM revenue_daily WHERE org_id = ? AND day BETWEEN ? AND ?""", (org_id, start_day, end_day))
+
+
+def recognized_monthly(org_id, start_month, end_month):
+    return cache.read_sql("SELECT month, recognized_amount FROM recognized_revenue_monthly WHERE org_id = ? AND month BETWEEN ? AND ? ORDER BY month",
+                          params=(org_id, start_month, end_month), org_id=org_id)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuild the revenue rollup tables from invoices and recognized_revenue.")
+    parser.add_argument('--org-id', type=int, default=None, help="Only rebuild this org (default: all)")
+    args = parser.parse_args()
+    with db.transaction() as cur:
+        rebuild(cur, args.org_id)
+    print("Revenue rollups rebuilt" + (f" for org {args.org_id}" if args.org_id is not None else ""))
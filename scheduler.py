@@ -0,0 +1,24 @@
+from datetime import datetime, timedelta
+import db
+
+# Cross-process claims for background jobs.
+# Every app process runs the same background threads (dunning, fraud retraining, ...); a job
+# claims its name in scheduled_jobs before running, so only one process runs it per interval.
+
+
+def create_tables(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS scheduled_jobs (name TEXT PRIMARY KEY, last_run_at TEXT)")
+
+
+# Claim a scheduled job for this process; False when another process ran it within interval
+def claim(job_name, interval, now=None):
+    now = now or datetime.now()
+    with db.transaction() as cur:
+        cur.execute("INSERT INTO scheduled_jobs (name, last_run_at) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET last_run_at = excluded.last_run_at WHERE last_run_at IS NULL OR last_run_at <= ?",
+                    (job_name, now.isoformat(), (now - timedelta(seconds=interval)).isoformat()))
+        return cur.rowcount == 1
+
+
+# Give a claimed job back, so the next claim runs it whatever its interval
+def release(job_name):
+    db.execute("UPDATE scheduled_jobs SET last_run_at = NULL WHERE name = ?", (job_name,))
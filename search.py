@@ -0,0 +1,73 @@
+import re
+import cache
+import db
+
+# Full-text search over customers and users.
+# customers_fts and users_fts are external-content FTS5 tables over customers / users (rowid =
+# id), kept in sync by triggers (migration 9). Every word typed becomes a prefix phrase, so
+# "bob@exa" matches bob@example.com and "9xQe" matches a wallet address, and results come
+# back ranked by bm25.
+
+SEARCH_LIMIT = 200
+
+FTS_TABLES = {
+    # fts table -> (content table, indexed columns)
+    'customers_fts': ('customers', ['name', 'email', 'address', 'street', 'city', 'state', 'zip_code', 'custom_field']),
+    'users_fts': ('users', ['username', 'email', 'name']),
+}
+
+
+def create_tables(cur):
+    for fts, (table, columns) in FTS_TABLES.items():
+        cols = ", ".join(columns)
+        new_values = ", ".join(f"NEW.{c}" for c in columns)
+        old_values = ", ".join(f"OLD.{c}" for c in columns)
+        cur.execute(f"""CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({cols}, content='{table}', content_rowid='id',
+                        tokenize='unicode61 remove_diacritics 2', prefix='2 3 4')""")
+        cur.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_fts_insert AFTER INSERT ON {table} BEGIN
+                            INSERT INTO {fts} (rowid, {cols}) VALUES (NEW.id, {new_values});
+                        END""")
+        cur.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_fts_delete AFTER DELETE ON {table} BEGIN
+                            INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', OLD.id, {old_values});
+                        END""")
+        cur.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_fts_update AFTER UPDATE OF {cols} ON {table} BEGIN
+                            INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', OLD.id, {old_values});
+                            INSERT INTO {fts} (rowid, {cols}) VALUES (NEW.id, {new_values});
+                        END""")
+
+
+def rebuild(cur):
+    for fts in FTS_TABLES:
+        cur.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+
+# Search box text -> FTS5 query: every word is a quoted prefix phrase, all of them must match.
+# Returns None when there is nothing searchable in the text.
+def fts_query(text):
+    words = [w.replace('"', '') for w in re.split(r"\s+", text or "")]
+    words = [w for w in words if re.search(r"\w", w)]
+    if not words:
+        return None
+    return " AND ".join(f'"{w}"*' for w in words)
+
+
+# Ids of an org's customers matching text, best match first
+def customer_ids(org_id, text, limit=SEARCH_LIMIT):
+    query = fts_query(text)
+    if query is None:
+        return []
+    df = cache.read_sql("""SELECT c.id FROM customers_fts f JOIN customers c ON c.id = f.rowid
+                           WHERE customers_fts MATCH ? AND c.org_id = ? ORDER BY f.rank LIMIT ?""",
+                        params=(query, org_id, limit), org_id=org_id)
+    return df['id'].tolist()
+
+
+# Users visible to an org (theirs plus users without an org) matching text, best match first
+def search_users(org_id, text, limit=SEARCH_LIMIT):
+    query = fts_query(text)
+    if query is None:
+        return cache.read_sql("SELECT id AS ID, username AS Username, email AS Email, name AS Name, role AS Role, created_at AS 'Created At' FROM users WHERE 0")
+    return cache.read_sql("""SELECT u.id AS ID, u.username AS Username, u.email AS Email, u.name AS Name, u.role AS Role, u.created_at AS 'Created At'
+                             FROM users_fts f JOIN users u ON u.id = f.rowid
+                             WHERE users_fts MATCH ? AND (u.org_id = ? OR u.org_id IS NULL) ORDER BY f.rank LIMIT ?""",
+                          params=(query, org_id, limit), org_id=org_id)
@@ -0,0 +1,183 @@
+import base64
+import os
+import threading
+import time
+import httpx
+from solders.hash import Hash
+from solders.message import Message
+from solders.pubkey import Pubkey
+from solders.transaction import Transaction
+from spl.token.instructions import get_associated_token_address, create_idempotent_associated_token_account
+
+# Shared Solana JSON-RPC layer.
+# One pooled keep-alive HTTP client per process, shared by the payments pages instead of a
+# solana Client per page. Lookups for many accounts go out as one JSON-RPC batch request
+# (getMultipleAccounts, 100 keys per call), so a payout batch checks every destination's
+# token account in a single round trip. What the pages ask for again and again is cached:
+#  - token accounts seen on chain are never looked up again (they are not closed here);
+#  - token balances for BALANCE_TTL seconds, dropped early after a send from the account;
+#  - the latest blockhash for BLOCKHASH_TTL seconds (a blockhash stays valid ~60-90s).
+# Rate limits (429) and server errors are retried with exponential backoff.
+
+RPC_URL = os.environ.get('STUNR_SOLANA_RPC', 'https://api.devnet.solana.com')
+USDC_MINT = Pubkey.from_string("4zMMC9srt5Ri5X14GAgXhaHii3GnPAEERYPJgZJDncDU")  # devnet USDC
+COMMITMENT = 'confirmed'
+BALANCE_TTL = 10     # seconds
+BLOCKHASH_TTL = 20   # seconds
+MAX_ACCOUNTS_PER_CALL = 100
+MAX_SIGNATURES_PER_CALL = 256
+MAX_CALLS_PER_REQUEST = 50
+ACCOUNT_CREATES_PER_TX = 5  # create instructions that fit a 1232-byte transaction
+ACCOUNT_CONFIRM_TIMEOUT = 60  # seconds
+CONFIRM_POLL = 1  # seconds
+MAX_RETRIES = 5
+
+_http = None
+_lock = threading.Lock()
+_known_accounts = set()  # str(pubkey) of accounts seen on chain
+_balances = {}           # str(account) -> (fetched_at, ui_amount)
+_blockhash = None        # (fetched_at, Hash)
+
+
+class RpcError(Exception):
+    pass
+
+
+def _client():
+    global _http
+    if _http is None:
+        with _lock:
+            if _http is None:
+                _http = httpx.Client(timeout=30, limits=httpx.Limits(max_connections=10, max_keepalive_connections=10))
+    return _http
+
+
+def _post(payload):
+    delay = 0.5
+    for attempt in range(MAX_RETRIES):
+        response = _client().post(RPC_URL, json=payload)
+        if response.status_code == 429 or response.status_code >= 500:
+            if attempt == MAX_RETRIES - 1:
+                response.raise_for_status()
+            time.sleep(float(response.headers.get('Retry-After', delay)))
+            delay *= 2
+            continue
+        response.raise_for_status()
+        return response.json()
+
+
+# Results of several calls [(method, params), ...], sent MAX_CALLS_PER_REQUEST per HTTP request
+def batch(calls):
+    results = []
+    for i in range(0, len(calls), MAX_CALLS_PER_REQUEST):
+        chunk = calls[i:i + MAX_CALLS_PER_REQUEST]
+        replies = _post([{'jsonrpc': '2.0', 'id': n, 'method': method, 'params': params} for n, (method, params) in enumerate(chunk)])
+        if isinstance(replies, dict):
+            raise RpcError(replies.get('error', replies))
+        by_id = {reply.get('id'): reply for reply in replies}
+        for n in range(len(chunk)):
+            reply = by_id.get(n)
+            if reply is None or 'error' in reply:
+                raise RpcError(f"{chunk[n][0]} failed: {reply and reply['error']}")
+            results.append(reply['result'])
+    return results
+
+
+def call(method, params=None):
+    return batch([(method, params or [])])[0]
+
+
+# The subset of accounts that exist on chain
+def existing_accounts(accounts):
+    accounts = list(dict.fromkeys(str(account) for account in accounts))
+    unknown = [account for account in accounts if account not in _known_accounts]
+    if unknown:
+        chunks = [unknown[i:i + MAX_ACCOUNTS_PER_CALL] for i in range(0, len(unknown), MAX_ACCOUNTS_PER_CALL)]
+        options = {'encoding': 'base64', 'commitment': COMMITMENT, 'dataSlice': {'offset': 0, 'length': 0}}
+        for chunk, result in zip(chunks, batch([('getMultipleAccounts', [chunk, options]) for chunk in chunks])):
+            _known_accounts.update(account for account, info in zip(chunk, result['value']) if info is not None)
+    return {account for account in accounts if account in _known_accounts}
+
+
+def token_balance(account):
+    key = str(account)
+    cached = _balances.get(key)
+    if cached and time.monotonic() - cached[0] < BALANCE_TTL:
+        return cached[1]
+    value = call('getTokenAccountBalance', [key, {'commitment': COMMITMENT}])['value']
+    balance = value.get('uiAmount') or 0.0
+    _balances[key] = (time.monotonic(), balance)
+    return balance
+
+
+def invalidate_balance(account):
+    _balances.pop(str(account), None)
+
+
+def latest_blockhash():
+    global _blockhash
+    if _blockhash is None or time.monotonic() - _blockhash[0] >= BLOCKHASH_TTL:
+        value = call('getLatestBlockhash', [{'commitment': COMMITMENT}])['value']
+        _blockhash = (time.monotonic(), Hash.from_string(value['blockhash']))
+    return _blockhash[1]
+
+
+def send_transaction(txn):
+    return call('sendTransaction', [base64.b64encode(bytes(txn)).decode(), {'encoding': 'base64', 'preflightCommitment': COMMITMENT}])
+
+
+# Sign and send instructions paid by signers[0]; returns the signature
+def send(instructions, signers):
+    blockhash = latest_blockhash()
+    message = Message.new_with_blockhash(instructions, signers[0].pubkey(), blockhash)
+    return send_transaction(Transaction(signers, message, blockhash))
+
+
+# signature -> status dict (None when the cluster has not seen it)
+def signature_statuses(signatures, search_history=False):
+    signatures = [str(signature) for signature in signatures]
+    chunks = [signatures[i:i + MAX_SIGNATURES_PER_CALL] for i in range(0, len(signatures), MAX_SIGNATURES_PER_CALL)]
+    results = batch([('getSignatureStatuses', [chunk, {'searchTransactionHistory': search_history}]) for chunk in chunks])
+    return {signature: status for chunk, result in zip(chunks, results) for signature, status in zip(chunk, result['value'])}
+
+
+# Wait until signatures are confirmed or failed, at most timeout seconds; returns the ones still unsettled
+def wait_for_signatures(signatures, timeout=ACCOUNT_CONFIRM_TIMEOUT):
+    pending = {str(signature) for signature in signatures}
+    deadline = time.monotonic() + timeout
+    while pending:
+        statuses = signature_statuses(pending, search_history=True)
+        pending = {signature for signature, status in statuses.items()
+                   if status is None or (status.get('err') is None and status.get('confirmationStatus') not in ('confirmed', 'finalized'))}
+        if not pending or time.monotonic() >= deadline:
+            break
+        time.sleep(CONFIRM_POLL)
+    return pending
+
+
+# owner -> associated token account for mint, for the owners whose account exists on chain.
+# Missing accounts are created first (paid by payer, ACCOUNT_CREATES_PER_TX per transaction) with
+# the idempotent instruction, so one created meanwhile doesn't fail its transaction; the creates
+# are confirmed and the accounts looked up again before returning, so only accounts seen on chain
+# are returned (and cached). One getMultipleAccounts batch for all owners; known accounts cost no RPC.
+def ensure_token_accounts(owners, payer, mint=USDC_MINT):
+    accounts = {owner: get_associated_token_address(owner, mint) for owner in owners}
+    existing = existing_accounts(accounts.values())
+    missing = [owner for owner, account in accounts.items() if str(account) not in existing]
+    if missing:
+        signatures = []
+        for i in range(0, len(missing), ACCOUNT_CREATES_PER_TX):
+            blockhash = latest_blockhash()
+            instructions = [create_idempotent_associated_token_account(payer.pubkey(), owner, mint) for owner in missing[i:i + ACCOUNT_CREATES_PER_TX]]
+            txn = Transaction([payer], Message.new_with_blockhash(instructions, payer.pubkey(), blockhash), blockhash)
+            try:
+                send_transaction(txn)
+                signatures.append(txn.signatures[0])
+            except RpcError as e:
+                print(f"Creating token accounts failed: {e}")
+            except Exception as e:
+                signatures.append(txn.signatures[0])  # may have reached the cluster
+                print(f"Creating token accounts may have failed: {e}")
+        wait_for_signatures(signatures)
+        existing |= existing_accounts(accounts[owner] for owner in missing)
+    return {owner: account for owner, account in accounts.items() if str(account) in existing}
@@ -0,0 +1,123 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+import stripe
+import db
+
+# Stripe request execution.
+# Every Stripe write goes through one shared worker pool, held to REQUESTS_PER_SECOND (Stripe
+# allows 25 requests/s in test mode and 100 in live mode). Every request carries an
+# idempotency key derived from the row it pays (a payout, or a payout_items row and its
+# attempt), so calling it again, after a crash or a retry, returns the original result
+# instead of paying twice. Stripe only keeps keys for 24 hours: a row left pending by a crash
+# must be resumed within that window, or checked in the Stripe dashboard first.
+# Rate limits (429), connection errors and Stripe server errors are retried with exponential
+# backoff and jitter. A fiat batch item whose retries ran out stays pending, since Stripe may
+# have made the transfer, and is retried under the same key. Any other error fails only its
+# own row and counts an attempt, so the row is retried under a new key (Stripe would replay
+# the saved error for the old one). A batch can be run again until every row is settled.
+# Set STUNR_STRIPE_API_BASE=http://localhost:12111 to run against stripe-mock.
+
+API_BASE = os.environ.get('STUNR_STRIPE_API_BASE')
+REQUESTS_PER_SECOND = float(os.environ.get('STUNR_STRIPE_RPS', 25))
+WORKERS = int(os.environ.get('STUNR_STRIPE_WORKERS', 10))
+MAX_RETRIES = 5
+CURRENCY = "usd"
+MOCK_TRANSFER = "stripe_mock"
+
+RETRYABLE = (stripe.error.RateLimitError, stripe.error.APIConnectionError, stripe.error.APIError)  # APIError: Stripe 5xx
+
+if API_BASE:
+    stripe.api_base = API_BASE
+
+_pool = None
+_pool_lock = threading.Lock()
+_next_slot = 0.0
+_slot_lock = threading.Lock()
+
+
+def _executor():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="stripe")
+    return _pool
+
+
+# Wait for this thread's turn under REQUESTS_PER_SECOND
+def _throttle():
+    global _next_slot
+    with _slot_lock:
+        now = time.monotonic()
+        wait = _next_slot - now
+        _next_slot = max(now, _next_slot) + 1 / REQUESTS_PER_SECOND
+    if wait > 0:
+        time.sleep(wait)
+
+
+# create(**params) with an idempotency key, retrying what Stripe says is safe to retry
+def call(create, idempotency_key, **params):
+    delay = 0.5
+    for attempt in range(MAX_RETRIES):
+        _throttle()
+        try:
+            return create(idempotency_key=idempotency_key, **params)
+        except RETRYABLE:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            time.sleep(delay + random.uniform(0, delay))
+            delay *= 2
+
+
+def payout_key(payout_id):
+    return f"stunr-payout-{payout_id}"
+
+
+def payout_item_key(batch_id, item_id, attempt=0):
+    return f"stunr-payout-{batch_id}-{item_id}" + (f"-{attempt}" if attempt else "")
+
+
+def transfer(amount, destination, idempotency_key):
+    return call(stripe.Transfer.create, idempotency_key, amount=int(round(amount * 100)), currency=CURRENCY, destination=destination)
+
+
+# PaymentIntent created on the worker pool; returns a Future of the intent
+def submit_payment_intent(amount, description, payment_method_types, idempotency_key):
+    return _executor().submit(call, stripe.PaymentIntent.create, idempotency_key, amount=int(round(amount * 100)), currency=CURRENCY,
+                              description=description, payment_method_types=payment_method_types)
+
+
+def _set_item(item_id, status, transfer_id=None, error=None, failed_attempt=False):
+    now = datetime.now().isoformat()
+    db.execute("UPDATE payout_items SET status = ?, tx_sig = COALESCE(?, tx_sig), error = ?, attempts = attempts + ?, sent_at = COALESCE(sent_at, ?), updated_at = ? WHERE id = ?",
+               (status, transfer_id, error, int(failed_attempt), now, now, item_id))
+
+
+def _pay_item(batch_id, item_id, destination, amount, attempt):
+    try:
+        result = transfer(amount, destination, payout_item_key(batch_id, item_id, attempt))
+        _set_item(item_id, 'confirmed', transfer_id=result['id'])
+    except RETRYABLE as e:
+        _set_item(item_id, 'pending', error=str(e.user_message or e))
+    except stripe.error.StripeError as e:
+        _set_item(item_id, 'failed', error=str(e.user_message or e), failed_attempt=True)
+
+
+# Transfer every unsettled item of a fiat batch; returns the number of items processed
+def run_batch(batch_id, mock=False):
+    items = db.query("SELECT id, destination, amount, attempts FROM payout_items WHERE batch_id = ? AND status IN ('pending', 'failed') ORDER BY id", (batch_id,))
+    stripe.api_key = stripe.api_key or db.get_payment_settings()[2]
+    if mock:
+        now = datetime.now().isoformat()
+        db.executemany("UPDATE payout_items SET status = 'confirmed', tx_sig = ?, error = NULL, updated_at = ? WHERE id = ?",
+                       [(MOCK_TRANSFER, now, item_id) for item_id, _, _, _ in items])
+        return len(items)
+    futures = [_executor().submit(_pay_item, batch_id, item_id, destination, amount, attempts) for item_id, destination, amount, attempts in items]
+    for future in as_completed(futures):
+        future.result()
+    return len(items)
+
@@ -0,0 +1,117 @@
+import streamlit as st
+import cache
+
+# Paginated list tables.
+# Filters and the search box become SQL predicates that the list indexes can answer, rows
+# are fetched one page at a time with keyset (seek) pagination on the id column (newest
+# first), and the total is counted only up to COUNT_CAP. The browser gets a single page.
+#
+# Search columns are (sql column, kind):
+#   'id'      - the search term, when it is a number, must equal the column
+#   'prefix'  - case-insensitive prefix match (column LIKE 'term%', needs a COLLATE NOCASE index)
+#   'keyword' - lower-case prefix range for enum-like columns stored in lower case (status)
+
+PAGE_SIZE = 50
+COUNT_CAP = 10000
+
+
+def _escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+# (sql, params) matching term against search_columns; "0" when no column can match it
+def search_predicate(term, search_columns):
+    parts, params = [], []
+    for column, kind in search_columns:
+        if kind == 'id':
+            if term.isdigit():
+                parts.append(f"{column} = ?")
+                params.append(int(term))
+        elif kind == 'keyword':
+            if term.isdigit():
+                continue
+            parts.append(f"({column} >= ? AND {column} < ?)")
+            params += [term.lower(), term.lower() + '\x7f']
+        else:
+            parts.append(f"{column} LIKE ? ESCAPE '\\'")
+            params.append(_escape_like(term) + '%')
+    if not parts:
+        return "0", []
+    return "(" + " OR ".join(parts) + ")", params
+
+
+# One page of rows after the cursor (an id; None for the first page)
+def fetch_page(select, from_where, params, id_column='id', after=None, page_size=PAGE_SIZE, org_id=None):
+    sql = f"SELECT {id_column} AS _key, {select} {from_where}"
+    params = list(params)
+    if after is not None:
+        sql += f" AND {id_column} < ?"
+        params.append(after)
+    sql += f" ORDER BY {id_column} DESC LIMIT ?"
+    params.append(page_size)
+    return cache.read_sql(sql, params=params, org_id=org_id)
+
+
+# Number of matching rows, counting no further than cap
+def capped_count(from_where, params, cap=COUNT_CAP, org_id=None):
+    df = cache.read_sql(f"SELECT COUNT(*) AS n FROM (SELECT 1 {from_where} LIMIT ?)", params=list(params) + [cap + 1], org_id=org_id)
+    return int(df['n'].iloc[0])
+
+
+def _go(state_key, cursor):
+    st.session_state[state_key]['cursors'].append(cursor)
+
+
+def _back(state_key):
+    if len(st.session_state[state_key]['cursors']) > 1:
+        st.session_state[state_key]['cursors'].pop()
+
+
+def build_where(from_where, params, search, search_columns, filters):
+    params = list(params)
+    for sql, filter_params in filters:
+        from_where += f" AND {sql}"
+        params += list(filter_params)
+    search = (search or "").strip()
+    if search:
+        sql, search_params = search_predicate(search, search_columns)
+        from_where += f" AND {sql}"
+        params += search_params
+    return from_where, params
+
+
+# Render a filterable, keyset-paginated table and return the page shown.
+# from_where must contain a WHERE clause ("FROM invoices WHERE org_id = ?"); filters are extra
+# (sql, params) predicates AND-ed to it; search is the raw search box text.
+def paginated_table(key, select, from_where, params=(), search="", search_columns=(), filters=(),
+                    id_column='id', page_size=PAGE_SIZE, org_id=None):
+    from_where, params = build_where(from_where, params, search, search_columns, filters)
+
+    # A new filter combination starts again from the first page
+    state_key = f"{key}_pagination"
+    signature = (from_where, tuple(params))
+    state = st.session_state.get(state_key)
+    if state is None or state['signature'] != signature:
+        state = st.session_state[state_key] = {'signature': signature, 'cursors': [None]}
+
+    page = fetch_page(select, from_where, params, id_column, state['cursors'][-1], page_size, org_id)
+    total = capped_count(from_where, params, org_id=org_id)
+    page_number = len(state['cursors'])
+    first_row = (page_number - 1) * page_size + 1
+
+    st.dataframe(page.drop(columns=['_key']), use_container_width=True, hide_index=True)
+    col1, col2, col3 = st.columns([1, 1, 4])
+    with col1:
+        st.button("Previous", key=f"{key}_prev", disabled=page_number == 1, on_click=_back, args=(state_key,))
+    with col2:
+        has_next = len(page) == page_size and (total > COUNT_CAP or first_row + page_size <= total)
+        st.button("Next", key=f"{key}_next", disabled=not has_next,
+                  on_click=_go, args=(state_key, int(page['_key'].iloc[-1]) if len(page) else None))
+    with col3:
+        total_label = f"{COUNT_CAP:,}+" if total > COUNT_CAP else f"{total:,}"
+        if page.empty:
+            st.caption(f"No matching rows ({total_label} total)")
+        else:
+            st.caption(f"Rows {first_row:,}-{first_row + len(page) - 1:,} of {total_label}")
+    return page.drop(columns=['_key'])
+
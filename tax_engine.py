@@ -0,0 +1,173 @@
+import argparse
+import numpy as np
+import cache
+import db
+
+# Invoice tax engine.
+# Invoices keep their pre-tax amount in net_amount, the rate applied in tax_rate and the tax
+# in tax_amount; amount stays the gross total every other page reads. Tax is always computed
+# from net_amount, so applying it again only changes invoices whose rate changed. Rates come
+# from tax_rules through an in-memory country -> rate index (a cached frame that is dropped as
+# soon as tax_rules is written); an invoice whose customer's country has no rule keeps the
+# rate it was billed with. tax_monthly holds invoiced and collected (paid) tax per org and
+# month, kept up to date by triggers the same way as the revenue rollups.
+# Invoices from before the split had tax added straight to amount by the old "Apply Tax"
+# page (sometimes more than once). backfill_net takes their net amount from the subscription
+# they bill; an invoice whose amount isn't that net plus whole applications of its country's
+# rate is flagged with tax_review instead, and tax is not applied to it until someone enters
+# its net amount on the Taxes page.
+
+CHUNK_SIZE = 50000
+
+_TAX_MEASURES = ['invoiced_tax', 'collected_tax']
+
+
+def _tax_values(row):
+    tax = f"COALESCE({row}.tax_amount, 0)"
+    return [tax, f"CASE WHEN {row}.status = 'paid' THEN {tax} ELSE 0 END"]
+
+
+def _tax_delta(row, sign):
+    signed = [f"{'-' if sign < 0 else ''}{value}" for value in _tax_values(row)]
+    updates = ", ".join(f"{m} = {m} + excluded.{m}" for m in _TAX_MEASURES)
+    return (f"INSERT INTO tax_monthly (org_id, month, {', '.join(_TAX_MEASURES)}) "
+            f"SELECT {row}.org_id, substr({row}.date, 1, 7), {', '.join(signed)} "
+            f"WHERE {row}.org_id IS NOT NULL AND {row}.date IS NOT NULL "
+            f"ON CONFLICT (org_id, month) DO UPDATE SET {updates};")
+
+
+def create_tables(cur):
+    cur.execute("""CREATE TABLE IF NOT EXISTS tax_monthly
+                   (org_id INTEGER, month TEXT, invoiced_tax FLOAT DEFAULT 0, collected_tax FLOAT DEFAULT 0, PRIMARY KEY (org_id, month)) WITHOUT ROWID""")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_invoices_tax_insert AFTER INSERT ON invoices BEGIN\n{_tax_delta('NEW', 1)}\nEND")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_invoices_tax_update AFTER UPDATE OF org_id, date, status, tax_amount ON invoices BEGIN\n{_tax_delta('OLD', -1)}\n{_tax_delta('NEW', 1)}\nEND")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_invoices_tax_delete AFTER DELETE ON invoices BEGIN\n{_tax_delta('OLD', -1)}\nEND")
+
+
+def rebuild(cur):
+    cur.execute("DELETE FROM tax_monthly")
+    cur.execute(f"""INSERT INTO tax_monthly (org_id, month, {', '.join(_TAX_MEASURES)})
+                    SELECT org_id, substr(date, 1, 7), {', '.join(f'SUM({v})' for v in _tax_values('invoices'))} FROM invoices
+                    WHERE org_id IS NOT NULL AND date IS NOT NULL GROUP BY org_id, substr(date, 1, 7)""")
+
+
+# Tax applications the old page could have stacked on one invoice
+MAX_STACKED_TAX = 5
+
+
+# net_amount/tax_rate/tax_amount for invoices that have none. The net is the subscription amount;
+# the gross must equal it untaxed or with the country's current rate applied 1..MAX_STACKED_TAX
+# times, otherwise the invoice is flagged for review. Returns (backfilled, flagged).
+def backfill_net(cur):
+    rows = cur.execute("""SELECT i.id, i.amount, s.amount, r.rate FROM invoices i
+                          LEFT JOIN subscriptions s ON s.id = i.sub_id LEFT JOIN customers c ON c.id = s.customer_id
+                          LEFT JOIN tax_rules r ON r.id = (SELECT MAX(id) FROM tax_rules WHERE upper(country) = upper(c.country))
+                          WHERE i.net_amount IS NULL AND i.amount IS NOT NULL""").fetchall()
+    filled, flagged = [], []
+    for invoice_id, amount, net, rate in rows:
+        matched = None
+        if net is not None:
+            for times in range(MAX_STACKED_TAX + 1 if rate else 1):
+                if abs(net * (1 + (rate or 0) / 100) ** times - amount) < 0.005:
+                    matched = rate if times else 0
+                    break
+        if matched is None:
+            flagged.append((invoice_id,))
+        else:
+            filled.append((net, matched, round(amount - net, 2), invoice_id))
+    cur.executemany("UPDATE invoices SET net_amount = ?, tax_rate = ?, tax_amount = ? WHERE id = ?", filled)
+    cur.executemany("UPDATE invoices SET tax_review = 1 WHERE id = ?", flagged)
+    return len(filled), len(flagged)
+
+
+# Invoices backfill_net couldn't account for, for manual review
+def review_queue(org_id):
+    return db.read_sql("SELECT id AS ID, sub_id AS 'Subscription ID', date AS Date, amount AS Amount, status AS Status FROM invoices WHERE org_id = ? AND tax_review = 1 ORDER BY id",
+                       params=(org_id,))
+
+
+# Record a reviewed invoice's net amount; whatever is above it is the tax already charged
+def resolve_review(invoice_id, net):
+    with db.transaction() as cur:
+        cur.execute("""UPDATE invoices SET net_amount = ?, tax_amount = round(amount - ?, 2),
+                       tax_rate = CASE WHEN ? > 0 THEN round((amount - ?) * 100.0 / ?, 4) ELSE 0 END, tax_review = 0
+                       WHERE id = ? AND tax_review = 1""", (net, net, net, net, net, invoice_id))
+        return cur.rowcount
+
+
+# Country code -> rate (%); the newest rule wins when a country has several
+def rule_index():
+    rules = cache.memoize(('tax_rules',), ['tax_rules'], lambda: db.read_sql(
+        "SELECT upper(country) AS country, rate FROM tax_rules WHERE id IN (SELECT MAX(id) FROM tax_rules WHERE country IS NOT NULL GROUP BY upper(country))"))
+    return rules.set_index('country')['rate']
+
+
+# Tax for a batch: (rate, tax, gross) arrays. Countries without a rule keep current_rate.
+def compute_tax(net, countries, current_rate, rules=None):
+    rules = rule_index() if rules is None else rules
+    rate = countries.map(rules).to_numpy(dtype=float)
+    rate = np.where(np.isnan(rate), np.nan_to_num(current_rate), rate)
+    tax = np.round(net * rate / 100, 2)
+    return rate, tax, np.round(net + tax, 2)
+
+
+def _load_chunk(after_id, org_id, invoice_ids, statuses):
+    sql = """SELECT i.id, COALESCE(i.net_amount, i.amount) AS net, upper(c.country) AS country, i.tax_rate, i.tax_amount, i.amount
+             FROM invoices i JOIN subscriptions s ON s.id = i.sub_id JOIN customers c ON c.id = s.customer_id
+             WHERE i.id > ? AND i.amount IS NOT NULL AND i.tax_review = 0"""
+    params = [after_id]
+    if org_id is not None:
+        sql += " AND i.org_id = ?"
+        params.append(org_id)
+    if invoice_ids is not None:
+        sql += f" AND i.id IN ({', '.join('?' * len(invoice_ids))})"
+        params += list(invoice_ids)
+    if statuses:
+        sql += f" AND i.status IN ({', '.join('?' * len(statuses))})"
+        params += list(statuses)
+    return db.read_sql(sql + " ORDER BY i.id LIMIT ?", params=params + [CHUNK_SIZE])
+
+
+# Apply current tax rules to invoices (default: an org's open ones).
+# Returns (invoices changed, tax on the invoices processed).
+def apply_taxes(org_id=None, invoice_ids=None, statuses=('open',)):
+    if invoice_ids is not None and not invoice_ids:
+        return 0, 0.0
+    rules = rule_index()
+    changed, total_tax, after_id = 0, 0.0, 0
+    while True:
+        df = _load_chunk(after_id, org_id, invoice_ids, statuses)
+        if df.empty:
+            break
+        net = df['net'].to_numpy(dtype=float)
+        rate, tax, gross = compute_tax(net, df['country'], df['tax_rate'].to_numpy(dtype=float), rules)
+        stale = (df['tax_amount'].isna().to_numpy() | (df['tax_amount'].to_numpy(dtype=float) != tax)
+                 | (df['amount'].to_numpy(dtype=float) != gross) | (df['tax_rate'].to_numpy(dtype=float) != rate))
+        idx = np.flatnonzero(stale)
+        if len(idx):
+            ids = df['id'].to_numpy()
+            with db.transaction() as cur:
+                cur.executemany("UPDATE invoices SET net_amount = ?, tax_rate = ?, tax_amount = ?, amount = ? WHERE id = ?",
+                                [(float(net[i]), float(rate[i]), float(tax[i]), float(gross[i]), int(ids[i])) for i in idx.tolist()])
+        changed += len(idx)
+        total_tax += float(tax.sum())
+        after_id = int(df['id'].iloc[-1])
+    return changed, round(total_tax, 2)
+
+
+# Tax collected (on paid invoices) and invoiced per month, from tax_monthly
+def tax_by_month(org_id):
+    return cache.read_sql("SELECT month, invoiced_tax, collected_tax FROM tax_monthly WHERE org_id = ? ORDER BY month", params=(org_id,), org_id=org_id)
+
+
+def tax_collected(org_id):
+    return db.query_one("SELECT COALESCE(SUM(collected_tax), 0) FROM tax_monthly WHERE org_id = ?", (org_id,))[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Apply the current tax rules to invoices.")
+    parser.add_argument('--org-id', type=int, default=None, help="Only this org's invoices (default: all)")
+    parser.add_argument('--status', action='append', default=None, help="Invoice statuses to update (default: open)")
+    args = parser.parse_args()
+    changed, total_tax = apply_taxes(args.org_id, statuses=tuple(args.status or ['open']))
+    print(f"{changed} invoices updated, {total_tax:.2f} USDC tax on the invoices processed")
@@ -1,28 +1,19 @@
 import streamlit as st
 import pandas as pd
-import sqlite3
+import numpy as np
+import db
+import audit
+import tax_engine
 from datetime import datetime  # Added missing import
 import stripe
 
-# Initialize database connection
-conn = sqlite3.connect('stunr_db.sqlite', check_same_thread=False)
-c = conn.cursor()
-
 # Audit logging function
-def log_audit(user_id, action, details):
-    timestamp = datetime.now().isoformat()
-    c.execute("INSERT INTO audit_logs (user_id, action, details, timestamp) VALUES (?, ?, ?, ?)",
-              (user_id, action, details, timestamp))
-    conn.commit()
+def log_audit(user_id, action, details, sync=False):
+    timestamp = audit.log_audit(user_id, action, details, sync=sync)
     st.write(f"Audit Log: {action} - {details} at {timestamp}")  # Optional feedback
 
-# Fetch or initialize payment settings for Stripe
-payment_settings = c.execute("SELECT * FROM payment_settings").fetchone()
-if not payment_settings:
-    c.execute("INSERT INTO payment_settings (stripe_publishable_key, stripe_secret_key) VALUES (?, ?)",
-              ("pk_test_...", "sk_test_..."))  # Replace with real test keys
-    conn.commit()
-    payment_settings = c.execute("SELECT * FROM payment_settings").fetchone()
+# Fetch or initialize payment settings
+payment_settings = db.get_payment_settings()
 stripe.api_key = payment_settings[2]  # Secret key
 
 st.header("Taxes")
@@ -30,7 +21,7 @@ tax_tab1, tax_tab2 = st.tabs(["Tax Rules", "Apply Tax"])
 
 with tax_tab1:
     st.subheader("Tax Rules")
-    tax_rules_df = pd.read_sql_query("SELECT id AS ID, country AS Country, rate AS 'Tax Rate (%)' FROM tax_rules", conn)
+    tax_rules_df = db.read_sql("SELECT id AS ID, country AS Country, rate AS 'Tax Rate (%)' FROM tax_rules")
     if not tax_rules_df.empty:
         st.dataframe(tax_rules_df, use_container_width=True, hide_index=True)
     else:
@@ -40,33 +31,47 @@ with tax_tab1:
     rate = st.number_input("Tax Rate (%)", min_value=0.0, max_value=100.0, value=0.0)
     if st.button("Add Tax Rule"):
         if country:
-            c.execute("INSERT INTO tax_rules (country, rate) VALUES (?, ?)", (country.upper(), rate))
-            conn.commit()
+            db.execute("INSERT INTO tax_rules (country, rate) VALUES (?, ?)", (country.upper(), rate))
             log_audit(st.session_state['user_id'], "added_tax_rule", f"Country: {country}, Rate: {rate}%")
             st.success("Tax rule added successfully!")
 
 with tax_tab2:
     st.subheader("Apply Tax")
-    invoices = c.execute("SELECT id, sub_id, date, amount, due_date FROM invoices WHERE sub_id IN (SELECT id FROM subscriptions WHERE customer_id IN (SELECT id FROM customers WHERE org_id = ?))", (st.session_state['org_id'],)).fetchall()
+    st.metric("Total Tax Collected", f"${tax_engine.tax_collected(st.session_state['org_id']):,.2f} USDC")
+    st.write("Tax is computed from each invoice's pre-tax amount, so applying it again only updates invoices whose rate changed.")
+    if st.button("Apply Tax to All Open Invoices"):
+        changed, total_tax = tax_engine.apply_taxes(st.session_state['org_id'])
+        log_audit(st.session_state['user_id'], "applied_tax", f"Open invoices updated: {changed}")
+        st.success(f"Tax applied! {changed} invoices updated, ${total_tax:,.2f} USDC tax on open invoices.")
+
+    review_df = tax_engine.review_queue(st.session_state['org_id'])
+    if not review_df.empty:
+        st.warning(f"{len(review_df)} older invoices don't match their subscription's amount, so tax isn't applied to them until their net amount is entered.")
+        st.dataframe(review_df, use_container_width=True, hide_index=True)
+        review_id = st.selectbox("Invoice to Review", review_df['ID'].tolist())
+        review_net = st.number_input("Net Amount (USDC)", min_value=0.0, value=0.0, key="review_net")
+        if st.button("Save Net Amount"):
+            if tax_engine.resolve_review(int(review_id), review_net):
+                log_audit(st.session_state['user_id'], "reviewed_invoice_tax", f"Invoice ID: {review_id}, Net Amount: {review_net}")
+                st.success("Net amount saved.")
+
+    invoices = db.query("SELECT id, sub_id, date, amount, due_date FROM invoices WHERE org_id = ?", (st.session_state['org_id'],))
     if invoices:
         selected_invoice = st.selectbox("Select Invoice", [f"ID: {inv[0]} - {inv[2]} - ${inv[3]} USDC" for inv in invoices])
         invoice_id = int(selected_invoice.split("ID: ")[1].split(" - ")[0])
-        invoice_data = c.execute("SELECT i.id, i.amount, s.customer_id, c.country FROM invoices i JOIN subscriptions s ON i.sub_id = s.id JOIN customers c ON s.customer_id = c.id WHERE i.id = ?", (invoice_id,)).fetchone()
+        invoice_data = db.query_one("SELECT i.id, COALESCE(i.net_amount, i.amount), i.tax_rate, upper(c.country) FROM invoices i JOIN subscriptions s ON i.sub_id = s.id JOIN customers c ON s.customer_id = c.id WHERE i.id = ?", (invoice_id,))
         if invoice_data:
-            invoice_id, amount, customer_id, country = invoice_data
-            tax_rate = c.execute("SELECT rate FROM tax_rules WHERE country = ?", (country,)).fetchone()
-            tax_rate = tax_rate[0] if tax_rate else 0.0
-            tax_amount = amount * (tax_rate / 100)
-            total_amount = amount + tax_amount
-            st.write(f"Tax Rate: {tax_rate}%")
-            st.write(f"Tax Amount: ${tax_amount:.2f} USDC")
-            st.write(f"Total Amount: ${total_amount:.2f} USDC")
+            invoice_id, net_amount, current_rate, country = invoice_data
+            rate, tax, gross = tax_engine.compute_tax(np.array([net_amount], dtype=float), pd.Series([country]), np.array([current_rate], dtype=float))
+            st.write(f"Net Amount: ${net_amount:.2f} USDC")
+            st.write(f"Tax Rate: {rate[0]}%")
+            st.write(f"Tax Amount: ${tax[0]:.2f} USDC")
+            st.write(f"Total Amount: ${gross[0]:.2f} USDC")
             if st.button("Apply Tax"):
-                c.execute("UPDATE invoices SET amount = ? WHERE id = ?", (total_amount, invoice_id))
-                conn.commit()
-                log_audit(st.session_state['user_id'], "applied_tax", f"Invoice ID: {invoice_id}, Tax Rate: {tax_rate}%")
-                st.success(f"Tax applied! New total: ${total_amount} USDC")
+                tax_engine.apply_taxes(invoice_ids=[invoice_id], statuses=None)
+                log_audit(st.session_state['user_id'], "applied_tax", f"Invoice ID: {invoice_id}, Tax Rate: {rate[0]}%")
+                st.success(f"Tax applied! New total: ${gross[0]} USDC")
         else:
             st.error("Invoice data not found.")
     else:
-        st.write("No invoices to apply tax to.")
\ No newline at end of file
+        st.write("No invoices to apply tax to.")
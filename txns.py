@@ -1,18 +1,11 @@
 import streamlit as st
 import pandas as pd
-import sqlite3
-
-# Initialize database connection
-conn = sqlite3.connect('stunr_db.sqlite', check_same_thread=False)
-c = conn.cursor()
-
-# Audit logging function
-def log_audit(user_id, action, details):
-    timestamp = datetime.now().isoformat()
-    c.execute("INSERT INTO audit_logs (user_id, action, details, timestamp) VALUES (?, ?, ?, ?)",
-              (user_id, action, details, timestamp))
-    conn.commit()
-    st.write(f"Audit Log: {action} - {details} at {timestamp}")  # Optional feedback
+import db
+import cache
+import tables
+import exporter
+import revrec
+from datetime import datetime
 
 st.header("Transactions")
 txn_tab1, txn_tab2 = st.tabs(["Transaction Log", "Revenue Recognition"])
@@ -20,25 +13,25 @@ txn_tab1, txn_tab2 = st.tabs(["Transaction Log", "Revenue Recognition"])
 with txn_tab1:
     st.subheader("Transaction Log")
     # Modified query to avoid merchant_keypair dependency, focusing on customer transactions
-    txns_df = pd.read_sql_query("SELECT id AS ID, tx_sig AS 'Transaction Signature', amount AS 'Amount (USDC)', from_addr AS 'From Address', timestamp AS 'Timestamp', status AS Status FROM transactions WHERE from_addr IN (SELECT address FROM customers WHERE org_id = ?)", conn, params=(st.session_state['org_id'],))
+    txn_columns = "id AS ID, tx_sig AS 'Transaction Signature', amount AS 'Amount (USDC)', from_addr AS 'From Address', timestamp AS 'Timestamp', status AS Status"
+    txn_from_where = "FROM transactions WHERE from_addr IN (SELECT address FROM customers WHERE org_id = ?)"
+    txn_search = [('id', 'id'), ('tx_sig', 'prefix'), ('status', 'keyword')]
+    search_query = st.text_input("Search Transactions (ID, Signature, Status)", placeholder="Search by ID or status...")
+    txns_df = tables.paginated_table("transactions", txn_columns, txn_from_where, params=(st.session_state['org_id'],),
+                                     search=search_query, search_columns=txn_search, org_id=st.session_state['org_id'])
     if not txns_df.empty:
-        search_query = st.text_input("Search Transactions (ID, Signature, Status)", placeholder="Search by ID or status...")
-        if search_query:
-            txns_df = txns_df[
-                txns_df['ID'].astype(str).str.contains(search_query, case=False) |
-                txns_df['Transaction Signature'].str.contains(search_query, case=False) |
-                txns_df['Status'].str.contains(search_query, case=False)
-            ]
-        st.dataframe(txns_df, use_container_width=True, hide_index=True)
-        csv = txns_df.to_csv(index=False)
-        st.download_button("Export Transactions to CSV", csv, "transactions.csv", "text/csv")
-    else:
+        exporter.export_controls("transactions", "transactions", txn_columns, txn_from_where, params=(st.session_state['org_id'],), search=search_query, search_columns=txn_search)
+    elif not search_query:
         st.write("No transactions logged yet.")
 
 with txn_tab2:
     st.subheader("Revenue Recognition")
-    recognized_df = pd.read_sql_query("SELECT id AS ID, sub_id AS 'Subscription ID', month AS Month, amount AS 'Total Amount (USDC)', recognized_amount AS 'Recognized Amount (USDC)', prorated AS Prorated FROM recognized_revenue WHERE sub_id IN (SELECT id FROM subscriptions WHERE customer_id IN (SELECT id FROM customers WHERE org_id = ?))", conn, params=(st.session_state['org_id'],))
-    deferred_df = pd.read_sql_query("SELECT id AS ID, sub_id AS 'Subscription ID', amount AS 'Deferred Amount (USDC)', start_date AS 'Start Date', end_date AS 'End Date', status AS Status FROM deferred_revenue WHERE sub_id IN (SELECT id FROM subscriptions WHERE customer_id IN (SELECT id FROM customers WHERE org_id = ?))", conn, params=(st.session_state['org_id'],))
+    recognition_month = st.text_input("Recognition Month (YYYY-MM)", value=datetime.now().strftime('%Y-%m'))
+    if st.button("Recognize Month"):
+        schedules, amount = revrec.recognize_month(recognition_month, st.session_state['org_id'])
+        st.success(f"{recognition_month}: ${amount} USDC recognized across {schedules} schedules.")
+    recognized_df = cache.read_sql("SELECT id AS ID, sub_id AS 'Subscription ID', month AS Month, amount AS 'Total Amount (USDC)', recognized_amount AS 'Recognized Amount (USDC)', prorated AS Prorated FROM recognized_revenue WHERE org_id = ?", params=(st.session_state['org_id'],), org_id=st.session_state['org_id'])
+    deferred_df = cache.read_sql("SELECT id AS ID, sub_id AS 'Subscription ID', amount AS 'Deferred Amount (USDC)', recognized_amount AS 'Recognized To Date (USDC)', start_date AS 'Start Date', end_date AS 'End Date', status AS Status FROM deferred_revenue WHERE org_id = ?", params=(st.session_state['org_id'],), org_id=st.session_state['org_id'])
     if not recognized_df.empty or not deferred_df.empty:
         st.subheader("Recognized Revenue")
         st.dataframe(recognized_df, use_container_width=True, hide_index=True)
@@ -0,0 +1,283 @@
+import argparse
+import atexit
+import json
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import db
+
+# Metered usage ingestion.
+# record_usage() validates a batch of events and queues it; a background thread writes
+# everything queued in one transaction (group commit) every FLUSH_INTERVAL seconds or as
+# soon as FLUSH_SIZE events are waiting, then wakes the callers with their counts.
+# Events carrying an idempotency_key are stored at most once per org and subscription (unique
+# index on (org_id, sub_id, idempotency_key), INSERT OR IGNORE), so clients can safely retry a
+# batch and one tenant's keys never collide with another's.
+#
+# usage_minute / usage_hourly / usage_daily hold per-subscription totals and are kept
+# current by triggers on usage_logs; the dashboard charts read those, not raw rows.
+# Run "python usage.py serve" for the local HTTP/JSON endpoint:
+#   POST /usage  {"events": [{"sub_id": 1, "quantity": 3, "timestamp": "...", "idempotency_key": "..."}]}
+
+FLUSH_SIZE = 5000
+FLUSH_INTERVAL = 0.05  # seconds
+MAX_BATCH_EVENTS = 10000
+HTTP_PORT = 8504
+
+USAGE_ROLLUPS = [
+    # (table, bucket column, length of the timestamp prefix that identifies the bucket)
+    ('usage_minute', 'minute', 16),
+    ('usage_hourly', 'hour', 13),
+    ('usage_daily', 'day', 10),
+]
+
+_queue = []  # pending _Ticket objects
+_pending = 0  # events in _queue
+_queue_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_wakeup = threading.Event()
+_flusher = None
+
+
+class _Ticket:
+    def __init__(self, rows):
+        self.rows = rows  # [(index in the caller's batch, sub_id, timestamp, quantity, idempotency_key)]
+        self.accepted = 0
+        self.unknown = []  # indexes whose sub_id does not exist
+        self.error = None
+        self.done = threading.Event()
+
+
+def create_tables(cur):
+    for table, bucket, _ in USAGE_ROLLUPS:
+        cur.execute(f"""CREATE TABLE IF NOT EXISTS {table}
+                        (sub_id INTEGER, {bucket} TEXT, org_id INTEGER, quantity INTEGER DEFAULT 0, events INTEGER DEFAULT 0,
+                         PRIMARY KEY (sub_id, {bucket})) WITHOUT ROWID""")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_org ON {table} (org_id, {bucket})")
+
+
+def _usage_delta(table, bucket, length, row, sign):
+    neg = '-' if sign < 0 else ''
+    return (f"INSERT INTO {table} (sub_id, {bucket}, org_id, quantity, events) "
+            f"SELECT {row}.sub_id, substr({row}.timestamp, 1, {length}), {row}.org_id, {neg}COALESCE({row}.quantity, 0), {neg}1 "
+            f"WHERE {row}.org_id IS NOT NULL AND {row}.timestamp IS NOT NULL "
+            f"ON CONFLICT (sub_id, {bucket}) DO UPDATE SET quantity = quantity + excluded.quantity, events = events + excluded.events, org_id = excluded.org_id;")
+
+
+# Same shape as the revenue rollup triggers: rows that get org_id from the org_id trigger are
+# counted by the UPDATE trigger
+def create_triggers(cur):
+    add_new = "\n".join(_usage_delta(t, b, n, 'NEW', 1) for t, b, n in USAGE_ROLLUPS)
+    remove_old = "\n".join(_usage_delta(t, b, n, 'OLD', -1) for t, b, n in USAGE_ROLLUPS)
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_usage_logs_rollup_insert AFTER INSERT ON usage_logs BEGIN\n{add_new}\nEND")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_usage_logs_rollup_update AFTER UPDATE OF org_id, sub_id, timestamp, quantity ON usage_logs BEGIN\n{remove_old}\n{add_new}\nEND")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_usage_logs_rollup_delete AFTER DELETE ON usage_logs BEGIN\n{remove_old}\nEND")
+
+
+def rebuild(cur):
+    for table, bucket, length in USAGE_ROLLUPS:
+        cur.execute(f"DELETE FROM {table}")
+        cur.execute(f"""INSERT INTO {table} (sub_id, {bucket}, org_id, quantity, events)
+                        SELECT sub_id, substr(timestamp, 1, {length}), MAX(org_id), SUM(COALESCE(quantity, 0)), COUNT(*) FROM usage_logs
+                        WHERE org_id IS NOT NULL AND timestamp IS NOT NULL
+                        GROUP BY sub_id, substr(timestamp, 1, {length})""")
+
+
+# One event -> (sub_id, timestamp, quantity, idempotency_key); raises ValueError when invalid
+def _normalize(event):
+    if not isinstance(event, dict):
+        raise ValueError("event must be an object")
+    try:
+        sub_id = int(event['sub_id'])
+        quantity = int(event.get('quantity', 1))
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("sub_id and quantity must be integers")
+    if quantity < 0:
+        raise ValueError("quantity must not be negative")
+    timestamp = event.get('timestamp')
+    if timestamp is None:
+        timestamp = datetime.now()
+    elif isinstance(timestamp, (int, float)):
+        timestamp = datetime.fromtimestamp(timestamp)
+    else:
+        try:
+            timestamp = datetime.fromisoformat(str(timestamp).replace('Z', '+00:00'))
+        except ValueError:
+            raise ValueError(f"invalid timestamp: {timestamp}")
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone().replace(tzinfo=None)
+    key = event.get('idempotency_key')
+    return sub_id, timestamp.isoformat(timespec='seconds'), quantity, str(key) if key is not None else None
+
+
+def _write(tickets):
+    sub_ids = {row[1] for ticket in tickets for row in ticket.rows}
+    orgs = {}
+    sub_list = list(sub_ids)
+    for i in range(0, len(sub_list), 500):
+        chunk = sub_list[i:i + 500]
+        orgs.update(db.query(f"SELECT id, org_id FROM subscriptions WHERE id IN ({', '.join('?' * len(chunk))})", chunk))
+    with db.transaction() as cur:
+        for ticket in tickets:
+            ticket.unknown = [index for index, sub_id, _, _, _ in ticket.rows if sub_id not in orgs]
+            rows = [(sub_id, ts, qty, key, orgs[sub_id]) for _, sub_id, ts, qty, key in ticket.rows if sub_id in orgs]
+            if rows:
+                # rowcount leaves out rows ignored by the idempotency_key index
+                cur.executemany("INSERT OR IGNORE INTO usage_logs (sub_id, timestamp, quantity, idempotency_key, org_id) VALUES (?, ?, ?, ?, ?)", rows)
+                ticket.accepted = cur.rowcount
+
+
+# Write everything queued so far; returns the number of events written
+def flush():
+    global _pending
+    with _flush_lock:
+        with _queue_lock:
+            tickets = _queue[:]
+            _queue.clear()
+            _pending = 0
+        if not tickets:
+            return 0
+        try:
+            _write(tickets)
+        except Exception as e:
+            # Waiting callers get the error; record_usage(wait=False) batches are lost
+            for ticket in tickets:
+                ticket.error = e
+            raise
+        finally:
+            for ticket in tickets:
+                ticket.done.set()
+        return sum(ticket.accepted for ticket in tickets)
+
+
+def _flush_loop():
+    while True:
+        _wakeup.wait(FLUSH_INTERVAL)
+        _wakeup.clear()
+        try:
+            flush()
+        except Exception as e:
+            print(f"Usage flush failed: {e}")
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is None:
+        with _queue_lock:
+            if _flusher is None:
+                _flusher = threading.Thread(target=_flush_loop, name="usage-flusher", daemon=True)
+                _flusher.start()
+
+
+# Ingest a batch of usage events.
+# Invalid events are reported back and skipped; with wait=True the call returns once the batch
+# is committed, with accepted (newly stored), duplicates (idempotency_key already seen for the subscription) and
+# rejected ([(index, reason)]) counts.
+def record_usage(events, wait=True):
+    global _pending
+    if len(events) > MAX_BATCH_EVENTS:
+        raise ValueError(f"at most {MAX_BATCH_EVENTS} events per batch")
+    rows = []
+    rejected = []
+    for index, event in enumerate(events):
+        try:
+            rows.append((index,) + _normalize(event))
+        except ValueError as e:
+            rejected.append((index, str(e)))
+    result = {'received': len(events), 'accepted': 0, 'duplicates': 0, 'rejected': rejected}
+    if not rows:
+        return result
+    ticket = _Ticket(rows)
+    _ensure_flusher()
+    with _queue_lock:
+        _queue.append(ticket)
+        _pending += len(rows)
+        pending = _pending
+    if pending >= FLUSH_SIZE:
+        _wakeup.set()
+    if not wait:
+        result['queued'] = len(rows)
+        return result
+    ticket.done.wait()
+    if ticket.error is not None:
+        raise ticket.error
+    result['accepted'] = ticket.accepted
+    result['duplicates'] = len(rows) - len(ticket.unknown) - ticket.accepted
+    result['rejected'] = sorted(rejected + [(index, "unknown sub_id") for index in ticket.unknown])
+    return result
+
+
+# Events still queued at interpreter shutdown are written before exit
+atexit.register(flush)
+
+
+class _UsageHandler(BaseHTTPRequestHandler):
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/usage':
+            self._reply(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'null')
+            events = body.get('events') if isinstance(body, dict) else body
+            if not isinstance(events, list):
+                raise ValueError("expected a list of events or {\"events\": [...]}")
+            result = record_usage(events)
+        except ValueError as e:
+            self._reply(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self._reply(500, {'error': str(e)})
+            return
+        result['rejected'] = [{'index': i, 'reason': reason} for i, reason in result['rejected']]
+        self._reply(200, result)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host='127.0.0.1', port=HTTP_PORT):
+    server = ThreadingHTTPServer((host, port), _UsageHandler)
+    print(f"Usage ingestion listening on http://{host}:{port}/usage")
+    try:
+        server.serve_forever()
+    finally:
+        flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Metered usage ingestion.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    serve_cmd = sub.add_parser('serve', help="Run the HTTP/JSON ingestion endpoint")
+    serve_cmd.add_argument('--host', default='127.0.0.1')
+    serve_cmd.add_argument('--port', type=int, default=HTTP_PORT)
+    load_cmd = sub.add_parser('load', help="Ingest a JSON-lines file of events")
+    load_cmd.add_argument('path')
+    sub.add_parser('rebuild', help="Recompute the usage rollup tables from usage_logs")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.host, args.port)
+    elif args.command == 'load':
+        with open(args.path) as f:
+            events = [json.loads(line) for line in f if line.strip()]
+        totals = {'received': 0, 'accepted': 0, 'duplicates': 0, 'rejected': 0}
+        for i in range(0, len(events), MAX_BATCH_EVENTS):
+            result = record_usage(events[i:i + MAX_BATCH_EVENTS])
+            for key in ('received', 'accepted', 'duplicates'):
+                totals[key] += result[key]
+            totals['rejected'] += len(result['rejected'])
+        print(f"{totals['received']} events read: {totals['accepted']} stored, "
+              f"{totals['duplicates']} duplicates, {totals['rejected']} rejected")
+    else:
+        with db.transaction() as cur:
+            rebuild(cur)
+        print("Usage rollups rebuilt")